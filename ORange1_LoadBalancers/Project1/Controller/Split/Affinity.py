@@ -0,0 +1,71 @@
+import bisect
+import Flow,Range,RidsTable
+from ryu.ofproto import ofproto_v1_3
+
+#This file contains the logic for keeping the connections of clients while a rebalance moves ranges.
+#Before the boundaries move, every known client whose address moves to another server is pinned to its former server by an exact match flow
+#in the first balancing table, above all the range flows. The flow expires once the client is idle, so its next connections go to its new server.
+#A pin flow writes the metadata of its server and goes to the RIDs table, which holds a pin target flow for every server in both compilations.
+#The pin target flows send the packets to the servers and have the cookies of the RIDs flows, so pinned packets are counted for their server.
+#The metadata of a range holds its end, which moves on every rebalance, so the pin target flows match a fixed metadata of the server instead.
+
+#Priority of pin flows, above all the flows of the first balancing table
+PIN_PRIORITY=1000
+#Priority of pin target flows, below all the flows of the RIDs table
+PIN_TARGET_PRIORITY=0
+#The range id written into the metadata by pin flows, no range has it so only the pin target flows match it
+PIN_RANGE_ID=0xffffffff
+
+#Returns the index of the range which holds the ip (an integer), or None if no range holds it. The ranges are ordered and do not overlap.
+def findRange(ranges,ip):
+    index=bisect.bisect_right([r.start for r in ranges],ip)-1
+    if index>=0 and ip<=ranges[index].end:
+        return index
+    return None
+
+#Returns a list of (client ip, former range index) tupples of the clients whose address moves to the range of another server
+def getMovedClients(clients,oldRanges,newRanges):
+    moved=[]
+    for client in clients:
+        ip=Range.IP2Int(client[1])
+        oldIndex=findRange(oldRanges,ip)
+        if oldIndex is not None and oldIndex!=findRange(newRanges,ip):
+            moved.append((client[1],oldIndex))
+    return moved
+
+#Returns the metadata written by the pin flows of the server at the index
+def getPinMetadata(index):
+    return (PIN_RANGE_ID << Range.IP_BITS) | index
+
+#Creates a flow which keeps sending the packets of a client to the server at the index, through its pin target flow. The switch reports when the
+#flow expires.
+def createPinFlow(clientIP,index,datapath,idleTimeout,bank=0):
+    ofproto=ofproto_v1_3
+    parser=datapath.ofproto_parser
+    match=parser.OFPMatch(eth_type=0x800,ipv4_src=clientIP)
+    inst=[parser.OFPInstructionGotoTable(Flow.bankTable(4,bank)),
+          parser.OFPInstructionWriteMetadata(getPinMetadata(index),Flow.getMetaDataMask())]
+    return Flow.createFlow(datapath,Flow.createCookie(Flow.PIN_COOKIE,index),Flow.bankTable(1,bank),PIN_PRIORITY,match,inst,
+                           ofproto.OFPFF_SEND_FLOW_REM,idleTimeout)
+
+#Returns the flows of pins, given as a list of (client ip, (range index, range)) tupples
+def getPinFlows(dp,pins,idleTimeout,bank=0):
+    return [createPinFlow(ip,index,dp,idleTimeout,bank) for (ip,(index,flowRange)) in pins]
+
+#Creates the flow of the RIDs table which sends the packets of the clients pinned to the server at the index to the server
+def createPinTargetFlow(index,datapath,servers,bank=0):
+    ofproto=ofproto_v1_3
+    parser=datapath.ofproto_parser
+    match=parser.OFPMatch(eth_type=0x800,metadata=getPinMetadata(index))
+    actions=RidsTable.createServerActions(index,servers)
+    inst=[parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,actions)]
+    return Flow.createFlow(datapath,Flow.createCookie(Flow.RID_COOKIE,index),Flow.bankTable(4,bank),PIN_TARGET_PRIORITY,match,inst)
+
+#Returns the pin target flows of the servers at the given indices, of all the servers if none are given
+def getPinTargetFlows(dp,servers,bank=0,indices=None):
+    indices=range(0,len(servers)) if indices is None else indices
+    return [createPinTargetFlow(index,dp,servers,bank) for index in indices]
+
+#Given the stats of a flow, returns true iff it is the pin target flow of a server in the given bank
+def isPinTarget(stat,bank=0):
+    return stat.table_id==Flow.bankTable(4,bank) and stat.priority==PIN_TARGET_PRIORITY
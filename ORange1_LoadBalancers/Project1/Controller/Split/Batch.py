@@ -0,0 +1,117 @@
+import time
+from ryu.lib import hub
+import Metrics
+
+#This file contains the logic for installing flows in batches.
+#The messages of a batch are serialized together into large writes, the batch is ended by a barrier request
+#and is considered committed once the switch answers the barrier, meaning all the messages before it were applied.
+
+#Maximal number of bytes written to the datapath at once
+MAX_WRITE_SIZE=65536
+
+class FlowBatch(object):
+    #Batches which were sent and wait for their barrier reply, by (datapath id, barrier xid)
+    pending={}
+
+    def __init__(self,datapath):
+        self.datapath=datapath
+        self.msgs=[]
+        self.callbacks=[]
+        self.xid=None
+        self.numOfBytes=0
+        self.createTime=time.time()
+        self.sendTime=None
+        self.commitTime=None
+        self.committed=hub.Event()
+
+    #Adds a message to the batch, it will be sent when the batch is committed
+    def send_msg(self,msg):
+        self.msgs.append(msg)
+
+    #Adds a barrier inside the batch, the switch applies all messages before it before any message after it
+    def addBarrier(self):
+        self.msgs.append(self.datapath.ofproto_parser.OFPBarrierRequest(self.datapath))
+
+    #Registers a function to be called with this batch once the switch applied all of its messages
+    def addCallback(self,callback):
+        if self.committed.is_set():
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    #Serializes all messages followed by a barrier request and sends them to the datapath using as few writes as possible
+    def commit(self,callback=None):
+        if callback is not None:
+            self.addCallback(callback)
+        dp=self.datapath
+        barrier=dp.ofproto_parser.OFPBarrierRequest(dp)
+        dp.set_xid(barrier)
+        self.xid=barrier.xid
+        #Register before writing, the reply may arrive before this function returns
+        FlowBatch.pending[(dp.id,self.xid)]=self
+        self.sendTime=time.time()
+        buf=bytearray()
+        for msg in self.msgs+[barrier]:
+            if msg.xid is None:
+                dp.set_xid(msg)
+            Metrics.countMessage(msg)
+            msg.serialize()
+            buf+=msg.buf
+            if len(buf)>=MAX_WRITE_SIZE:
+                self.write(buf)
+                buf=bytearray()
+        if len(buf)>0:
+            self.write(buf)
+        return self
+
+    #Writes a buffer of serialized messages to the datapath
+    def write(self,buf):
+        self.numOfBytes+=len(buf)
+        self.datapath.send(bytes(buf))
+
+    #Marks the batch as committed and runs its callbacks
+    def done(self):
+        self.commitTime=time.time()
+        self.committed.set()
+        callbacks=self.callbacks
+        self.callbacks=[]
+        for callback in callbacks:
+            callback(self)
+
+    #Blocks the calling green thread until the batch is committed, returns true iff it was committed in time
+    def wait(self,timeout=None):
+        return self.committed.wait(timeout)
+
+    #Returns the number of seconds from the creation of the batch until the switch committed it, None if not committed yet
+    def elapsed(self):
+        if self.commitTime is None:
+            return None
+        return self.commitTime-self.createTime
+
+#Given a barrier reply message, marks the batch waiting for it as committed. Returns the batch, None if no batch waits for this reply.
+def handleBarrierReply(msg):
+    batch=FlowBatch.pending.pop((msg.datapath.id,msg.xid),None)
+    if batch is not None:
+        batch.done()
+        Metrics.registry.histogram("batch_commit_seconds").observe(batch.elapsed())
+    return batch
+
+#Forgets the batches of a datapath which disconnected, their barrier replies will never arrive. Returns the forgotten batches.
+def dropDatapath(dpid):
+    keys=[key for key in FlowBatch.pending if key[0]==dpid]
+    return [FlowBatch.pending.pop(key) for key in keys]
+
+#Returns the number of flow mods and group mods in a batch, None counts as an empty batch
+def countChanges(batch):
+    if batch is None:
+        return 0
+    parser=batch.datapath.ofproto_parser
+    return len([msg for msg in batch.msgs if isinstance(msg,(parser.OFPFlowMod,parser.OFPGroupMod))])
+
+#Sends a message to the datapath, through the batch if one is given
+def send(dp,msg,batch=None):
+    if batch is None:
+        Metrics.countMessage(msg)
+        dp.send_msg(msg)
+    else:
+        batch.send_msg(msg)
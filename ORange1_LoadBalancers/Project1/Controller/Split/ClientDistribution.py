@@ -0,0 +1,71 @@
+import Range,Probes
+
+#This file contains the logic for dividing a subnet between the servers by the distribution of the clients in it, instead of evenly.
+#The distribution is a list of (start,end,count) tupples - the learned clients, each counted once, or a histogram loaded from a file.
+#Range boundaries are placed at the weighted quantiles of the distribution, so every range holds a share of the clients which matches its weight.
+
+#Share of the clients which is assumed to be spread evenly over the subnet, so addresses where no client was seen are not given away for free
+UNIFORM_SHARE=0.01
+#The least number of clients the even share is worth for every range, so a small sample does not leave the unseen addresses to a single server
+UNIFORM_CLIENTS=4
+
+#Loads a histogram of client addresses from a file. Every line holds an address or a CIDR prefix, optionally followed by a count (1 by default),
+#the count of a prefix is spread evenly over its addresses. Empty lines and lines starting with # are skipped.
+def loadHistogram(path):
+    points=[]
+    with open(path) as f:
+        for line in f:
+            fields=line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            count=float(fields[1]) if len(fields)>1 else 1
+            if "/" in fields[0]:
+                (ip,prefixLen)=fields[0].split("/")
+                start=Range.prefixOf(Range.IP2Int(ip),int(prefixLen))
+                points.append((start,start+(1 << (Range.IP_BITS-int(prefixLen)))-1,count))
+            else:
+                points.append((Range.IP2Int(fields[0]),Range.IP2Int(fields[0]),count))
+    return points
+
+#Returns the distribution of the learned clients, every client is counted once
+def getClientPoints(clients):
+    return [(Range.IP2Int(client[1]),Range.IP2Int(client[1]),1) for client in clients]
+
+#Returns segments which cover the addresses from low to high in order, with the counts of the points inside them and the uniform share, of at
+#least minUniform clients, added to all of them. Points outside the addresses, or overlapping a former point, are cut.
+def getSegments(points,low,high,minUniform=0):
+    total=float(sum(count for (start,end,count) in points))
+    floor=max(total*UNIFORM_SHARE,minUniform)/float(high-low+1)
+    segments=[]
+    position=low
+    for (start,end,count) in sorted(points):
+        (pointStart,pointEnd)=(max(start,position),min(end,high))
+        if pointStart>pointEnd:
+            continue
+        if pointStart>position:
+            segments.append((position,pointStart-1,floor*(pointStart-position)))
+        segments.append((pointStart,pointEnd,count*float(pointEnd-pointStart+1)/(end-start+1)+floor*(pointEnd-pointStart+1)))
+        position=pointEnd+1
+    if position<=high:
+        segments.append((position,high,floor*(high-position+1)))
+    return segments
+
+#Returns a list of (start,end) tupples which divide the addresses from low to high by the weights, so the clients inside each range match its weight.
+#Every range gets at least one address. Returns None if there are fewer clients than ranges, the quantiles of so few clients would give single
+#addresses to most of the ranges, so the addresses should be divided evenly instead.
+def getQuantileBounds(points,weights,low,high):
+    if sum(count for (start,end,count) in points)<len(weights):
+        return None
+    segments=getSegments(points,low,high,UNIFORM_CLIENTS*len(weights))
+    total=sum(count for (start,end,count) in segments)
+    bounds=[]
+    start=low
+    cumulative=0
+    for i in range(0,len(weights)-1):
+        cumulative+=weights[i]
+        end=Probes.addressAtTraffic(segments,total*cumulative/float(sum(weights)))-1
+        end=min(max(end,start),high-(len(weights)-1-i))
+        bounds.append((start,end))
+        start=end+1
+    bounds.append((start,high))
+    return bounds
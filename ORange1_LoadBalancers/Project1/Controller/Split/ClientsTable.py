@@ -1,34 +1,55 @@
-import Flow
+import Flow,Batch,Metrics
 from ryu.ofproto import ofproto_v1_3
 
 #This file contains all the logic for populating the first table, used for traffic from servers to clients, which should no be run through the balancing process
 
-#Create a flow for this table, one is created for each client
-def createStableFlow(clientIP,clientPort,datapath,servers):
+#Create a flow for this table, one is created for each client. The source of the packet is rewritten to the (ip, mac) of the virtual service.
+def createStableFlow(clientIP,clientPort,datapath,service):
     ofproto=ofproto_v1_3
     parser = datapath.ofproto_parser
     match = datapath.ofproto_parser.OFPMatch(eth_type=0x800,ipv4_dst=clientIP)
-    actions = [datapath.ofproto_parser.OFPActionSetField(ipv4_src=servers[len(servers)-1][1]),
-                   datapath.ofproto_parser.OFPActionSetField(eth_src=servers[len(servers)-1][2]),
+    actions = [datapath.ofproto_parser.OFPActionSetField(ipv4_src=service[0]),
+                   datapath.ofproto_parser.OFPActionSetField(eth_src=service[1]),
                    datapath.ofproto_parser.OFPActionOutput(clientPort)]
     apply = parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,actions)
     inst = [apply]
     return Flow.createFlow(datapath,0,0,2,match,inst)
 
 #Install the flow
-def installStableFlow(clientIP,clientPort,datapath,servers):
+def installStableFlow(clientIP,clientPort,datapath,service,batch=None):
     #print "Defining flow..IP={0} .  port={1}".format(clientIP,clientPort)
-    datapath.send_msg(createStableFlow(clientIP,clientPort,datapath,servers))
+    Batch.send(datapath,createStableFlow(clientIP,clientPort,datapath,service),batch)
   
-#Creates a table miss flow, used in case the packet destination is not a client but rather a server, sends it to the balancing tables.      
-def createStableMissFlow(datapath):
+#Creates a table miss flow, used in case the packet destination is not a client but rather a server, sends it to the balancing tables of the given bank.
+#Adding it again with another bank replaces the former one, which moves all balanced traffic to the other bank at once.
+def createStableMissFlow(datapath,bank=0):
     ofproto=ofproto_v1_3
     match = datapath.ofproto_parser.OFPMatch()
-    inst = [datapath.ofproto_parser.OFPInstructionGotoTable(1)]
+    inst = [datapath.ofproto_parser.OFPInstructionGotoTable(Flow.bankTable(1,bank))]
     return Flow.createFlow(datapath,0,0,1,match,inst)
 
+#Creates a flow which floods ARP packets, so once the hosts were learned the switch answers them by itself and the controller stops acting as a hub
+def createArpFloodFlow(datapath):
+    ofproto=ofproto_v1_3
+    match = datapath.ofproto_parser.OFPMatch(eth_type=0x806)
+    actions = [datapath.ofproto_parser.OFPActionOutput(ofproto.OFPP_FLOOD)]
+    inst = [datapath.ofproto_parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,actions)]
+    return Flow.createFlow(datapath,0,0,3,match,inst)
+
+#Creates a flow which sends the ARP requests for the ip of the virtual service to the controller, which answers them. Clients which were not
+#learned yet are learned by these requests.
+def createServiceArpFlow(datapath,serviceIP):
+    ofproto=ofproto_v1_3
+    match = datapath.ofproto_parser.OFPMatch(eth_type=0x806,arp_op=1,arp_tpa=serviceIP)
+    actions = [datapath.ofproto_parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,ofproto.OFPCML_NO_BUFFER)]
+    inst = [datapath.ofproto_parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,actions)]
+    return Flow.createFlow(datapath,0,0,4,match,inst)
+
 #Install all flows in table
-def prepareStable(dp,clients,servers):
+@Metrics.timed("prepare_table_seconds",table="stable")
+def prepareStable(dp,clients,service,batch=None,bank=0):
     for i in range(0,len(clients)):
-        installStableFlow(clients[i][1],clients[i][0],dp,servers)
-    dp.send_msg(createStableMissFlow(dp))   
+        installStableFlow(clients[i][1],clients[i][0],dp,service,batch)
+    Batch.send(dp,createServiceArpFlow(dp,service[0]),batch)
+    Batch.send(dp,createArpFloodFlow(dp),batch)
+    Batch.send(dp,createStableMissFlow(dp,bank),batch)   
@@ -1,28 +1,33 @@
-import Flow,Range
-from ryu.ofproto import ofproto_v1_3
+import Flow,Range,Batch,Metrics
 
 #This file contains all the logic for populating the compare table used to compare the ip source with a range's end
 
 #Creates a flow using a spesific pattern
 def createSecondTableFlow(pattern, index, datapath):
-    ofproto = datapath.ofproto
-    match = datapath.ofproto_parser.OFPMatch(eth_type=0x800,ipv4_src=getPatternIPPart(pattern),
-                                                 metadata=getPatternEndPart(pattern))
-    inst = []
+    return createCompareFlow(createCompareRule(pattern, index), datapath)
+
+#Creates a flow from a precomputed compare rule, in the compare table of the given bank
+def createCompareFlow(rule, datapath, bank=0):
+    (ipPart, endPart, priority, table) = rule
+    match = datapath.ofproto_parser.OFPMatch(eth_type=0x800,ipv4_src=ipPart,metadata=endPart)
+    inst = [datapath.ofproto_parser.OFPInstructionGotoTable(Flow.bankTable(table,bank))]
+    return Flow.createFlow(datapath,0,Flow.bankTable(2,bank),priority,match,inst)
+
+#Returns a tuple of (ip part, end part, priority, goto table) for a spesific pattern, all the values needed to create its flow
+def createCompareRule(pattern, index):
     if (index % 2 == 1):
         # False case
-        inst = [datapath.ofproto_parser.OFPInstructionGotoTable(3)]
+        table = 3
     else:
         # True case
-        inst = [datapath.ofproto_parser.OFPInstructionGotoTable(4)]
-      
-    return Flow.createFlow(datapath,0,2,1000-index,match,inst) 
+        table = 4
+    return (getPatternIPPart(pattern), getPatternEndPart(pattern), 1000-index, table)
 
 #Populates the compare table with all flows
-def prepareCompareTable(dp):
-    patternList = getCompareTablePatterns()
-    for i in range(0, len(patternList)):
-        dp.send_msg(createSecondTableFlow(patternList[i], i, dp))
+@Metrics.timed("prepare_table_seconds",table="compare")
+def prepareCompareTable(dp,batch=None,bank=0):
+    for rule in COMPARE_RULES:
+        Batch.send(dp,createCompareFlow(rule, dp, bank),batch)
 
 #Returns a list of all the patterns in the compare table
 def getCompareTablePatterns():
@@ -76,3 +81,6 @@ def pattern2Mask(p):
     p= p.replace("0","1")
     p= p.replace("*","0")
     return p
+
+#The compare table never changes, so its rules are computed once and shared by all the datapaths
+COMPARE_RULES = tuple(createCompareRule(p, i) for (i, p) in enumerate(getCompareTablePatterns()))
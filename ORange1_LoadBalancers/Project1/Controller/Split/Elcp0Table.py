@@ -1,18 +1,35 @@
-import Flow,Range
+import Flow,Batch,Metrics
 from ryu.ofproto import ofproto_v1_3
 
 #This file contains all the logic for populating the fourth table, used for the balancing of traffic
 
 #Creates a flow for the table, one for each range, representing the start of a range
-def createThirdTableFlow(flowRange, datapath):
+def createThirdTableFlow(flowRange, datapath, bank=0):
     ofproto=ofproto_v1_3
     match = datapath.ofproto_parser.OFPMatch(eth_type=0x800,ipv4_src=flowRange.getZeroELCP())
     #If a match is found, send to the last table which will send the packet to the chosen server
-    inst = [datapath.ofproto_parser.OFPInstructionGotoTable(4),
-               datapath.ofproto_parser.OFPInstructionWriteMetadata(Range.fromBinary(Range.toBinary(int(flowRange.ID)) +flowRange.end), Flow.getMetaDataMask(), type_=None, len_=None)]     
-    return Flow.createFlow(datapath,int(flowRange.ID),3,100-Range.starsInString(flowRange.zeroELCP),match,inst)
+    inst = [datapath.ofproto_parser.OFPInstructionGotoTable(Flow.bankTable(4,bank)),
+               datapath.ofproto_parser.OFPInstructionWriteMetadata(flowRange.getMetadata(), Flow.getMetaDataMask(), type_=None, len_=None)]
+    return Flow.createFlow(datapath,int(flowRange.ID),Flow.bankTable(3,bank),100-flowRange.getELCPStars(),match,inst)
         
 #Install all flows in table
-def prepareELCP0Table(dp,ranges):
+@Metrics.timed("prepare_table_seconds",table="elcp0")
+def prepareELCP0Table(dp,ranges,batch=None,bank=0):
     for i in range(0, len(ranges)):
-        dp.send_msg(createThirdTableFlow(ranges[i], dp)) 
+        Batch.send(dp,createThirdTableFlow(ranges[i], dp, bank),batch)
+
+#Returns the flows of the table for a list of ranges, as a dictionary from the flow's (elcp, priority) to a (written values, range) tuple
+def getRangeRules(ranges):
+    rules={}
+    for flowRange in ranges:
+        rules[(flowRange.getZeroELCP(),100-flowRange.getELCPStars())]=((flowRange.getMetadata(),int(flowRange.ID)),flowRange)
+    return rules
+
+#Returns the flows needed to move the table from the old ranges to the new ones, as a tuple of (flows to add, flows to delete).
+#Flows of ranges which did not change are not returned.
+def getUpdateFlows(dp,oldRanges,newRanges,bank=0):
+    (add,delete)=Flow.diffRules(getRangeRules(oldRanges),getRangeRules(newRanges))
+    addFlows=[createThirdTableFlow(flowRange,dp,bank) for flowRange in add]
+    deleteFlows=[Flow.createDeleteStrictFlow(dp,Flow.bankTable(3,bank),priority,dp.ofproto_parser.OFPMatch(eth_type=0x800,ipv4_src=elcp))
+                    for (elcp,priority) in delete]
+    return (addFlows,deleteFlows)
@@ -1,28 +1,45 @@
-import Flow,Range
+import Flow,Batch,Metrics
 from ryu.ofproto import ofproto_v1_3
 
 #This file contains all the logic for populating the second table, used for the balancing of traffic
 
 #Creates a flow for the table, one for each range, representing the end of a range
-def createFirstTableFlow(flowRange, datapath):
+def createFirstTableFlow(flowRange, datapath, bank=0):
     ofproto=ofproto_v1_3
     match = datapath.ofproto_parser.OFPMatch(eth_type=0x800,ipv4_src=flowRange.getOneELCP())
     #If a match is found, write the range id and end into the metadata and send to third table in order to verify the range's end is higher than the source ip.
-    inst = [datapath.ofproto_parser.OFPInstructionGotoTable(2),
+    inst = [datapath.ofproto_parser.OFPInstructionGotoTable(Flow.bankTable(2,bank)),
                datapath.ofproto_parser.OFPInstructionWriteMetadata
-               (Range.fromBinary(Range.toBinary(int(flowRange.ID)) +flowRange.end), Flow.getMetaDataMask(), type_=None, len_=None)]
-    return Flow.createFlow(datapath,int(flowRange.ID),1,100-Range.starsInString(flowRange.oneELCP),match,inst)
+               (flowRange.getMetadata(), Flow.getMetaDataMask(), type_=None, len_=None)]
+    return Flow.createFlow(datapath,int(flowRange.ID),Flow.bankTable(1,bank),100-flowRange.getELCPStars(),match,inst)
 
 
 #Creates a table miss in case no match was found, sends it to the fourth table in order to find a match againt the range's start.
-def createFirstTableMissFlow(datapath): 
+def createFirstTableMissFlow(datapath, bank=0):
     ofproto=ofproto_v1_3
     match = datapath.ofproto_parser.OFPMatch()
-    inst = [datapath.ofproto_parser.OFPInstructionGotoTable(3)]
-    return Flow.createFlow(datapath,404,1,1,match,inst)
+    inst = [datapath.ofproto_parser.OFPInstructionGotoTable(Flow.bankTable(3,bank))]
+    return Flow.createFlow(datapath,404,Flow.bankTable(1,bank),1,match,inst)
 
 #Install all flows in table        
-def prepareELCP1Table(dp,ranges):
+@Metrics.timed("prepare_table_seconds",table="elcp1")
+def prepareELCP1Table(dp,ranges,batch=None,bank=0):
     for i in range(0, len(ranges)):
-        dp.send_msg(createFirstTableFlow(ranges[i], dp))
-    dp.send_msg(createFirstTableMissFlow(dp))
+        Batch.send(dp,createFirstTableFlow(ranges[i], dp, bank),batch)
+    Batch.send(dp,createFirstTableMissFlow(dp, bank),batch)
+
+#Returns the flows of the table for a list of ranges, as a dictionary from the flow's (elcp, priority) to a (written values, range) tuple
+def getRangeRules(ranges):
+    rules={}
+    for flowRange in ranges:
+        rules[(flowRange.getOneELCP(),100-flowRange.getELCPStars())]=((flowRange.getMetadata(),int(flowRange.ID)),flowRange)
+    return rules
+
+#Returns the flows needed to move the table from the old ranges to the new ones, as a tuple of (flows to add, flows to delete).
+#Flows of ranges which did not change are not returned.
+def getUpdateFlows(dp,oldRanges,newRanges,bank=0):
+    (add,delete)=Flow.diffRules(getRangeRules(oldRanges),getRangeRules(newRanges))
+    addFlows=[createFirstTableFlow(flowRange,dp,bank) for flowRange in add]
+    deleteFlows=[Flow.createDeleteStrictFlow(dp,Flow.bankTable(1,bank),priority,dp.ofproto_parser.OFPMatch(eth_type=0x800,ipv4_src=elcp))
+                    for (elcp,priority) in delete]
+    return (addFlows,deleteFlows)
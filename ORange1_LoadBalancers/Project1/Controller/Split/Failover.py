@@ -0,0 +1,119 @@
+import socket
+import Flow,FastPath
+from ryu.ofproto import ofproto_v1_3
+
+#This file contains the logic for failing over from servers which went away. A server fails when the port it is connected to goes down or, if the
+#health probes are on, when it did not answer several ARP probes of the controller in a row.
+#The range of a failed server is given to the live servers around it, half to each, so only the flows of these ranges are rewritten. The failed
+#server keeps a placeholder range of a single address, and the flows of its range are sent to its standby, the nearest live server.
+#All the flows are sent to the switch as a single batch, so a failover takes a single control round trip.
+
+#The source MAC of the health probes, the switch sends the replies of the servers to it to the controller
+HEALTH_MAC="02:00:00:00:00:fe"
+#The source IP of the health probes, an ARP probe (RFC 5227) does not change the ARP caches of the servers and is answered to 0.0.0.0
+HEALTH_IP="0.0.0.0"
+#Number of addresses in the placeholder range of a failed server
+FAILED_RANGE_SIZE=1
+
+#Given a port status message, returns true iff the port went down - it was deleted, its link is down or it was brought down by configuration
+def isPortDown(msg):
+    ofproto=ofproto_v1_3
+    return (msg.reason==ofproto.OFPPR_DELETE or msg.desc.state & ofproto.OFPPS_LINK_DOWN!=0
+            or msg.desc.config & ofproto.OFPPC_PORT_DOWN!=0)
+
+#Returns the index of the live server nearest to the server at the index, the one before it on a tie, or None if all the servers failed
+def getStandby(index,failed,numOfServers):
+    for distance in range(1,numOfServers):
+        for candidate in [index-distance,index+distance]:
+            if 0<=candidate<numOfServers and candidate not in failed:
+                return candidate
+    return None
+
+#Given the standby of every failed server by its index, returns the servers where every failed server is replaced by its standby
+def getTargetServers(servers,standbys):
+    return [servers[standbys.get(i,i)] for i in range(0,len(servers))]
+
+#Given the (start, end) bounds of the ranges in order, returns the bounds where the addresses of every run of failed servers are given to the live
+#servers around it, half to each, and every failed server keeps FAILED_RANGE_SIZE addresses between them. The bounds of other ranges do not move.
+def collapseFailedRanges(bounds,failed):
+    bounds=[list(b) for b in bounds]
+    i=0
+    while i<len(bounds):
+        if i not in failed:
+            i+=1
+            continue
+        first=i
+        while i<len(bounds) and i in failed:
+            i+=1
+        last=i-1
+        if first==0 and last==len(bounds)-1:
+            break
+        (start,end)=(bounds[first][0],bounds[last][1])
+        count=last-first+1
+        free=end-start+1-count*FAILED_RANGE_SIZE
+        if free<0:
+            continue
+        if first==0:
+            down=0
+        elif last==len(bounds)-1:
+            down=free
+        else:
+            #The addresses are split near the middle, at the address which ends the most prefixes, so the flows of the prefix compilation change little
+            down=getAlignedAddress(start+free/4,start+free-free/4)-start
+        if first>0:
+            bounds[first-1][1]=start+down-1
+        position=start+down
+        for j in range(first,last+1):
+            bounds[j]=[position,position+FAILED_RANGE_SIZE-1]
+            position+=FAILED_RANGE_SIZE
+        if last<len(bounds)-1:
+            bounds[last+1][0]=position
+    return [tuple(b) for b in bounds]
+
+#Returns the address from low to high which has the most trailing zero bits
+def getAlignedAddress(low,high):
+    for bits in range(31,0,-1):
+        size=1 << bits
+        address=(low+size-1)/size*size
+        if address<=high:
+            return address
+    return low
+
+#Given the bounds of the ranges in order, returns the bounds where the range at the index grows to about size addresses, which are taken from the
+#ranges around it, half from each. Every one of them keeps at least half of its addresses. Used when a failed server recovers.
+def expandRange(bounds,index,size):
+    bounds=[list(b) for b in bounds]
+    need=size-(bounds[index][1]-bounds[index][0]+1)
+    sides=[j for j in [index-1,index+1] if 0<=j<len(bounds)]
+    for j in sides:
+        if need<=0:
+            break
+        #The range before gives half, and the range after gives the rest
+        share=need/2 if j<index and len(sides)>1 else need
+        take=min(share,(bounds[j][1]-bounds[j][0]+1)/2)
+        if j<index:
+            bounds[j][1]-=take
+            bounds[index][0]-=take
+        else:
+            bounds[j][0]+=take
+            bounds[index][1]+=take
+        need-=take
+    return [tuple(b) for b in bounds]
+
+#Returns the raw Ethernet frame of the health probe of a server, an ARP request for its ip which is sent to its mac
+def createHealthProbe(serverMac,serverIP):
+    eth=FastPath.ETH_HEADER.pack(FastPath.stringToMac(serverMac),FastPath.stringToMac(HEALTH_MAC),FastPath.ETH_TYPE_ARP)
+    return eth+FastPath.ARP_HEADER.pack(1,FastPath.ETH_TYPE_IP,6,4,FastPath.ARP_REQUEST,FastPath.stringToMac(HEALTH_MAC),
+                                        socket.inet_aton(HEALTH_IP),"\0"*6,socket.inet_aton(serverIP))
+
+#Returns true iff a parsed ARP packet (see FastPath.parseArp) is the reply of a server to a health probe
+def isHealthReply(arpPacket):
+    return arpPacket is not None and arpPacket[0]==FastPath.ARP_REPLY and arpPacket[3]==HEALTH_IP
+
+#Creates a flow which sends the replies to the health probes to the controller, above the flow which floods ARP packets
+def createHealthReplyFlow(datapath):
+    ofproto=ofproto_v1_3
+    match = datapath.ofproto_parser.OFPMatch(eth_type=FastPath.ETH_TYPE_ARP,arp_op=FastPath.ARP_REPLY,eth_dst=HEALTH_MAC)
+    actions = [datapath.ofproto_parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,ofproto.OFPCML_NO_BUFFER)]
+    inst = [datapath.ofproto_parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,actions)]
+    return Flow.createFlow(datapath,0,0,4,match,inst)
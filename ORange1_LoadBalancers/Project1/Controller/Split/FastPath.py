@@ -0,0 +1,66 @@
+import socket,struct,time
+
+#This file contains the cheap handling of packet-ins. While the controller learns the hosts, only the Ethernet and ARP headers are read from the raw
+#buffer of a packet, instead of parsing the whole packet. A token bucket limits the packet-ins handled for a switch, so a broadcast storm while the
+#hosts are learned does not saturate the control channel. ARP replies of the virtual service are built here as well.
+
+ETH_TYPE_ARP=0x806
+ETH_TYPE_VLAN=0x8100
+ETH_TYPE_IP=0x800
+ARP_REQUEST=1
+ARP_REPLY=2
+ETH_HEADER=struct.Struct("!6s6sH")
+VLAN_HEADER=struct.Struct("!HH")
+#Hardware type, protocol type, hardware length, protocol length, opcode, sender MAC, sender IP, target MAC and target IP of an ARP packet
+#over Ethernet and IPv4
+ARP_HEADER=struct.Struct("!HHBBH6s4s6s4s")
+
+#Returns the (opcode, sender MAC, sender IP, target IP) of an ARP packet, the addresses as strings, or None if the packet is not an ARP packet
+def parseArp(data):
+    if len(data)<ETH_HEADER.size:
+        return None
+    (dst,src,ethType)=ETH_HEADER.unpack_from(data,0)
+    offset=ETH_HEADER.size
+    while ethType==ETH_TYPE_VLAN and len(data)>=offset+VLAN_HEADER.size:
+        (tci,ethType)=VLAN_HEADER.unpack_from(data,offset)
+        offset+=VLAN_HEADER.size
+    if ethType!=ETH_TYPE_ARP or len(data)<offset+ARP_HEADER.size:
+        return None
+    (hwType,protoType,hwLen,protoLen,opcode,senderMac,senderIP,targetMac,targetIP)=ARP_HEADER.unpack_from(data,offset)
+    if hwLen!=6 or protoLen!=4:
+        return None
+    return (opcode,macToString(senderMac),socket.inet_ntoa(senderIP),socket.inet_ntoa(targetIP))
+
+#Returns the raw Ethernet frame of an ARP reply, which tells the requester that the ip is at the mac
+def createArpReply(mac,ip,requesterMac,requesterIP):
+    eth=ETH_HEADER.pack(stringToMac(requesterMac),stringToMac(mac),ETH_TYPE_ARP)
+    return eth+ARP_HEADER.pack(1,ETH_TYPE_IP,6,4,ARP_REPLY,stringToMac(mac),socket.inet_aton(ip),
+                               stringToMac(requesterMac),socket.inet_aton(requesterIP))
+
+#Given 6 raw bytes, returns the MAC address string
+def macToString(mac):
+    return ":".join("%02x" % b for b in struct.unpack("!6B",mac))
+
+#Given a MAC address string, returns its 6 raw bytes
+def stringToMac(mac):
+    return struct.pack("!6B",*[int(part,16) for part in mac.split(":")])
+
+#A token bucket, which allows rate events a second on average and up to burst events at once
+class TokenBucket(object):
+    def __init__(self,rate,burst):
+        self.rate=float(rate)
+        self.burst=float(burst)
+        self.tokens=float(burst)
+        self.lastTime=time.time()
+        self.dropped=0
+
+    #Returns true iff an event is allowed now, and takes its token
+    def consume(self):
+        now=time.time()
+        self.tokens=min(self.burst,self.tokens+(now-self.lastTime)*self.rate)
+        self.lastTime=now
+        if self.tokens<1:
+            self.dropped+=1
+            return False
+        self.tokens-=1
+        return True
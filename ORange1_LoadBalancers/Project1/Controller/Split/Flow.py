@@ -1,21 +1,62 @@
-import Range
 from ryu.ofproto import ofproto_v1_3
 
+#Mask of all 64 bits of the metadata
+METADATA_MASK=(1 << 64)-1
+
+#The balancing tables (1-4) are duplicated into banks of this size, a new set of ranges is written into the
+#inactive bank and traffic is moved to it at once by changing the goto table of the first table's miss flow
+BANK_SIZE=4
+NUM_OF_BANKS=2
+
+#Cookies of flows whose statistics are collected hold the flow type in their upper 32 bits and an index in the lower 32 bits,
+#so stats requests can ask for a single type using a cookie mask
+COOKIE_TYPE_MASK=0xffffffff << 32
+COOKIE_INDEX_MASK=0xffffffff
+RID_COOKIE=1 << 32
+PIN_COOKIE=2 << 32
+PROBE_COOKIE=3 << 32
+
+#Returns the cookie of a flow with the given type and index
+def createCookie(cookieType,index):
+    return cookieType | index
 
 #Create a flowmod objects ready to be sent to the datapath, the command is "add".
-def createFlow(dp,cookie,table,priority,match,inst):
+def createFlow(dp,cookie,table,priority,match,inst,flags=0,idleTimeout=0):
        ofproto=ofproto_v1_3
        return dp.ofproto_parser.OFPFlowMod(dp, cookie, 0, table,
-                                                     ofproto.OFPFC_ADD, 0, 0,
+                                                     ofproto.OFPFC_ADD, idleTimeout, 0,
                                                      priority,
                                                      ofproto.OFPCML_NO_BUFFER,
                                                      ofproto.OFPP_ANY,
-                                                     ofproto.OFPG_ANY, 0,
+                                                     ofproto.OFPG_ANY, flags,
                                                      match, inst)
 
-#Returns a string composed of 64 ones, used for masking the metadata
+#Create a flowmod object which strictly deletes the flow with the given match and priority from a table
+def createDeleteStrictFlow(dp,table,priority,match):
+       ofproto=ofproto_v1_3
+       return dp.ofproto_parser.OFPFlowMod(dp, 0, 0, table,
+                                                     ofproto.OFPFC_DELETE_STRICT, 0, 0,
+                                                     priority,
+                                                     ofproto.OFPCML_NO_BUFFER,
+                                                     ofproto.OFPP_ANY,
+                                                     ofproto.OFPG_ANY, 0,
+                                                     match, [])
+
+#Given the flows of a table before and after a change, as dictionaries from a flow's (match, priority) key to a (value, object) tuple where the value
+#is everything else the flow writes, returns the objects of the new flows which should be added and the keys of the old flows which should be deleted.
+#A flow whose key exists in both but with another value is added again, since adding a flow with the same match and priority replaces it.
+def diffRules(oldRules,newRules):
+    add=[]
+    for key in newRules:
+        if key not in oldRules or oldRules[key][0]!=newRules[key][0]:
+            add.append(newRules[key][1])
+    delete=[key for key in oldRules if key not in newRules]
+    return (add,delete)
+
+#Given a balancing table id (1-4) as used by the first bank, returns its id in the given bank
+def bankTable(table,bank):
+    return table+bank*BANK_SIZE
+
+#Returns an integer composed of 64 ones, used for masking the metadata
 def getMetaDataMask():
-    str=""
-    for i in range (0,64):
-        str+="1"
-    return Range.fromBinary(str)
+    return METADATA_MASK
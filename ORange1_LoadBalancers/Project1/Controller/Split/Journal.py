@@ -0,0 +1,73 @@
+import struct,time
+
+#This file contains the journal of the rebalance decisions, an append-only binary file which records every stats sample, the deltas and weights
+#computed from it and the flows a rebalance emitted, so the rebalance policy can be replayed offline against real traffic (see Tools/replay.py).
+#The file starts with a magic and is followed by records, each one a header (type, time, datapath id, number of values) and its values,
+#whose format depends on the type. The format is shared with MicDekLoad's journal, a record which was cut by a crash is ignored by the reader.
+
+MAGIC="ORJ1"
+HEADER=struct.Struct("!BdQH")
+
+CONFIG=1 #The policy constants of the controller, by the order of the controller's CONFIG_NAMES
+SAMPLE=2 #The packet counts of the servers, as read from the switch
+RANGES=3 #The (start, end) of the range of every server when the sample was read, flattened
+DELTAS=4 #The packets of every server in the last interval
+WEIGHTS=5 #The weights of the servers after the sample was handled
+DIFF=6 #The messages a rebalance emitted - flows added, flows deleted and groups modified
+MODES=7 #The modes of the controller which change its flows, by the order of the controller's CONFIG_MODES (see encodeModes)
+
+#The format of a single value of every record type
+FORMATS={CONFIG:"d",SAMPLE:"Q",RANGES:"I",DELTAS:"q",WEIGHTS:"d",DIFF:"I",MODES:"d"}
+
+class Journal(object):
+    def __init__(self,path):
+        self.path=path
+        self.file=open(path,"ab")
+        if self.file.tell()==0:
+            self.file.write(MAGIC)
+
+    #Appends a record, the values are written by the format of its type
+    def write(self,recordType,dpid,values,now=None):
+        now=time.time() if now is None else now
+        values=list(values)
+        self.file.write(HEADER.pack(recordType,now,dpid,len(values))+struct.pack("!%d%s" % (len(values),FORMATS[recordType]),*values))
+
+    #Makes all the records written so far reach the file, called once all the records of a sample were written
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+#Returns the (type, time, datapath id, values) records of a journal file, in the order they were written
+def readJournal(path):
+    with open(path,"rb") as f:
+        data=f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("%s is not a rebalance journal" % path)
+    records=[]
+    offset=len(MAGIC)
+    while offset+HEADER.size<=len(data):
+        (recordType,recordTime,dpid,count)=HEADER.unpack_from(data,offset)
+        body=struct.Struct("!%d%s" % (count,FORMATS[recordType]))
+        if offset+HEADER.size+body.size>len(data):
+            break
+        records.append((recordType,recordTime,dpid,list(body.unpack_from(data,offset+HEADER.size))))
+        offset+=HEADER.size+body.size
+    return records
+
+#Returns the values of a MODES record, given the (name, choices) of every mode. A mode is recorded as the index of its value among its choices,
+#or as its value if it has no choices.
+def encodeModes(obj,modes):
+    return [getattr(obj,name) if choices is None else list(choices).index(getattr(obj,name)) for (name,choices) in modes]
+
+#Returns the number of flows added, flows deleted and groups modified by the messages of a batch
+def getDiff(batch):
+    if batch is None:
+        return [0,0,0]
+    ofproto=batch.datapath.ofproto
+    parser=batch.datapath.ofproto_parser
+    flowMods=[msg for msg in batch.msgs if isinstance(msg,parser.OFPFlowMod)]
+    added=len([msg for msg in flowMods if msg.command in [ofproto.OFPFC_ADD,ofproto.OFPFC_MODIFY,ofproto.OFPFC_MODIFY_STRICT]])
+    groups=len([msg for msg in batch.msgs if isinstance(msg,parser.OFPGroupMod)])
+    return [added,len(flowMods)-added,groups]
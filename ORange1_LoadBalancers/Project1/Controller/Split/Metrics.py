@@ -0,0 +1,174 @@
+import threading,time
+from ryu.app.wsgi import ControllerBase,route
+from webob import Response
+from ryu.ofproto import ofproto_v1_3_parser
+
+#This file contains the metrics of the controller - counters, gauges and histograms of its hot paths, kept in a single registry.
+#They are read in-process through the registry, or as text from the /metrics page of Ryu's web server (in the Prometheus text format),
+#to tell when the controller rather than the switch becomes the bottleneck.
+#An instrument is identified by its name and labels, a dictionary given as keyword arguments, e.g. registry.counter("flow_mods_total",table=1).
+
+#Default bucket bounds of histograms of durations, in seconds
+TIME_BOUNDS=[0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10]
+#Default bucket bounds of histograms of counts
+COUNT_BOUNDS=[0,1,2,5,10,20,50,100,200,500,1000,2000,5000,10000]
+
+#A value which only grows
+class Counter(object):
+    kind="counter"
+
+    def __init__(self):
+        self.value=0
+
+    def inc(self,amount=1):
+        self.value+=amount
+
+    def samples(self):
+        return [("",{},self.value)]
+
+#A value which is set
+class Gauge(object):
+    kind="gauge"
+
+    def __init__(self):
+        self.value=0
+
+    def set(self,value):
+        self.value=value
+
+    def samples(self):
+        return [("",{},self.value)]
+
+#Counts observed values in buckets, each bucket counts the values up to its bound, and keeps their count and sum
+class Histogram(object):
+    kind="histogram"
+
+    def __init__(self,bounds):
+        self.bounds=list(bounds)
+        self.counts=[0]*len(self.bounds)
+        self.count=0
+        self.sum=0
+
+    def observe(self,value):
+        self.count+=1
+        self.sum+=value
+        for i in range(0,len(self.bounds)):
+            if value<=self.bounds[i]:
+                self.counts[i]+=1
+                break
+
+    #Returns the value below which the given share of the observed values are, by the bounds of the buckets
+    def quantile(self,share):
+        seen=0
+        for i in range(0,len(self.bounds)):
+            seen+=self.counts[i]
+            if seen>=share*self.count and seen>0:
+                return self.bounds[i]
+        return float("inf")
+
+    def samples(self):
+        res=[]
+        cumulative=0
+        for i in range(0,len(self.bounds)):
+            cumulative+=self.counts[i]
+            res.append(("_bucket",{"le":repr(self.bounds[i])},cumulative))
+        res.append(("_bucket",{"le":"+Inf"},self.count))
+        res.append(("_sum",{},self.sum))
+        res.append(("_count",{},self.count))
+        return res
+
+#Measures the time of the code inside a with statement into a histogram
+class Timer(object):
+    def __init__(self,histogram):
+        self.histogram=histogram
+
+    def __enter__(self):
+        self.start=time.time()
+        return self
+
+    def __exit__(self,excType,excValue,traceback):
+        self.elapsed=time.time()-self.start
+        self.histogram.observe(self.elapsed)
+        return False
+
+#All the instruments, by (name, labels)
+class Registry(object):
+    def __init__(self):
+        self.instruments={}
+        self.lock=threading.Lock()
+
+    #Returns the instrument of a name and labels, it is created by the factory if it does not exist yet
+    def get(self,factory,name,labels):
+        key=(name,tuple(sorted((k,str(v)) for (k,v) in labels.items())))
+        instrument=self.instruments.get(key)
+        if instrument is None:
+            with self.lock:
+                instrument=self.instruments.setdefault(key,factory())
+        return instrument
+
+    def counter(self,name,**labels):
+        return self.get(Counter,name,labels)
+
+    def gauge(self,name,**labels):
+        return self.get(Gauge,name,labels)
+
+    def histogram(self,name,bounds=TIME_BOUNDS,**labels):
+        return self.get(lambda: Histogram(bounds),name,labels)
+
+    #Returns a timer to be used in a with statement, the time is observed by the histogram of the name and labels
+    def timer(self,name,**labels):
+        return Timer(self.histogram(name,TIME_BOUNDS,**labels))
+
+    #Returns a dictionary from every (name, labels) to the value of its instrument, the count of the observed values for histograms
+    def snapshot(self):
+        res={}
+        for (key,instrument) in self.instruments.items():
+            if instrument.kind=="histogram":
+                res[key]=instrument.count
+            else:
+                res[key]=instrument.value
+        return res
+
+    #Returns the text of all the instruments in the Prometheus text format
+    def render(self):
+        lines=[]
+        typed=set()
+        for ((name,labels),instrument) in sorted(self.instruments.items()):
+            if name not in typed:
+                lines.append("# TYPE %s %s" % (name,instrument.kind))
+                typed.add(name)
+            for (suffix,extra,value) in instrument.samples():
+                allLabels=list(labels)+sorted(extra.items())
+                text=",".join('%s="%s"' % (k,v) for (k,v) in allLabels)
+                lines.append("%s%s%s %s" % (name,suffix,"{%s}" % text if text else "",value))
+        return "\n".join(lines)+"\n"
+
+#The registry of the controller
+registry=Registry()
+
+#Returns a decorator which measures every call of a function into the histogram of the name and labels
+def timed(name,**labels):
+    def decorator(function):
+        def wrapper(*args,**kwargs):
+            with registry.timer(name,**labels):
+                return function(*args,**kwargs)
+        wrapper.__name__=function.__name__
+        return wrapper
+    return decorator
+
+#Counts a message sent to a switch, flow mods are counted by their table and group mods by their group
+def countMessage(msg):
+    if isinstance(msg,ofproto_v1_3_parser.OFPFlowMod):
+        registry.counter("flow_mods_total",table=msg.table_id).inc()
+    elif isinstance(msg,ofproto_v1_3_parser.OFPGroupMod):
+        registry.counter("group_mods_total",group=msg.group_id).inc()
+
+#Serves the text of the registry, registered with Ryu's web server by LoadBalancingSwitch
+class MetricsController(ControllerBase):
+    def __init__(self, req, link, data, **config):
+        super(MetricsController, self).__init__(req, link, data, **config)
+        self.registry=data
+
+    @route("metrics","/metrics",methods=["GET"])
+    def metrics(self, req, **kwargs):
+        return Response(content_type="text/plain",body=self.registry.render())
@@ -0,0 +1,80 @@
+import Flow,Range,Batch,CompareTable,RidsTable,Metrics
+from ryu.ofproto import ofproto_v1_3
+
+#This file contains all the logic for the prefix compilation of the ranges, an alternative to the ELCP tables (1-4).
+#Every range is split into the minimal set of CIDR prefixes which covers it, and each prefix gets a flow in the first balancing table
+#which sends the packet straight to the range's server. A packet is balanced by a single lookup instead of up to four, at the price
+#of more flows, up to 2*32 for a range instead of 3. The prefixes of the ranges do not overlap.
+
+#Number of tables a packet goes through in the worst case, including the first table
+ELCP_DEPTH=5
+PREFIX_DEPTH=2
+
+#Creates a flow for the table, one for each prefix of a range. The cookie is the one of the range's RIDs flow, so the stats of a range
+#are the sum of its prefixes, and the counters are reset when a flow is replaced since they belong to the former range.
+#A longer prefix gets a higher priority, which only matters while a rebalance replaces the flows of neighbouring ranges.
+def createPrefixFlow(prefix, flowRange, index, datapath, servers, numOfClients, bank=0):
+    ofproto=ofproto_v1_3
+    parser = datapath.ofproto_parser
+    match = parser.OFPMatch(eth_type=0x800,ipv4_src=prefix)
+    actions = RidsTable.createServerActions(index, servers)
+    inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,actions)]
+    return Flow.createFlow(datapath,Flow.createCookie(Flow.RID_COOKIE,index),Flow.bankTable(1,bank),getPriority(prefix),match,inst,
+                           ofproto.OFPFF_RESET_COUNTS)
+
+#Returns the priority of the flow of a prefix, given as an (ip,mask) tupple
+def getPriority(prefix):
+    return 1+bin(Range.IP2Int(prefix[1])).count("1")
+
+#Install all flows in table
+@Metrics.timed("prepare_table_seconds",table="prefix")
+def preparePrefixTable(dp,ranges,servers,numOfClients,batch=None,bank=0):
+    for i in range(0, len(ranges)):
+        for prefix in ranges[i].getPrefixes():
+            Batch.send(dp,createPrefixFlow(prefix, ranges[i], i, dp, servers, numOfClients, bank),batch)
+
+#Returns the flows of the table for a list of ranges, as a dictionary from the flow's (prefix, priority) to a (written values, (prefix, index)) tupple.
+#The bounds of the range are part of the values, so all the flows of a range which changed are replaced and their counters start together.
+def getRangeRules(ranges,servers,numOfClients):
+    rules={}
+    for i in range(0, len(ranges)):
+        value=(ranges[i].start,ranges[i].end,servers[i][1],servers[i][2],RidsTable.getServerPort(i,servers))
+        for prefix in ranges[i].getPrefixes():
+            rules[(prefix,getPriority(prefix))]=(value,(prefix,i))
+    return rules
+
+#Returns the flows needed to move the table from the old ranges to the new ones, as a tuple of (flows to add, flows to delete).
+#Flows of ranges which did not change are not returned. The old ranges were sent to the old servers, the same servers unless given.
+def getUpdateFlows(dp,oldRanges,newRanges,servers,numOfClients,bank=0,oldServers=None):
+    oldServers=servers if oldServers is None else oldServers
+    (add,delete)=Flow.diffRules(getRangeRules(oldRanges,oldServers,numOfClients),getRangeRules(newRanges,servers,numOfClients))
+    addFlows=[createPrefixFlow(prefix,newRanges[i],i,dp,servers,numOfClients,bank) for (prefix,i) in add]
+    deleteFlows=[Flow.createDeleteStrictFlow(dp,Flow.bankTable(1,bank),priority,dp.ofproto_parser.OFPMatch(eth_type=0x800,ipv4_src=prefix))
+                    for (prefix,priority) in delete]
+    return (addFlows,deleteFlows)
+
+#----------------------------Cost model---------------------------------
+
+#Returns the number of balancing flows of the prefix compilation
+def getNumOfPrefixRules(ranges):
+    return sum(len(Range.rangeToPrefixes(r.start,r.end)) for r in ranges)
+
+#Returns the number of balancing flows of the ELCP compilation, a flow in each of the ELCP and RIDs tables for every range,
+#the miss flow of the first ELCP table and the compare table
+def getNumOfELCPRules(ranges):
+    return 3*len(ranges)+1+len(CompareTable.COMPARE_RULES)
+
+#Returns the cost of a compilation, its flows plus its pipeline depth where every table lookup costs as much as lookupCost flows
+def getCost(numOfRules,depth,lookupCost):
+    return numOfRules+depth*lookupCost
+
+#Returns the cheaper compilation of the ranges, "prefix" or "elcp". If the current compilation is given, it is kept unless the other one is cheaper by
+#the margin, a fraction of its cost.
+def chooseCompilation(ranges,lookupCost,current=None,margin=0):
+    costs={"prefix":getCost(getNumOfPrefixRules(ranges),PREFIX_DEPTH,lookupCost),"elcp":getCost(getNumOfELCPRules(ranges),ELCP_DEPTH,lookupCost)}
+    if current in costs:
+        other="elcp" if current=="prefix" else "prefix"
+        return other if costs[other]*(1+margin)<costs[current] else current
+    if costs["prefix"]<=costs["elcp"]:
+        return "prefix"
+    return "elcp"
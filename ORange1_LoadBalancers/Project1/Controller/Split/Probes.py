@@ -0,0 +1,62 @@
+import Flow,Range,RidsTable
+from ryu.ofproto import ofproto_v1_3
+
+#This file contains the logic for finding the hot parts of overloaded ranges.
+#The per range counters only tell how much traffic a range has, not where in the range it comes from. To find out, an overloaded range is
+#covered by a few temporary probe flows in the first balancing table, one for each sub-prefix of the range, above the range flows and below the pins.
+#A probe sends its packets to the range's server like the range flows do, so it changes nothing but counting. The packets it matches are not
+#counted by the flows of the range, so the controller adds the counts of the probes to the count of their range while they are installed.
+#The counts of the probes tell how the traffic is spread inside the range, so a rebalance can move the boundaries by traffic instead of by addresses.
+
+#Priority of probe flows, above the flows of the ranges and below the pins
+PROBE_PRIORITY=500
+
+#Returns a list of (value,prefix length) sub-prefixes which cover the range, at least numOfProbes of them when the range is large enough.
+#The minimal cover of the range is split by halving its largest prefix until there are enough.
+def getProbePrefixes(flowRange,numOfProbes):
+    prefixes=Range.rangeToPrefixes(flowRange.start,flowRange.end)
+    while len(prefixes)<numOfProbes:
+        (value,prefixLen)=min(prefixes,key=lambda prefix: prefix[1])
+        if prefixLen==Range.IP_BITS:
+            break
+        index=prefixes.index((value,prefixLen))
+        half=1 << (Range.IP_BITS-prefixLen-1)
+        prefixes[index:index+1]=[(value,prefixLen+1),(value+half,prefixLen+1)]
+    return prefixes
+
+#Creates the probe flow of a sub-prefix of a range, its cookie holds the probe's index
+def createProbeFlow(prefix,probeIndex,flowRange,index,datapath,servers,numOfClients,bank=0):
+    ofproto=ofproto_v1_3
+    parser=datapath.ofproto_parser
+    (value,prefixLen)=prefix
+    match=parser.OFPMatch(eth_type=0x800,ipv4_src=(Range.Int2IP(value),Range.cidrToMask(prefixLen)))
+    actions=RidsTable.createServerActions(index,servers)
+    inst=[parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,actions)]
+    return Flow.createFlow(datapath,Flow.createCookie(Flow.PROBE_COOKIE,probeIndex),Flow.bankTable(1,bank),PROBE_PRIORITY,match,inst)
+
+#Creates a flow which deletes all the probe flows of a bank
+def createDeleteProbesFlow(datapath,bank=0):
+    ofproto=ofproto_v1_3
+    return datapath.ofproto_parser.OFPFlowMod(datapath, Flow.PROBE_COOKIE, Flow.COOKIE_TYPE_MASK, Flow.bankTable(1,bank),
+                                              ofproto.OFPFC_DELETE, 0, 0, 0,
+                                              ofproto.OFPCML_NO_BUFFER,
+                                              ofproto.OFPP_ANY,
+                                              ofproto.OFPG_ANY, 0,
+                                              datapath.ofproto_parser.OFPMatch(), [])
+
+#Returns the address where the traffic counted from the start of the segments reaches the given amount. The segments are (start,end,packets)
+#tupples which follow each other, the packets of a segment are considered spread evenly over its addresses.
+def addressAtTraffic(segments,traffic):
+    for (start,end,packets) in segments:
+        if packets>=traffic:
+            return start+int(round((end-start+1)*float(traffic)/packets)) if packets>0 else start
+        traffic-=packets
+    return segments[-1][1]+1
+
+#Returns how many addresses a range should give away from its start and from its end, so that it sheds the given traffic from each side.
+#The segments are the probe counts of the range, they cover it in order.
+def getShedAddresses(segments,downTraffic,upTraffic):
+    total=sum(packets for (start,end,packets) in segments)
+    newStart=addressAtTraffic(segments,downTraffic)
+    newEnd=max(newStart,addressAtTraffic(segments,total-upTraffic)-1)
+    return (newStart-segments[0][0],segments[-1][1]-newEnd)
@@ -1,86 +1,138 @@
-import math,socket,struct
+import socket,struct
+
+#Number of bits in an IPv4 address, all binary strings of the module are of this length
+IP_BITS=32
+IP_MASK=0xffffffff
 
 #A class which represents a range of ip addresses
+#Start and end are held as integers and the ELCPs are derived from them with bitwise arithmetic,
+#so a range costs a handful of integer operations instead of walking binary strings
 
-class Range:
+class Range(object):
+    __slots__=('ID','start','end','prefixLen')
     idGen=0
     def __init__(self,start,end):
-        self.ID="%d" % Range.idGen
-        self.start=toBinary(start)
-        self.end=toBinary(end)
-        self.oneELCP=getOneELCP(self.start, self.end)
-        self.zeroELCP=getZeroELCP(self.start, self.end)
+        self.ID=Range.idGen
+        self.start=int(start)
+        self.end=int(end)
+        self.prefixLen=commonPrefixLength(self.start,self.end)
         Range.idGen+=1
-    
+
     #String representation of this range
     def __str__(self):
-        return "ID: {0}\nStart: {1}, {2}\nEnd: {3}, {4}\nOneELCP: {5}\nZeroELCP: {6}".format(self.ID,Int2IP(fromBinary(self.start)),fromBinary(self.start),
-                Int2IP(fromBinary(self.end)),fromBinary(self.end),self.oneELCP, self.zeroELCP)
+        return "ID: {0}\nStart: {1}, {2}\nEnd: {3}, {4}\nOneELCP: {5}\nZeroELCP: {6}".format(self.ID,Int2IP(self.start),self.start,
+                Int2IP(self.end),self.end,self.oneELCP, self.zeroELCP)
 
     #Given an ip string address, returns true iff ip is in this range
     def isIPAdressInRange(self,ip):
         ip=IP2Int(ip)
-        return ip>=fromBinary(self.start) and ip<=fromBinary(self.end)
- 
+        return ip>=self.start and ip<=self.end
+
+    #The one Elcp as a binary pattern string, kept for debugging and printing
+    @property
+    def oneELCP(self):
+        return elcpPattern(self.getOneELCPInt(),self.prefixLen)
+
+    #The zero Elcp as a binary pattern string, kept for debugging and printing
+    @property
+    def zeroELCP(self):
+        return elcpPattern(self.getZeroELCPInt(),self.prefixLen)
+
+    #Returns the integer value of this range one Elcp (stars are zeros)
+    def getOneELCPInt(self):
+        if self.prefixLen==IP_BITS:
+            return self.start
+        return prefixOf(self.start,self.prefixLen) | (1 << (IP_BITS-1-self.prefixLen))
+
+    #Returns the integer value of this range zero Elcp (stars are zeros)
+    def getZeroELCPInt(self):
+        if self.prefixLen==IP_BITS:
+            return self.start
+        return prefixOf(self.start,self.prefixLen)
+
+    #Returns the number of stars (wildcard bits) in both Elcps of this range
+    def getELCPStars(self):
+        if self.prefixLen==IP_BITS:
+            return 0
+        return IP_BITS-1-self.prefixLen
+
+    #Returns the metadata written for this range, the range id in the upper half and the range's end in the lower half
+    def getMetadata(self):
+        return (int(self.ID) << IP_BITS) | self.end
+
     #Returns a tupple of (ip,mask) representing this range one Elcp
     def getOneELCP(self):
-        return getELCPTupple(self.oneELCP)
+        return (Int2IP(self.getOneELCPInt()),cidrToMask(IP_BITS-self.getELCPStars()))
 
     #Returns a tupple of (ip,mask) representing this range zero Elcp
     def getZeroELCP(self):
-        return getELCPTupple(self.zeroELCP)
+        return (Int2IP(self.getZeroELCPInt()),cidrToMask(IP_BITS-self.getELCPStars()))
+
+    #Returns a list of (ip,mask) tupples of the minimal set of CIDR prefixes which covers exactly this range
+    def getPrefixes(self):
+        return [(Int2IP(value),cidrToMask(prefixLen)) for (value,prefixLen) in rangeToPrefixes(self.start,self.end)]
+
+#Returns the length of the longest common prefix of two 32 bit integers
+def commonPrefixLength(x,y):
+    return IP_BITS-((x ^ y) & IP_MASK).bit_length()
+
+#Returns the first prefixLen bits of x, the rest are zeroed
+def prefixOf(x,prefixLen):
+    return x & maskOf(prefixLen)
+
+#Returns the integer mask of a prefix length
+def maskOf(prefixLen):
+    return (IP_MASK << (IP_BITS-prefixLen)) & IP_MASK
+
+#Returns the minimal list of (value,prefix length) CIDR prefixes which covers exactly the addresses from start to end.
+#Each prefix is the largest aligned block which starts at the first uncovered address and does not pass the end.
+def rangeToPrefixes(start,end):
+    prefixes=[]
+    while start<=end:
+        size=(start & -start) if start else 1 << IP_BITS
+        while size>end-start+1:
+            size>>=1
+        prefixes.append((start,IP_BITS-(size.bit_length()-1)))
+        start+=size
+    return prefixes
+
+#Returns the pattern string of an Elcp, the bits after the Elcp are stars
+def elcpPattern(value,prefixLen):
+    bits=toBinary(value)
+    if prefixLen==IP_BITS:
+        return bits
+    return bits[:prefixLen+1]+"*"*(IP_BITS-1-prefixLen)
 
 #Given a string, returns # of stars it contains
 def starsInString(s):
-    count=0
-    for i in range(0,len(s)):
-        if (s[i]=='*'):
-            break
-        else:
-            count+=1
-    return len(s)-count
+    index=s.find('*')
+    if index==-1:
+        return 0
+    return len(s)-index
 
 #Given an IP string, converts and returns the integer value of this address
 def IP2Int(ip):
-    o = map(int, ip.split('.'))
-    res = (16777216 * o[0]) + (65536 * o[1]) + (256 * o[2]) + o[3]
-    return res
+    return struct.unpack(">I",socket.inet_aton(ip))[0]
 
 #Given an integer representation of an IP address, converts and returns the IP address as a string
 def Int2IP(ipnum):
-    o1 = int(ipnum / 16777216) % 256
-    o2 = int(ipnum / 65536) % 256
-    o3 = int(ipnum / 256) % 256
-    o4 = int(ipnum) % 256
-    return '%(o1)s.%(o2)s.%(o3)s.%(o4)s' % locals()
+    return socket.inet_ntoa(struct.pack(">I",int(ipnum) & IP_MASK))
 
 
-#Given an integer, returns the binary string representation of it     
+#Given an integer, returns the binary string representation of it
 def toBinary(x):
-    res = ""
-    while (x != 0):
-        res = ("%d" % (x % 2)) + res
-        x = math.floor(x/ 2)
-    for i in range(0,32-len(res)):
-        res="0"+res
-    return res
-
-#Given a binary string , returns the integer value of it  
+    return format(int(x),'032b')
+
+#Given a binary string , returns the integer value of it
 def fromBinary(binStr):
     return int(binStr,2)
 
 #Returns a string representing the Elcp using start and end of range
 def getELCP(x,y,ruleType):
-    res = ""
-    for i in range(0,len(x)):
-        if (x[i]==y[i]):
-            res+=x[i]
-        else:
-            res+=ruleType
-            for j in range(0,len(x)-(i+1)):
-                res+="*"
-            break
-    return res
+    prefixLen=commonPrefixLength(fromBinary(x),fromBinary(y))
+    if prefixLen>=len(x):
+        return x
+    return x[:prefixLen]+ruleType+"*"*(len(x)-(prefixLen+1))
 
 def getZeroELCP(x,y):
     return getELCP(x,y,"0")
@@ -94,4 +146,4 @@ def getELCPTupple(elcp):
 
 #Converts the convential cidr number to an IP mask string
 def cidrToMask(prefix):
-    return socket.inet_ntoa(struct.pack(">I", (0xffffffff << (32 - prefix)) & 0xffffffff))
+    return Int2IP(maskOf(prefix))
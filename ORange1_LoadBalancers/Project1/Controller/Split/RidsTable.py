@@ -1,22 +1,60 @@
-import Flow,Range
-from ryu.ofproto import ofproto_v1_3
+import Flow,Batch,Metrics
+from ryu.ofproto import ofproto_v1_3,ofproto_v1_3_parser
 
 #This file contains all the logic for populating the last table, used for the balancing of traffic
 
 #Creates a flow for the table, one for each range
-def createFourthTableFlow(flowRange, index, datapath,servers,numOfClients):
+def createFourthTableFlow(flowRange, index, datapath,servers,numOfClients,bank=0):
     ofproto=ofproto_v1_3
     parser = datapath.ofproto_parser
-    match = datapath.ofproto_parser.OFPMatch(eth_type=0x800,metadata=Range.fromBinary(Range.toBinary(int(flowRange.ID)) + flowRange.end))
+    match = datapath.ofproto_parser.OFPMatch(eth_type=0x800,metadata=flowRange.getMetadata())
     #If a match is found, send the packet to the server which is assigned to the matched range
-    actions = [datapath.ofproto_parser.OFPActionSetField(ipv4_dst= servers[index][1]),
-                   datapath.ofproto_parser.OFPActionSetField(eth_dst= servers[index][2]),
-                   datapath.ofproto_parser.OFPActionOutput(int(flowRange.ID )+ 1 +numOfClients)]
+    actions = createServerActions(index, servers)
     apply = parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,actions)
     inst = [apply]
-    return Flow.createFlow(datapath,index,4,100-index,match,inst)
+    return Flow.createFlow(datapath,Flow.createCookie(Flow.RID_COOKIE,index),Flow.bankTable(4,bank),getPriority(index),match,inst)
+
+#Returns the actions which send a packet to the server at the index
+def createServerActions(index, servers):
+    parser=ofproto_v1_3_parser
+    return [parser.OFPActionSetField(ipv4_dst= servers[index][1]),
+               parser.OFPActionSetField(eth_dst= servers[index][2]),
+               parser.OFPActionOutput(getServerPort(index,servers))]
+
+#Returns the switch port of the server of a range, the servers are (port, ip, mac) tupples
+def getServerPort(index, servers):
+    return servers[index][0]
+
+#Returns the priority of the flow of a range, the flows match exact metadata so the priority only has to be valid (not negative) for any number of ranges
+def getPriority(index):
+    return max(1,100-index)
         
 #Install all flows in table    
-def prepareRIDTable(dp,ranges,servers,numOfClients):
+@Metrics.timed("prepare_table_seconds",table="rids")
+def prepareRIDTable(dp,ranges,servers,numOfClients,batch=None,bank=0):
     for i in range(0, len(ranges)):
-        dp.send_msg(createFourthTableFlow(ranges[i], i, dp,servers,numOfClients))
+        Batch.send(dp,createFourthTableFlow(ranges[i], i, dp,servers,numOfClients,bank),batch)
+
+#Returns a dictionary from the cookie of each flow in the table to the index of its range
+def getCookieMap(numOfRanges):
+    cookies={}
+    for i in range(0,numOfRanges):
+        cookies[Flow.createCookie(Flow.RID_COOKIE,i)]=i
+    return cookies
+
+#Returns the flows of the table for a list of ranges, as a dictionary from the flow's (metadata, priority) to a (written values, index) tuple
+def getRangeRules(ranges,servers,numOfClients):
+    rules={}
+    for i in range(0, len(ranges)):
+        rules[(ranges[i].getMetadata(),getPriority(i))]=((servers[i][1],servers[i][2],getServerPort(i,servers)),i)
+    return rules
+
+#Returns the flows needed to move the table from the old ranges to the new ones, as a tuple of (flows to add, flows to delete).
+#Flows of ranges which did not change are not returned. The old ranges were sent to the old servers, the same servers unless given.
+def getUpdateFlows(dp,oldRanges,newRanges,servers,numOfClients,bank=0,oldServers=None):
+    oldServers=servers if oldServers is None else oldServers
+    (add,delete)=Flow.diffRules(getRangeRules(oldRanges,oldServers,numOfClients),getRangeRules(newRanges,servers,numOfClients))
+    addFlows=[createFourthTableFlow(newRanges[i],i,dp,servers,numOfClients,bank) for i in add]
+    deleteFlows=[Flow.createDeleteStrictFlow(dp,Flow.bankTable(4,bank),priority,dp.ofproto_parser.OFPMatch(eth_type=0x800,metadata=metadata))
+                    for (metadata,priority) in delete]
+    return (addFlows,deleteFlows)
@@ -0,0 +1,70 @@
+import Flow,Batch,RidsTable,Metrics
+from ryu.ofproto import ofproto_v1_3
+
+#This file contains the logic for offloading the balancing to a single OpenFlow select group, instead of the range tables.
+#The group has a bucket for every server, weighted by the server's weight, and the switch picks a bucket for every flow by hashing it in the datapath.
+#Every bucket gets a weight of at least 1, so the bucket of a failed or drained server is sent to a server in rotation instead (see BalancedSwitch.getGroupServers).
+#The first balancing table only holds a flow which sends all the traffic to the group, so a rebalance is a single group modification.
+#The counters of the buckets are the packet counts of the servers.
+
+#Id of the balancing group
+GROUP_ID=1
+#Weight of the bucket of the heaviest server, bucket weights are 16 bit integers so the weights are scaled to it
+MAX_BUCKET_WEIGHT=1000
+
+#Given the group features of a switch (the body of a group features reply), returns true iff it supports weighted select groups
+def supportsSelect(features):
+    ofproto=ofproto_v1_3
+    return (features.types & (1 << ofproto.OFPGT_SELECT)!=0 and features.capabilities & ofproto.OFPGFC_SELECT_WEIGHT!=0
+            and features.max_groups[ofproto.OFPGT_SELECT]>0)
+
+#Creates a request for the group features of a switch
+def createFeaturesRequest(datapath):
+    return datapath.ofproto_parser.OFPGroupFeaturesStatsRequest(datapath,0)
+
+#Returns the bucket weights of the servers' weights, the heaviest server gets the maximal weight and every server gets at least 1
+def getBucketWeights(weights):
+    heaviest=max(weights)
+    return [max(1,int(round(MAX_BUCKET_WEIGHT*weight/float(heaviest)))) for weight in weights]
+
+#Creates a bucket for every server, which sends a packet to the server like the flows of its range do
+def createBuckets(datapath,ranges,servers,weights,numOfClients):
+    ofproto=ofproto_v1_3
+    parser=datapath.ofproto_parser
+    buckets=[]
+    bucketWeights=getBucketWeights(weights)
+    for i in range(0,len(ranges)):
+        actions=RidsTable.createServerActions(i,servers)
+        buckets.append(parser.OFPBucket(bucketWeights[i],ofproto.OFPP_ANY,ofproto.OFPG_ANY,actions))
+    return buckets
+
+#Creates the group mod which adds the group (or modifies it, given OFPGC_MODIFY) with a bucket for every server
+def createGroupMod(datapath,ranges,servers,weights,numOfClients,command=ofproto_v1_3.OFPGC_ADD):
+    ofproto=ofproto_v1_3
+    buckets=createBuckets(datapath,ranges,servers,weights,numOfClients)
+    return datapath.ofproto_parser.OFPGroupMod(datapath,command,ofproto.OFPGT_SELECT,GROUP_ID,buckets)
+
+#Creates the flow of the first balancing table, which sends all the traffic to the group
+def createGroupFlow(datapath,bank=0):
+    ofproto=ofproto_v1_3
+    parser=datapath.ofproto_parser
+    match=parser.OFPMatch(eth_type=0x800)
+    inst=[parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,[parser.OFPActionGroup(GROUP_ID)])]
+    return Flow.createFlow(datapath,0,Flow.bankTable(1,bank),1,match,inst)
+
+#Installs the group and the flow which uses it, the group is added first since a flow may only point to an existing group
+@Metrics.timed("prepare_table_seconds",table="group")
+def prepareGroup(dp,ranges,servers,weights,numOfClients,batch=None,bank=0):
+    Batch.send(dp,createGroupMod(dp,ranges,servers,weights,numOfClients),batch)
+    Batch.send(dp,createGroupFlow(dp,bank),batch)
+
+#Creates a request for the counters of the group's buckets
+def createStatsRequest(datapath):
+    return datapath.ofproto_parser.OFPGroupStatsRequest(datapath,0,GROUP_ID)
+
+#Given the body of a group stats reply, returns the packet count of every bucket, or None if the group is not in it
+def getPacketCounts(body):
+    for stat in body:
+        if stat.group_id==GROUP_ID:
+            return [bucket.packet_count for bucket in stat.bucket_stats]
+    return None
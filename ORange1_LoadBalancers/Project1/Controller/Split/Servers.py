@@ -0,0 +1,148 @@
+import json
+from ryu.app.wsgi import ControllerBase,route
+from webob import Response
+
+#This file contains the runtime changes of the servers - adding, draining, removing and reweighting a server - and the REST interface which
+#serves them through Ryu's web server:
+#   GET    /servers              - the servers of every balanced switch
+#   POST   /servers              - adds a server, {"port": ..., "ip": ..., "mac": ..., "weight": ...}
+#   PUT    /servers/{ip}         - sets the weight of a server and undrains it, {"weight": ...}
+#   POST   /servers/{ip}/drain   - stops sending new clients to a server
+#   DELETE /servers/{ip}         - removes a server
+#A change applies to every balanced switch, or only to the one whose id is given as "dpid" in the body or the query.
+#The interface has no authentication, so it is served only on LoadBalancingSwitch.apiHost, the loopback address unless set otherwise.
+#Every change moves only the boundaries next to the server, so only the flows of these ranges are sent. The flows of a range are found by its
+#index, so a removed server keeps a placeholder range which is sent to its standby (see Failover) and the next added server takes its place,
+#instead of moving the index of every range after it.
+
+#Given the bounds of the ranges in order, returns the bounds with a new range at the index, of about size addresses which are taken from the ranges
+#around it, half from each. Every one of them keeps at least half of its addresses.
+def insertRange(bounds,index,size):
+    bounds=[(int(start),int(end)) for (start,end) in bounds]
+    sides=[j for j in [index-1,index] if 0<=j<len(bounds)]
+    takes={}
+    need=size
+    for j in sides:
+        #The range before gives half, and the range after gives the rest
+        share=need/2 if j<index and len(sides)>1 else need
+        takes[j]=max(0,min(share,(bounds[j][1]-bounds[j][0]+1)/2))
+        need-=takes[j]
+    if sum(takes.values())<1:
+        raise ValueError("There is no room for a new range at index %d" % index)
+    bounds=[list(b) for b in bounds]
+    if index-1 in takes:
+        start=bounds[index-1][1]-takes[index-1]+1
+        bounds[index-1][1]=start-1
+    else:
+        start=bounds[index][0]
+    end=start+sum(takes.values())-1
+    if index in takes:
+        bounds[index][0]=end+1
+    bounds.insert(index,[start,end])
+    return [tuple(b) for b in bounds]
+
+#Given the bounds of the ranges in order, returns the bounds where the range at the index grows or shrinks to about size addresses, by moving its
+#boundaries with the ranges around it, half on each side. A range which addresses are taken from keeps at least half of them.
+def resizeRange(bounds,index,size):
+    bounds=[[int(start),int(end)] for (start,end) in bounds]
+    sides=[j for j in [index-1,index+1] if 0<=j<len(bounds)]
+    change=size-(bounds[index][1]-bounds[index][0]+1)
+    for j in sides:
+        share=change/2 if j<index and len(sides)>1 else change
+        if share>0:
+            amount=min(share,(bounds[j][1]-bounds[j][0]+1)/2)
+        else:
+            amount=max(share,1-(bounds[index][1]-bounds[index][0]+1))
+        if j<index:
+            bounds[j][1]-=amount
+            bounds[index][0]-=amount
+        else:
+            bounds[j][0]+=amount
+            bounds[index][1]+=amount
+        change-=amount
+    return [tuple(b) for b in bounds]
+
+def jsonResponse(value,status=200):
+    return Response(status=status,content_type="application/json",body=json.dumps(value))
+
+def errorResponse(message,status=400):
+    return jsonResponse({"error":message},status)
+
+#Serves the server changes of the switches of a LoadBalancingSwitch, registered with Ryu's web server by it
+class ServerController(ControllerBase):
+    def __init__(self, req, link, data, **config):
+        super(ServerController, self).__init__(req, link, data, **config)
+        self.app=data
+
+    #Returns the body of a request as a dictionary
+    def readBody(self, req):
+        try:
+            body=json.loads(req.body) if req.body else {}
+        except ValueError:
+            raise ValueError("The body is not valid JSON")
+        if not isinstance(body,dict):
+            raise ValueError("The body should be a JSON object")
+        return body
+
+    #Returns the balanced switches a request applies to, all of them unless a dpid is given in the body or the query
+    def getSwitches(self, req, body):
+        dpid=body.get("dpid",req.GET.get("dpid"))
+        switches=[switch for switch in self.app.switches.values() if switch.areFlowsSet]
+        if dpid is not None:
+            switches=[switch for switch in switches if switch.id==int(dpid)]
+        if not switches:
+            raise ValueError("There is no balanced switch to change")
+        return switches
+
+    #Applies a change to the server of the ip on every switch of the request which has it, the change is called with the switch and the server's index
+    def change(self, req, ip, action, body=None):
+        try:
+            body=body if body is not None else self.readBody(req)
+            switches=[(switch,switch.getServerIndex(ip)) for switch in self.getSwitches(req,body)]
+            switches=[(switch,index) for (switch,index) in switches if index is not None]
+            if not switches:
+                return errorResponse("There is no server %s" % ip,404)
+            for (switch,index) in switches:
+                action(switch,index)
+        except (ValueError,TypeError) as e:
+            return errorResponse(str(e))
+        return jsonResponse([server for (switch,index) in switches for server in switch.describeServers() if server["ip"]==ip])
+
+    @route("servers","/servers",methods=["GET"])
+    def listServers(self, req, **kwargs):
+        return jsonResponse([server for switch in self.app.switches.values() if switch.areFlowsSet for server in switch.describeServers()])
+
+    @route("servers","/servers",methods=["POST"])
+    def addServer(self, req, **kwargs):
+        try:
+            body=self.readBody(req)
+            if "port" not in body or "ip" not in body or "mac" not in body:
+                raise ValueError("A server needs a port, an ip and a mac")
+            server=(int(body["port"]),str(body["ip"]),str(body["mac"]))
+            weight=float(body.get("weight",1))
+            switches=self.getSwitches(req,body)
+            for switch in switches:
+                switch.addServer(switch.datapath,server,weight)
+        except (ValueError,TypeError) as e:
+            return errorResponse(str(e))
+        return jsonResponse([s for switch in switches for s in switch.describeServers() if s["ip"]==server[1]],201)
+
+    @route("servers","/servers/{ip}",methods=["PUT"])
+    def setWeight(self, req, ip, **kwargs):
+        try:
+            body=self.readBody(req)
+            weight=float(body["weight"])
+        except (ValueError,TypeError,KeyError):
+            return errorResponse("The body should hold the new weight")
+        return self.change(req,ip,lambda switch,index: switch.setServerWeight(switch.datapath,index,weight),body)
+
+    @route("servers","/servers/{ip}/drain",methods=["POST"])
+    def drain(self, req, ip, **kwargs):
+        return self.change(req,ip,lambda switch,index: switch.drainServer(switch.datapath,index))
+
+    @route("servers","/servers/{ip}",methods=["DELETE"])
+    def remove(self, req, ip, **kwargs):
+        response=self.change(req,ip,lambda switch,index: switch.removeServer(switch.datapath,index))
+        if response.status_int==200:
+            return jsonResponse({"removed":ip})
+        return response
@@ -1,54 +1,292 @@
-import array,math
+import math
 
 from ryu.base import app_manager
 from ryu.controller import ofp_event
-from ryu.controller.handler import MAIN_DISPATCHER
+from ryu.controller.handler import MAIN_DISPATCHER,DEAD_DISPATCHER
 from ryu.controller.handler import set_ev_cls
+from ryu import cfg
+from ryu.app.wsgi import WSGIApplication,DEFAULT_WSGI_HOST
+from ryu.lib import hub
 from ryu.ofproto import ofproto_v1_3
-from ryu.lib.packet import packet
-from ryu.lib.packet import ipv4,arp,ethernet
-import Range,stats,CompareTable,ClientsTable,Elcp1Table,Elcp0Table,RidsTable
+import Range,stats,Batch,Flow,CompareTable,ClientsTable,Elcp1Table,Elcp0Table,RidsTable,PrefixTable,Affinity,Probes,ClientDistribution,FastPath,SelectGroup,Metrics,Journal,Failover,Servers
 
-#A class for a controller designed to balance traffic between a fixed number of servers
+#The policy constants recorded at the start of the rebalance journal, in this order
+CONFIG_NAMES=["statsInterval","minAveragePackets","overloadFactor"]
+#The modes recorded after the constants, as (name, choices) tupples, since they change the flows of every rebalance. Modes without choices are
+#recorded by their value.
+CONFIG_MODES=[("compilationMode",["elcp","prefix","auto","group"]),("rebalanceMode",["clear","shadow","incremental"]),("affinityMode",[False,True]),
+              ("heavyHitterMode",[False,True]),("lookupCost",None),("recompileMargin",None),("numOfProbes",None)]
+
+#A class for a controller designed to balance traffic between a fixed number of servers, on any number of switches.
+#The controller only dispatches the events of a switch to its BalancedSwitch, which holds all of the switch's state.
+#The metrics of the controller (see Metrics) are served as text by Ryu's web server at /metrics.
 
 class LoadBalancingSwitch(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+    _CONTEXTS = {'wsgi': WSGIApplication}
     numOfClients=10 #number of hosts used as clients
+    #How a rebalance replaces the range flows:
+    #"clear" - clears the balancing tables and adds the new flows, traffic is lost until all flows are added
+    #"shadow" - writes the new flows into the other bank of balancing tables and switches to it at once when the switch applied all of them
+    #"incremental" - only adds, replaces and deletes the flows of ranges whose boundaries moved
+    rebalanceMode="incremental"
+    statsInterval=15 #seconds between stats requests
+    statsJitter=1 #maximal random change of the interval, in seconds, so requests of many switches are spread
+    minAveragePackets=10 #servers are not rebalanced while their average packet count is not above this
+    overloadFactor=1.5 #a server whose packet count is more than this many times the average is overloaded
+    #Path of the rebalance journal (see Journal), every stats sample and the decision taken by it are appended to it. None for no journal.
+    journalPath=None
+    #How the ranges are compiled into flows:
+    #"elcp" - the ELCP tables and the compare table, about 3 flows for a range but up to 5 table lookups for a packet
+    #"prefix" - the minimal CIDR prefixes of every range in a single table, more flows but 2 table lookups for a packet
+    #"auto" - the cheaper of the two for the ranges, by the cost model of PrefixTable. It is chosen again on every rebalance, since ranges which
+    #moved are no longer aligned and have more prefixes, and the other compilation is written into the inactive bank when it became cheaper.
+    #"group" - a single select group with a bucket for every server weighted by its weight, the switch hashes the flows between the buckets and a
+    #rebalance is a single group modification. Switches which do not support weighted select groups fall back to "auto".
+    compilationMode="auto"
+    lookupCost=64 #the cost of a table lookup in the cost model, in flows
+    recompileMargin=0.05 #a rebalance changes the compilation only when the other one is cheaper by this fraction, so it does not flip on every rebalance
+    affinityMode=False #whether clients whose range moves to another server are pinned to their former server until they are idle
+    pinIdleTimeout=10 #seconds a client should be idle before its pin expires
+    heavyHitterMode=False #whether overloaded ranges are probed before an incremental rebalance, so their boundaries are moved by traffic and not by addresses
+    numOfProbes=16 #number of probe flows of an overloaded range
+    #Path of a histogram of client addresses (see ClientDistribution.loadHistogram) by which the subnet is divided between the servers.
+    #When there is none the learned clients are used, and when no client is known the subnet is divided evenly.
+    clientHistogram=None
+    packetInRate=100 #packet-ins of a switch handled every second on average, the rest are dropped
+    packetInBurst=500 #packet-ins of a switch handled at once, enough for all the hosts to be learned
+    #The servers as a list of (port, ip, mac) tupples, their ports following the ports of the clients in the order of the list. When they are given
+    #the servers are not learned, and the flows of a switch are installed as soon as it connects. Clients are added as they ARP for the service.
+    serverConfig=None
+    #The (ip, mac) of the virtual service the clients send their traffic to. The controller answers ARP requests for it. By default it is the last server.
+    virtualService=None
+    #Seconds after a switch connects until its flows are installed with the hosts learned so far, if all of its servers were learned by then.
+    #Clients which were silent until then are added as they ARP for the service.
+    learningTimeout=10
+    #A server fails over to its neighbours (see Failover) once its port goes down. If healthInterval is set, the controller also sends the servers
+    #an ARP probe every healthInterval seconds, and a server which did not answer healthMisses probes in a row fails as well.
+    healthInterval=None
+    healthMisses=3
+    #The server changes (see Servers) are served without authentication, so Ryu's web server listens on apiHost unless another address is given
+    #with --wsapi-host. Set it to "0.0.0.0" to serve every interface, only on a trusted management network.
+    apiHost="127.0.0.1"
   
     def __init__(self, *args, **kwargs):
         super(LoadBalancingSwitch, self).__init__(*args, **kwargs)
         self.subnet='192.168'
+        self.statsScheduler=stats.StatsScheduler()
+        self.switches={} #The state of every balanced switch, by datapath id
+        self.compiled={} #The initial ranges and their compilation, by (subnet, weights, client distribution), shared by switches with the same ones
+        self.histogram=None #The client distribution loaded from clientHistogram
+        self.metrics=Metrics.registry
+        self.journal=None
+        if LoadBalancingSwitch.journalPath is not None:
+            self.journal=Journal.Journal(LoadBalancingSwitch.journalPath)
+            self.journal.write(Journal.CONFIG,0,[getattr(LoadBalancingSwitch,name) for name in CONFIG_NAMES])
+            self.journal.write(Journal.MODES,0,Journal.encodeModes(LoadBalancingSwitch,CONFIG_MODES))
+            self.journal.flush()
+        if 'wsgi' in kwargs:
+            if cfg.CONF.wsapi_host==DEFAULT_WSGI_HOST:
+                cfg.CONF.set_override('wsapi_host',LoadBalancingSwitch.apiHost)
+            kwargs['wsgi'].register(Metrics.MetricsController,self.metrics)
+            kwargs['wsgi'].register(Servers.ServerController,self)
+
+    #Returns the state of the switch of a datapath, a switch which was not seen before gets a new one
+    def getSwitch(self, datapath):
+        switch=self.switches.get(datapath.id)
+        if switch is None:
+            switch=BalancedSwitch(self,datapath)
+            self.switches[datapath.id]=switch
+        return switch
+
+    #Returns the initial ranges of a switch and their compilation. They are computed once for all the switches with the same subnet, weights and
+    #client distribution. The ranges are never changed in place, a rebalance replaces the ranges of its own switch.
+    def compileRanges(self, switch):
+        key=(switch.subnet,tuple(switch.weights),tuple(sorted(switch.getClientDistribution())))
+        if key not in self.compiled:
+            Range.Range.idGen=0
+            switch.setRangesSubnetVersion(switch.subnet)
+            switch.chooseCompilation()
+            self.compiled[key]=(switch.ranges,switch.compilation)
+        return self.compiled[key]
+
+    #Returns the distribution of client addresses loaded from the histogram file, it is loaded once for all the switches
+    def getHistogram(self):
+        if self.histogram is None:
+            self.histogram=ClientDistribution.loadHistogram(LoadBalancingSwitch.clientHistogram)
+        return self.histogram
+
+    #Packet-ins beyond the rate of the switch's meter are dropped without being read
+    @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
+    def _packet_in_handler(self, ev):
+        switch=self.getSwitch(ev.msg.datapath)
+        self.metrics.counter("packet_ins_total").inc()
+        if switch.meter.consume():
+            with self.metrics.timer("packet_in_seconds"):
+                switch.handlePacketIn(ev.msg)
+        else:
+            self.metrics.counter("packet_ins_dropped_total").inc()
+
+    #Handle barrier replies, used to know when a batch of flows was applied
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def _barrier_reply_handler(self, ev):
+        Batch.handleBarrierReply(ev.msg)
+
+    #Forgets a pin once its flow in the active bank expired, the client is balanced by its range again
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def _flow_removed_handler(self, ev):
+        switch=self.switches.get(ev.msg.datapath.id)
+        if switch is not None:
+            switch.flowRemoved(ev.msg)
+
+    #Schedules periodic stats requests about the RIDs table of a switch
+    def flow_request(self, dp):
+        switch=self.getSwitch(dp)
+        print "Stats will be sent every %d seconds!" % LoadBalancingSwitch.statsInterval
+        print "-----\n"
+        self.statsScheduler.schedule(dp,LoadBalancingSwitch.statsInterval,switch.createStatsRequest,switch.flowStatsReceived,LoadBalancingSwitch.statsJitter)
+
+    #Handle stats recieved from switch, all parts of a multipart reply are collected by the scheduler
+    @set_ev_cls([ofp_event.EventOFPFlowStatsReply, ofp_event.EventOFPGroupStatsReply], MAIN_DISPATCHER)
+    def _stats_reply_handler(self, ev):
+        self.statsScheduler.handleReply(ev.msg)
+
+    #The flows of a switch in the group mode are defined once it is known whether it supports select groups
+    @set_ev_cls(ofp_event.EventOFPGroupFeaturesStatsReply, MAIN_DISPATCHER)
+    def _group_features_handler(self, ev):
+        switch=self.switches.get(ev.msg.datapath.id)
+        if switch is not None:
+            switch.groupFeaturesReceived(ev.msg.datapath,ev.msg.body)
+
+    #A switch starts its learning once it connects and its ports are known.
+    #Stop asking a switch for stats once it disconnects, and forget it and its pending batches. If it connects again, it is learned from scratch.
+    @set_ev_cls(ofp_event.EventOFPStateChange, [MAIN_DISPATCHER, DEAD_DISPATCHER])
+    def _state_change_handler(self, ev):
+        if ev.state==MAIN_DISPATCHER:
+            self.getSwitch(ev.datapath).connected(ev.datapath)
+        elif ev.datapath.id is not None:
+            self.statsScheduler.cancel(ev.datapath)
+            self.switches.pop(ev.datapath.id,None)
+            Batch.dropDatapath(ev.datapath.id)
+
+    #Ports which are added or removed while a switch is learned change the number of hosts it waits for, once it is balanced they fail its servers
+    @set_ev_cls(ofp_event.EventOFPPortStatus, MAIN_DISPATCHER)
+    def _port_status_handler(self, ev):
+        switch=self.switches.get(ev.msg.datapath.id)
+        if switch is not None:
+            switch.portChanged(ev.msg.datapath,ev.msg)
+
+
+#The state of a single switch balanced by the controller - the hosts it learned, its ranges, weights, banks and statistics.
+#Every switch learns its hosts, compiles its ranges and rebalances independently of the others.
+
+class BalancedSwitch(object):
+    def __init__(self, app, datapath):
+        self.app=app
+        self.logger=app.logger
+        self.id=datapath.id
+        self.datapath=datapath
+        self.subnet=app.subnet
         self.firstPacketRange=-1
         self.numOfServers=-1
         self.totalHosts=-1
         self.areFlowsSet=False
+        self.bank=0 #The bank of balancing tables the traffic currently goes through
+        self.isRebalancing=False
+        self.isRecompiling=False #Whether the bank being written holds another compilation than the active one
+        self.compilation="elcp" #The compilation of the ranges which is in use, chosen when the flows are first defined and again on every rebalance
+        self.compareBanks=set() #The banks whose compare table is defined
         self.lastStats=[]
+        self.pins={} #The pinned clients, by ip, (range index, range) of the server each is pinned to
+        self.probes={} #The probe flows which are installed, by cookie, (range index, start, end) of each one's sub-prefix
+        self.probeCounts={} #The traffic inside the probed ranges, by range index, a list of (start, end, packets) segments of each one
+        self.probePackets={} #The packets counted by the probe flows which are installed, by range index, they are added to the counts of the ranges
+        self.pinPackets={} #The packets counted by the pin target flows (see Affinity) at the last stats, by range index
         self.ranges=[]
-        self.servers=[] 
+        self.servers=[]
         self.clients=[]
-    
-    @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
-    def _packet_in_handler(self, ev):
-        msg = ev.msg
+        self.meter=FastPath.TokenBucket(LoadBalancingSwitch.packetInRate,LoadBalancingSwitch.packetInBurst) #Limits the packet-ins handled
+        self.ignoredPacketIns=0 #Packet-ins which arrived after the flows were installed
+        self.failedServers={} #The index of the standby of every failed server, by the failed server's index
+        self.downPorts=set() #The server ports which are down
+        self.missedProbes={} #The health probes each server did not answer in a row, by index
+        self.drainedServers=set() #The indices of the servers which get no new clients
+        self.removedServers=set() #The indices of the removed servers, whose placeholder ranges are sent to their standbys (see Servers)
+        self.service=None #The (ip, mac) of the service, fixed once the flows are installed so adding or removing a server does not change it
+
+    #Called once the switch connected and its ports are known. With configured servers its flows are installed at once,
+    #otherwise they are installed once all its hosts were learned, or when the learning times out.
+    def connected(self, datapath):
+        self.updateTopology(datapath)
+        if LoadBalancingSwitch.serverConfig is not None:
+            self.servers=sorted(LoadBalancingSwitch.serverConfig, key=lambda tup: tup[0])
+            self.numOfServers=len(self.servers)
+            self.initializeFlows(datapath)
+        elif LoadBalancingSwitch.learningTimeout is not None:
+            hub.spawn_after(LoadBalancingSwitch.learningTimeout,self.learningTimedOut,datapath)
+
+    #Installs the flows with the hosts learned so far, unless they were installed already or a server is still unknown
+    def learningTimedOut(self, datapath):
+        if self.areFlowsSet or self.app.switches.get(self.id) is not self:
+            return
+        if self.numOfServers>0 and len(self.servers)==self.numOfServers:
+            self.logger.info("Learned %d of %d clients of switch %s, the rest are added once they ARP for the service",
+                             len(self.clients), self.totalHosts-self.numOfServers, self.id)
+            self.initializeFlows(datapath)
+        else:
+            self.logger.info("Learned %d of %d servers of switch %s, waiting for the rest", len(self.servers), self.numOfServers, self.id)
+
+    #Counts the hosts again once a port was added or removed, while the switch is still learned. Once it is balanced, a server fails when its port
+    #goes down and recovers when it comes up again.
+    def portChanged(self, datapath, msg):
+        if not self.areFlowsSet:
+            self.updateTopology(datapath,True)
+            if self.totalHosts==len(self.servers)+len(self.clients):
+                self.initializeFlows(datapath)
+            return
+        port=msg.desc.port_no
+        index=self.findServer(lambda server: server[0]==port)
+        if index is None:
+            return
+        if Failover.isPortDown(msg):
+            self.downPorts.add(port)
+            self.serverFailed(datapath,index,"port %d is down" % port)
+        else:
+            self.downPorts.discard(port)
+            self.serverRecovered(datapath,index,"port %d is up" % port)
+
+    #Returns the index of the first server for which the condition is true, or None. Removed servers are left out.
+    def findServer(self, condition):
+        for i in range(0,len(self.servers)):
+            if i not in self.removedServers and condition(self.servers[i]):
+                return i
+        return None
+
+    #Handles a packet sent to the controller by the switch. Once the flows are installed the switch handles all the traffic, so only ARP requests
+    #for the service still reach the controller, and the rest are dropped.
+    def handlePacketIn(self, msg):
         datapath = msg.datapath
-        pkt=packet.Packet(array.array('B', ev.msg.data))
-        eth_pkt = pkt.get_protocol(ethernet.ethernet)
-        
-        #Handle incoming packet
-        self.handlePacket(datapath,msg,pkt)
+        #Only the ARP header of a packet is read
+        arpPacket=FastPath.parseArp(msg.data)
+        if Failover.isHealthReply(arpPacket):
+            self.healthReplyReceived(datapath,arpPacket)
+            return
+        isServiceRequest=self.isServiceRequest(arpPacket)
+        if self.areFlowsSet and not isServiceRequest:
+            self.ignoredPacketIns+=1
+            return
 
-        #If packet is part of the first packets sent from hosts on network start , learn the hosts
-        arp_pkt = pkt.get_protocol(arp.arp)
-        if (arp_pkt):
-            clientPort=self.getInPort(msg)
-            tup=(clientPort,arp_pkt.src_ip,eth_pkt.src)
-            if (clientPort<=LoadBalancingSwitch.numOfClients and tup not in self.clients):
-                self.clients.append(tup)
-            else:
-                if clientPort>LoadBalancingSwitch.numOfClients and tup not in self.servers:
-                    self.servers.append(tup)
-                    self.servers =sorted(self.servers, key=lambda tup: tup[0])
+        #Handle incoming packet, requests for the service are answered by the controller
+        if isServiceRequest:
+            self.replyToArp(datapath,msg,arpPacket)
+        else:
+            self.handlePacket(datapath,msg)
 
+        #If packet is part of the first packets sent from hosts on network start , learn the hosts
+        if (arpPacket):
+            self.learnHost(datapath,self.getInPort(msg),arpPacket[2],arpPacket[1])
+        if self.areFlowsSet:
+            return
         
         #Update number of hosts in network for ranges defining
         self.updateTopology(datapath)
@@ -56,20 +294,56 @@ class LoadBalancingSwitch(app_manager.RyuApp):
         #Populate all flows tables, once all hosts were seen by the controller
         if  self.totalHosts ==len (self.servers)+len(self.clients):
             self.initializeFlows(datapath)
-        
+
+    #Learns the host of an ARP packet as a client or as a server by its port. A client learned after the flows were installed gets its stable flow.
+    def learnHost(self, datapath, port, ip, mac):
+        tup=(port,ip,mac)
+        if (port<=LoadBalancingSwitch.numOfClients and tup not in self.clients):
+            self.clients.append(tup)
+            if self.areFlowsSet:
+                self.logger.info("Adding client %s on port %d of switch %s", ip, port, self.id)
+                ClientsTable.installStableFlow(ip,port,datapath,self.getService())
+        elif port>LoadBalancingSwitch.numOfClients and tup not in self.servers and LoadBalancingSwitch.serverConfig is None and not self.areFlowsSet:
+            self.servers.append(tup)
+            self.servers =sorted(self.servers, key=lambda tup: tup[0])
+
+    #Returns the (ip, mac) of the virtual service, or None while it is not known
+    def getService(self):
+        if self.service is not None:
+            return self.service
+        if LoadBalancingSwitch.virtualService is not None:
+            return tuple(LoadBalancingSwitch.virtualService)
+        if self.servers:
+            return (self.servers[len(self.servers)-1][1],self.servers[len(self.servers)-1][2])
+        return None
+
+    #Returns true iff a parsed ARP packet is a request for the address of the service
+    def isServiceRequest(self, arpPacket):
+        service=self.getService()
+        return arpPacket is not None and service is not None and arpPacket[0]==FastPath.ARP_REQUEST and arpPacket[3]==service[0]
+
+    #Answers an ARP request for the service with its mac, through the port the request came from
+    def replyToArp(self, datapath, msg, arpPacket):
+        ofproto=ofproto_v1_3
+        parser = datapath.ofproto_parser
+        service=self.getService()
+        data=FastPath.createArpReply(service[1],service[0],arpPacket[1],arpPacket[2])
+        outputAction = parser.OFPActionOutput(self.getInPort(msg),0)
+        packet_out = parser.OFPPacketOut(datapath, 0xffffffff,
+                                         ofproto.OFPP_CONTROLLER,
+                                         [outputAction], data)
+        datapath.send_msg(packet_out)
 
     #Given a packet-in message, returns the port the packet was sent from
     def getInPort(self,msg):
-        for f in msg.match.fields:
-            if f.header == ofproto_v1_3.OXM_OF_IN_PORT:
-                in_port = f.value
-        return in_port
-
-    #Updates information about the topology (number of host,servers and clients)
-    def updateTopology(self,datapath):
-        if (self.numOfServers==-1):
+        return msg.match['in_port']
+
+    #Updates information about the topology (number of host,servers and clients), the counts are kept unless refresh is set.
+    #Configured servers are not counted by the ports.
+    def updateTopology(self,datapath,refresh=False):
+        if (self.numOfServers==-1 or refresh) and LoadBalancingSwitch.serverConfig is None:
             self.numOfServers=len(datapath.ports)-(LoadBalancingSwitch.numOfClients+1)
-        if (self.totalHosts==-1):
+        if (self.totalHosts==-1 or refresh):
             self.totalHosts=len(datapath.ports)-1
 
     #Defines all the flows for all the tables for the first time
@@ -78,27 +352,46 @@ class LoadBalancingSwitch(app_manager.RyuApp):
         if (not self.areFlowsSet):
 
             #Define all the flow for the tables
-            self.logger.info("\nDefining all flows...")
+            self.logger.info("\nDefining all flows of switch %s...", self.id)
             #get initial weights for servers, used for balancing, all 1 by default.
             self.getDefaultWeights()
 
-            #Create a range object for each server using the initilaized weights
+            #Create a range object for each server using the initilaized weights, switches with the same clients share them
             #self.setRanges()
-            self.setRangesSubnetVersion(self.subnet)
-
-            #Define all flows
-            self.defineAllFlows(datapath,True)
+            (self.ranges,self.compilation)=self.app.compileRanges(self)
 
             #Mark job as done to make sure it's only done once
             self.areFlowsSet=True
-            
-            #Start the timer which receives stats from the RIDS table
-            self.flow_request(datapath)
+            self.service=self.getService()
+
+            #In the group mode the flows are defined once the group features of the switch arrive
+            if LoadBalancingSwitch.compilationMode=="group":
+                datapath.send_msg(SelectGroup.createFeaturesRequest(datapath))
+                return
+            self.installFlows(datapath)
+
+    #Defines all flows, starts the timer which receives stats from the RIDS table and the health probes of the servers if they are on
+    def installFlows(self,datapath):
+        self.defineAllFlows(datapath,True)
+        self.app.flow_request(datapath)
+        if LoadBalancingSwitch.healthInterval is not None:
+            hub.spawn(self.checkHealth,datapath)
+
+    #Uses a select group for the balancing if the switch supports it, otherwise the ranges keep the compilation chosen for them
+    def groupFeaturesReceived(self,datapath,features):
+        if self.compilation=="group":
+            return
+        if SelectGroup.supportsSelect(features):
+            self.compilation="group"
+            self.logger.info("Balancing switch %s by a select group", self.id)
+        else:
+            self.logger.info("Switch %s does not support weighted select groups, compiling the ranges into %s flows", self.id, self.compilation)
+        self.installFlows(datapath)
 
 
     #Since the switch is defined to handle all traffic, this function is used only for the first arp packets send while the controller is learning the network
     #Acts as a hub.
-    def handlePacket(self,datapath,msg,pkt):
+    def handlePacket(self,datapath,msg):
         ofproto=ofproto_v1_3
         parser = datapath.ofproto_parser
         outputAction = parser.OFPActionOutput(ofproto.OFPP_FLOOD,ofproto.OFPCML_NO_BUFFER)
@@ -109,15 +402,82 @@ class LoadBalancingSwitch(app_manager.RyuApp):
     
     #Populates all tables with flows, a flag is used since the first and third table are static and are defined only once at start,
     # unlike the others which might be cleared in case of a rebalancing.
-    def defineAllFlows(self,datapath,firstTime):
-        if (firstTime):
-            ClientsTable.prepareStable(datapath,self.clients,self.servers)
-        Elcp1Table.prepareELCP1Table(datapath,self.ranges)
+    # All flows are sent as a single batch, the returned batch is committed once the switch applied all of them.
+    def defineAllFlows(self,datapath,firstTime,bank=0,callback=None,pinFlows=[]):
+        batch=Batch.FlowBatch(datapath)
         if (firstTime):
-            CompareTable.prepareCompareTable(datapath)
-        Elcp0Table.prepareELCP0Table(datapath,self.ranges)
-        RidsTable.prepareRIDTable(datapath,self.ranges,self.servers,LoadBalancingSwitch.numOfClients)
-         
+            ClientsTable.prepareStable(datapath,self.clients,self.getService(),batch,bank)
+            if LoadBalancingSwitch.healthInterval is not None:
+                batch.send_msg(Failover.createHealthReplyFlow(datapath))
+        if self.compilation!="group":
+            for flow in self.getPinTargetFlows(datapath,bank):
+                batch.send_msg(flow)
+        for flow in pinFlows:
+            batch.send_msg(flow)
+        if self.compilation=="group":
+            SelectGroup.prepareGroup(datapath,self.ranges,self.getGroupServers(),self.getGroupWeights(),LoadBalancingSwitch.numOfClients,batch,bank)
+            batch.addCallback(self.flowsCommitted)
+            return batch.commit(callback)
+        if self.compilation=="prefix":
+            PrefixTable.preparePrefixTable(datapath,self.ranges,self.getServers(),LoadBalancingSwitch.numOfClients,batch,bank)
+            batch.addCallback(self.flowsCommitted)
+            return batch.commit(callback)
+        Elcp1Table.prepareELCP1Table(datapath,self.ranges,batch,bank)
+        #The compare table is static, it is defined once in every bank, or once the ranges of a bank are first compiled into ELCP flows
+        for b in (self.getBanks() if firstTime else [bank]):
+            if b not in self.compareBanks:
+                CompareTable.prepareCompareTable(datapath,batch,b)
+                self.compareBanks.add(b)
+        Elcp0Table.prepareELCP0Table(datapath,self.ranges,batch,bank)
+        RidsTable.prepareRIDTable(datapath,self.ranges,self.getServers(),LoadBalancingSwitch.numOfClients,batch,bank)
+        batch.addCallback(self.flowsCommitted)
+        return batch.commit(callback)
+
+    #Sets the compilation of the ranges by the class's mode, in "auto" mode it is chosen by the cost model for the current ranges.
+    #In "group" mode it is the compilation used if the switch does not support select groups. See updateCompilation for rebalances.
+    def chooseCompilation(self):
+        mode=LoadBalancingSwitch.compilationMode
+        if mode in ["auto","group"]:
+            mode=PrefixTable.chooseCompilation(self.ranges,LoadBalancingSwitch.lookupCost)
+        self.compilation=mode
+        self.logger.info("Compiling %d ranges into %s flows", len(self.ranges), mode)
+
+    #Chooses the compilation of the new ranges of a rebalance again in "auto" mode, returns true iff it changed. The current compilation is kept
+    #unless the other one is cheaper by recompileMargin.
+    def updateCompilation(self):
+        if LoadBalancingSwitch.compilationMode not in ["auto","group"] or self.compilation=="group":
+            return False
+        mode=PrefixTable.chooseCompilation(self.ranges,LoadBalancingSwitch.lookupCost,self.compilation,LoadBalancingSwitch.recompileMargin)
+        if mode==self.compilation:
+            return False
+        self.logger.info("Recompiling %d ranges of switch %s from %s into %s flows", len(self.ranges), self.id, self.compilation, mode)
+        Metrics.registry.counter("recompilations_total",compilation=mode).inc()
+        self.compilation=mode
+        return True
+
+    #Returns the table whose flows count the packets of every range, in the active bank, not used by the group compilation
+    def getStatsTable(self):
+        if self.compilation=="prefix":
+            return Flow.bankTable(1,self.bank)
+        return Flow.bankTable(4,self.bank)
+
+    #Returns the tables whose RIDs flows count the packets of every range, in the active bank. In the prefix compilation the pin target flows of the
+    #RIDs table count the pinned packets.
+    def getStatsTables(self):
+        if self.compilation=="prefix" and LoadBalancingSwitch.affinityMode:
+            return [self.getStatsTable(),Flow.bankTable(4,self.bank)]
+        return [self.getStatsTable()]
+
+    #Returns the banks of balancing tables used by the rebalance mode
+    def getBanks(self):
+        if LoadBalancingSwitch.rebalanceMode=="shadow":
+            return range(0,Flow.NUM_OF_BANKS)
+        return [0]
+
+    #Called once the switch applied a batch of flows
+    def flowsCommitted(self,batch):
+        self.logger.info("%d messages (%d bytes) were applied by switch %s in %.3f seconds", len(batch.msgs), batch.numOfBytes, self.id, batch.elapsed())
+
                         
 #-------------------------Load balancing------------------------------------------------
  
@@ -131,33 +491,95 @@ class LoadBalancingSwitch(app_manager.RyuApp):
         print "Statistics recieved!"
         print "Interval packet counts: %s" % counts
         print "Overall packet counts: %s" % newCounts
+        for i in range(0,len(counts)):
+            Metrics.registry.gauge("server_interval_packets",switch=self.id,server=self.servers[i][1]).set(counts[i])
+        self.writeJournal(Journal.SAMPLE,newCounts)
+        self.writeJournal(Journal.RANGES,[int(bound) for r in self.ranges for bound in (r.start,r.end)])
+        self.writeJournal(Journal.DELTAS,counts)
         oldWeights=list(self.weights)
-        weightsChanged=self.getNewWeights(newCounts)
+        #The servers are compared by the packets of this interval, the counters of flows which were replaced started again from zero
+        weightsChanged=self.getNewWeights(counts)
+        probeCounts=self.probeCounts
+        self.probeCounts={}
+        if self.probes and (probeCounts or not weightsChanged):
+            self.removeProbes(dp)
+        if weightsChanged and self.shouldProbe(probeCounts):
+            #Rebalance only once it is known where the traffic of the overloaded ranges comes from
+            if not self.probes:
+                self.installProbes(dp,oldWeights)
+            self.weights=oldWeights
+            self.writeJournal(Journal.WEIGHTS,self.weights,True)
+            print "-----"
+            return
         if weightsChanged:
             self.logger.info("Performing rebalancing...")
             print "Former weights: %s" % oldWeights
             print "New weights: %s" % self.weights
-            self.clearTables(dp)
-            Range.Range.idGen=0
-            #self.setRanges()
-            self.setRangesSubnetVersion(self.subnet)
-            self.defineAllFlows(dp,False)
-            self.lastStats=[]
+            with Metrics.registry.timer("rebalance_seconds",mode=self.getRebalanceMode()):
+                batch=self.rebalance(dp,oldWeights,probeCounts)
+            Metrics.registry.counter("rebalances_total",mode=self.getRebalanceMode()).inc()
+            Metrics.registry.histogram("rebalance_changes",Metrics.COUNT_BOUNDS).observe(Batch.countChanges(batch))
+            self.writeJournal(Journal.DIFF,Journal.getDiff(batch))
         else:
             self.logger.info("No rebalancing required")
+        self.writeJournal(Journal.WEIGHTS,self.weights,True)
         print "-----"
 
+    #Appends a record of the switch to the rebalance journal if there is one, the journal is flushed once the last record of a sample is written
+    def writeJournal(self, recordType, values, last=False):
+        if self.app.journal is not None:
+            self.app.journal.write(recordType,self.id,values)
+            if last:
+                self.app.journal.flush()
+
+    #Moves the switch to the new weights by the rebalance mode, returns the batch of the changed flows
+    def rebalance(self, dp, oldWeights, probeCounts):
+        if self.compilation=="group":
+            return self.updateGroup(dp)
+        oldRanges=self.ranges
+        Range.Range.idGen=0
+        if LoadBalancingSwitch.rebalanceMode=="incremental":
+            self.shrinkOverloadedRanges(oldWeights,probeCounts)
+            self.shrinkFailedRanges()
+            #The flows of another compilation are written into the inactive bank, so no packet is lost while they replace the current ones
+            if self.updateCompilation():
+                self.isRecompiling=True
+                return self.shadowRebalance(dp,oldRanges)
+            return self.incrementalRebalance(dp,oldRanges)
+        #self.setRanges()
+        self.setRangesSubnetVersion(self.subnet)
+        self.shrinkFailedRanges()
+        self.isRecompiling=self.updateCompilation()
+        self.lastStats=[]
+        if LoadBalancingSwitch.rebalanceMode=="shadow":
+            return self.shadowRebalance(dp,oldRanges)
+        self.isRecompiling=False
+        self.clearTables(dp,self.bank)
+        return self.defineAllFlows(dp,False,self.bank,pinFlows=self.getPinFlows(dp,oldRanges,self.bank,True))
+
+    #Returns the name of the way the switch is rebalanced, used to tell the metrics of the modes apart
+    def getRebalanceMode(self):
+        if self.compilation=="group":
+            return "group"
+        return LoadBalancingSwitch.rebalanceMode
+
     # If needed, changes the former server weights according to packet count statistics recived from the switch.
-    # A server is considered overloaded if its packet count is more than 1.5 times the average packet count in all servers.
+    # A server is considered overloaded if its packet count is more than overloadFactor times the average packet count in all servers.
+    # The packet counts are divided by the weight each server was given (see setServerWeight), 1 by default.
+    # Failed and drained servers are left out, their placeholder ranges get almost no packets.
     def getNewWeights(self,packets):
         flag=False
-        avgPacketCount= self.avg(packets)
+        live=[i for i in range(0,len(packets)) if self.inRotation(i)]
+        if not live:
+            return False
+        loads=[packets[i]/float(self.capacities[i]) for i in range(0,len(packets))]
+        avgPacketCount= self.avg([loads[i] for i in live])
         print "Average packets in server: %3f" % avgPacketCount
-        if (avgPacketCount>10):
-            for i in range(0,len(packets)):
-                if (packets[i]>avgPacketCount*1.5):
+        if (avgPacketCount>LoadBalancingSwitch.minAveragePackets):
+            for i in live:
+                if (loads[i]>avgPacketCount*LoadBalancingSwitch.overloadFactor):
                     flag=True
-                    self.weights[i]=self.weights[i]* (avgPacketCount/packets[i])
+                    self.weights[i]=self.weights[i]* (avgPacketCount/loads[i])
         return flag
    
     # Retruns a new list in which the integer in the Ith position is the result of the Ith element of the second list deducted from the Ith element of the first list
@@ -171,15 +593,132 @@ class LoadBalancingSwitch(app_manager.RyuApp):
     def avg(self,packets):
         return sum(packets) / float(len(packets))
 
-    #Removes all flows from all the dynamic tables (3 total), used in case of a rebalancing 
-    def clearTables(self, dp):
+    #Moves the active bank from the old ranges to the current ones by sending only the flows of ranges which changed, or whose server changed
+    #since the given old servers (see getServers). New flows are sent before the old ones are deleted, and the RIDs table is updated before the ELCP
+    #tables which write its metadata, so a packet always finds a matching flow.
+    def incrementalRebalance(self, dp, oldRanges, oldServers=None):
+        if self.compilation=="prefix":
+            return self.incrementalPrefixRebalance(dp,oldRanges,oldServers)
+        servers=self.getServers()
+        pinFlows=self.getRedirectedPinFlows(dp,oldServers)+self.getPinFlows(dp,oldRanges,self.bank,False)
+        (ridAdd,ridDelete)=RidsTable.getUpdateFlows(dp,oldRanges,self.ranges,servers,LoadBalancingSwitch.numOfClients,self.bank,oldServers)
+        (oneAdd,oneDelete)=Elcp1Table.getUpdateFlows(dp,oldRanges,self.ranges,self.bank)
+        (zeroAdd,zeroDelete)=Elcp0Table.getUpdateFlows(dp,oldRanges,self.ranges,self.bank)
+        batch=Batch.FlowBatch(dp)
+        for phase in [pinFlows,ridAdd,oneAdd+zeroAdd,oneDelete+zeroDelete,ridDelete]:
+            for flow in phase:
+                batch.send_msg(flow)
+            batch.addBarrier()
+        numOfFlows=len(ridAdd+oneAdd+zeroAdd+oneDelete+zeroDelete+ridDelete)
+        self.logger.info("Updating %d flows instead of %d", numOfFlows, 3*len(self.ranges))
+        batch.commit(self.flowsCommitted)
+        self.resetLastStats([i for i in range(0,len(self.ranges)) if i>=len(oldRanges) or oldRanges[i].getMetadata()!=self.ranges[i].getMetadata()],
+                            oldServers)
+        return batch
+
+    #The incremental rebalance of the prefix compilation. All the flows of a range which changed are replaced, the new flows are sent before
+    #the old ones are deleted, and a longer prefix has a higher priority, so a packet always finds a matching flow.
+    def incrementalPrefixRebalance(self, dp, oldRanges, oldServers=None):
+        pinFlows=self.getRedirectedPinFlows(dp,oldServers)+self.getPinFlows(dp,oldRanges,self.bank,False)
+        (add,delete)=PrefixTable.getUpdateFlows(dp,oldRanges,self.ranges,self.getServers(),LoadBalancingSwitch.numOfClients,self.bank,oldServers)
+        batch=Batch.FlowBatch(dp)
+        for phase in [pinFlows,add,delete]:
+            for flow in phase:
+                batch.send_msg(flow)
+            batch.addBarrier()
+        self.logger.info("Updating %d flows instead of %d", len(add+delete), PrefixTable.getNumOfPrefixRules(self.ranges))
+        batch.commit(self.flowsCommitted)
+        self.resetLastStats([i for i in range(0,len(self.ranges))
+                             if i>=len(oldRanges) or (oldRanges[i].start,oldRanges[i].end)!=(self.ranges[i].start,self.ranges[i].end)],oldServers)
+        return batch
+
+    #Sets the last counts of the ranges whose flows were replaced, given their indices, since the counters of the new flows start again from zero.
+    #The flows of a server which changed since the old servers are replaced too. A pin target flow is replaced only when its server changed, otherwise
+    #it keeps its counter.
+    def resetLastStats(self, changed, oldServers):
+        redirected=set(self.getChangedServers(oldServers))
+        for i in set(changed)|redirected:
+            if i<len(self.lastStats):
+                self.lastStats[i]=0 if i in redirected else self.pinPackets.get(i,0)
+        for i in redirected:
+            self.pinPackets.pop(i,None)
+
+    #Writes the current ranges into the inactive bank of balancing tables. Once the switch applied all of them, the miss flow of the
+    #first table is pointed to the new bank, so every packet is handled either by the old flows or by the new ones and none is lost.
+    #The old bank is cleared only after the switch moved to the new one. A failover while the new bank is written is applied to the old bank, and to
+    #the new one once the switch moved to it, or only to the new one if it holds another compilation (see updateCompilation).
+    def shadowRebalance(self, dp, oldRanges):
+        oldBank=self.bank
+        newBank=(oldBank+1) % Flow.NUM_OF_BANKS
+        self.isRebalancing=True
+        (ranges,servers)=(self.ranges,self.getServers())
+
+        def switchBank(batch):
+            flip=Batch.FlowBatch(dp)
+            flip.send_msg(ClientsTable.createStableMissFlow(dp,newBank))
+            flip.commit(bankSwitched)
+
+        def bankSwitched(batch):
+            self.bank=newBank
+            self.clearTables(dp,oldBank)
+            self.lastStats=[]
+            self.isRebalancing=False
+            self.isRecompiling=False
+            self.logger.info("Moved to bank %d", newBank)
+            if (self.ranges,self.getServers())!=(ranges,servers):
+                self.incrementalRebalance(dp,ranges,servers)
+
+        return self.defineAllFlows(dp,False,newBank,switchBank,self.getPinFlows(dp,oldRanges,newBank,True))
+
+    #When the affinity mode is on, pins the known clients whose address moves from the old ranges to the range of another server, to their former server.
+    #Returns the pin flows to send into the given bank - of the new pins or, if the bank is rewritten from scratch, of all the pins.
+    #A client which is already pinned stays pinned to the same server.
+    def getPinFlows(self, dp, oldRanges, bank, rewritten):
+        if not LoadBalancingSwitch.affinityMode:
+            return []
+        moved=Affinity.getMovedClients([client for client in self.clients if client[1] not in self.pins],oldRanges,self.ranges)
+        for (ip,index) in moved:
+            self.pins[ip]=(index,oldRanges[index])
+        if rewritten:
+            pins=self.pins.items()
+        else:
+            pins=[(ip,self.pins[ip]) for (ip,index) in moved]
+        if pins:
+            self.logger.info("Pinning %d clients to their former servers", len(pins))
+        return Affinity.getPinFlows(dp,pins,LoadBalancingSwitch.pinIdleTimeout,bank)
+
+    #Returns the pin target flows (see Affinity) of the servers at the given indices in a bank, of all the servers if none are given
+    def getPinTargetFlows(self, dp, bank, indices=None):
+        if not LoadBalancingSwitch.affinityMode:
+            return []
+        return Affinity.getPinTargetFlows(dp,self.getServers(),bank,indices)
+
+    #Returns the indices of the servers which changed since the given old servers, since a server failed, recovered, was added or removed
+    def getChangedServers(self, oldServers):
+        if oldServers is None:
+            return []
+        servers=self.getServers()
+        return [i for i in range(0,len(servers)) if i>=len(oldServers) or oldServers[i]!=servers[i]]
+
+    #Returns the pin target flows of the servers which changed since the given old servers, the pinned clients follow their server's standby
+    def getRedirectedPinFlows(self, dp, oldServers):
+        return self.getPinTargetFlows(dp,self.bank,self.getChangedServers(oldServers))
+
+    #Forgets a pin once its flow in the active bank expired, the client is balanced by its range again
+    def flowRemoved(self, msg):
+        if ((msg.cookie & Flow.COOKIE_TYPE_MASK)==Flow.PIN_COOKIE and msg.reason==ofproto_v1_3.OFPRR_IDLE_TIMEOUT
+                and msg.table_id==Flow.bankTable(1,self.bank)):
+            self.pins.pop(msg.match['ipv4_src'],None)
+
+    #Removes all flows from all the dynamic tables (3 total) of a bank, used in case of a rebalancing
+    def clearTables(self, dp, bank=0):
         for i in [1, 3, 4]:
-            self.remove_flows(dp, i)
+            self.remove_flows(dp, Flow.bankTable(i,bank))
     
     #Sends a message to a table (by table_id) to clear all flows        
     def remove_flows(self, datapath, table_id):
         flow_mod = self.remove_table_flows(datapath, table_id)
-        datapath.send_msg(flow_mod)
+        Batch.send(datapath,flow_mod)
 
     #Given a table id, creates a message to the switch to clear all flows from table
     def remove_table_flows(self, datapath, table_id):
@@ -201,6 +740,7 @@ class LoadBalancingSwitch(app_manager.RyuApp):
         for i in range(0,self.numOfServers):
             res.append(1)
         self.weights=res
+        self.capacities=list(res) #The weights given to the servers, by which their packet counts are compared
         return res
 
      
@@ -218,7 +758,7 @@ class LoadBalancingSwitch(app_manager.RyuApp):
         #self.printRanges()
   
 
-    #A secondary version for SetRanges, designed for a subnet
+    #A secondary version for SetRanges, designed for a subnet. The ranges are placed by the distribution of the clients in the subnet if it is known.
     def setRangesSubnetVersion(self, subnet):
         self.ranges=[]
         subnetArr= subnet.split(".")
@@ -227,6 +767,10 @@ class LoadBalancingSwitch(app_manager.RyuApp):
            subnet+=".0"
         factor=Range.IP2Int(subnet)
         spectrum= pow(2, 8*(4-subnetLen))
+        bounds=ClientDistribution.getQuantileBounds(self.getClientDistribution(),self.weights,factor,factor+spectrum-1)
+        if bounds is not None:
+            self.ranges=[Range.Range(start,end) for (start,end) in bounds]
+            return
         jump = math.floor(spectrum / sum(self.weights))
         fill = spectrum - jump * sum(self.weights)
         for i in range(0, len(self.weights)):
@@ -238,46 +782,386 @@ class LoadBalancingSwitch(app_manager.RyuApp):
         #self.printRanges()
         
 
+    #Returns the distribution of client addresses, from the histogram file if there is one and from the learned clients otherwise
+    def getClientDistribution(self):
+        if LoadBalancingSwitch.clientHistogram is None:
+            return ClientDistribution.getClientPoints(self.clients)
+        return self.app.getHistogram()
+
+    #A local version of setRanges, used for incremental rebalancing. Instead of dividing the spectrum again, only the ranges of servers whose weight
+    #decreased shrink, by the same factor, and the freed addresses are given to their neighbours. Boundaries of other ranges do not move.
+    #A range with probe counts sheds traffic instead of addresses, by the same factor, so a hot part of it is given away whole.
+    def shrinkOverloadedRanges(self, oldWeights, probeCounts={}):
+        bounds=[[r.start,r.end] for r in self.ranges]
+        for i in range(0,len(bounds)):
+            if self.weights[i]>=oldWeights[i]:
+                continue
+            segments=probeCounts.get(i)
+            if segments and sum(packets for (start,end,packets) in segments)>0:
+                size=sum(packets for (start,end,packets) in segments)
+            else:
+                segments=None
+                size=bounds[i][1]-bounds[i][0]+1
+            freed=size-int(math.ceil(size*self.weights[i]/float(oldWeights[i])))
+            if i==0:
+                down,up=0,freed
+            elif i==len(bounds)-1:
+                down,up=freed,0
+            else:
+                down=freed/2
+                up=freed-down
+            if segments:
+                (down,up)=Probes.getShedAddresses(segments,down,up)
+            bounds[i][0]+=down
+            bounds[i][1]-=up
+            if i>0:
+                bounds[i-1][1]+=down
+            if i<len(bounds)-1:
+                bounds[i+1][0]-=up
+        self.ranges=[Range.Range(start,end) for (start,end) in bounds]
+
+    #Returns true iff the overloaded ranges should be probed, or are being probed, before they are rebalanced
+    def shouldProbe(self, probeCounts):
+        return (LoadBalancingSwitch.heavyHitterMode and LoadBalancingSwitch.rebalanceMode=="incremental" and self.compilation!="group"
+                and not probeCounts)
+
+    #Rebalances the group compilation by a single modification of the group's bucket weights. The bucket counters may start again from zero.
+    def updateGroup(self, dp):
+        batch=Batch.FlowBatch(dp)
+        batch.send_msg(SelectGroup.createGroupMod(dp,self.ranges,self.getGroupServers(),self.getGroupWeights(),LoadBalancingSwitch.numOfClients,
+                                                  ofproto_v1_3.OFPGC_MODIFY))
+        self.logger.info("Updating 1 group instead of %d flows", 3*len(self.ranges))
+        batch.commit(self.flowsCommitted)
+        self.lastStats=[]
+        return batch
+
+    #Installs probe flows in the ranges of the servers whose weight decreased. The next stats reply holds their counts.
+    def installProbes(self, dp, oldWeights):
+        batch=Batch.FlowBatch(dp)
+        for i in range(0,len(self.ranges)):
+            if self.weights[i]>=oldWeights[i]:
+                continue
+            for prefix in Probes.getProbePrefixes(self.ranges[i],LoadBalancingSwitch.numOfProbes):
+                cookie=Flow.createCookie(Flow.PROBE_COOKIE,len(self.probes))
+                (start,end)=(prefix[0],prefix[0]+(1 << (Range.IP_BITS-prefix[1]))-1)
+                self.probes[cookie]=(i,start,end)
+                batch.send_msg(Probes.createProbeFlow(prefix,len(self.probes)-1,self.ranges[i],i,dp,self.getServers(),LoadBalancingSwitch.numOfClients,self.bank))
+        self.logger.info("Probing the traffic of overloaded ranges with %d flows", len(self.probes))
+        batch.commit(self.flowsCommitted)
+
+    #Keeps the counts of the probe flows in a stats reply, as segments of the traffic inside each probed range
+    def probesReceived(self, body):
+        counts={}
+        for stat in body:
+            probe=self.probes.get(stat.cookie)
+            if probe is not None:
+                (index,start,end)=probe
+                counts.setdefault(index,[]).append((start,end,stat.packet_count))
+        for index in counts:
+            counts[index].sort()
+        self.probeCounts=counts
+        self.probePackets=dict((index,sum(packets for (start,end,packets) in counts[index])) for index in counts)
+
+    #Deletes all the probe flows, they must be gone before the boundaries of the probed ranges move. The packets they counted are no longer part of
+    #the counts of their ranges, so they are deducted from the last counts too.
+    def removeProbes(self, dp):
+        batch=Batch.FlowBatch(dp)
+        batch.send_msg(Probes.createDeleteProbesFlow(dp,self.bank))
+        batch.commit()
+        self.probes={}
+        for (index,packets) in self.probePackets.items():
+            if index<len(self.lastStats):
+                self.lastStats[index]-=packets
+        self.probePackets={}
+
     #Prints all ranges defined in the switch, used for debugging
     def printRanges(self):
         for i in range (0, len(self.ranges)):
             print ("-----------")
             print ("%s" % self.ranges[i])
 
+
+#--------------------Failover-----------------------------
+
+    #Returns the servers the ranges are sent to, where every failed server is replaced by its standby
+    def getServers(self):
+        if not self.failedServers:
+            return self.servers
+        return Failover.getTargetServers(self.servers,self.failedServers)
+
+    #Returns the servers of the group's buckets, where a drained server is also replaced, by the nearest server in rotation, so it gets no new flows
+    def getGroupServers(self):
+        servers=self.getServers()
+        outOfRotation=set(self.failedServers)|self.drainedServers
+        for i in self.drainedServers:
+            standby=Failover.getStandby(i,outOfRotation,len(self.servers))
+            if standby is not None:
+                servers=servers[:i]+[self.servers[standby]]+servers[i+1:]
+        return servers
+
+    #Returns the weights of the group's buckets, a failed or drained server gets the least
+    def getGroupWeights(self):
+        return [self.weights[i] if self.inRotation(i) else 0 for i in range(0,len(self.weights))]
+
+    #Returns true iff new clients are sent to the server at the index - it did not fail, and it was not drained or removed
+    def inRotation(self, index):
+        return index not in self.failedServers and index not in self.drainedServers
+
+    #Fails over from the server at the index: its range is given to its live neighbours, and the rest of its flows are sent to its standby
+    def serverFailed(self, dp, index, reason):
+        if index in self.failedServers:
+            return
+        failed=set(self.failedServers)|set([index])
+        if len(failed)==len(self.servers):
+            self.logger.warning("Server %s of switch %s failed (%s), but no other server is left", self.servers[index][1], self.id, reason)
+            return
+        self.logger.warning("Server %s of switch %s failed (%s), failing over", self.servers[index][1], self.id, reason)
+        Metrics.registry.counter("server_failures_total",switch=self.id).inc()
+        self.failOver(dp,failed)
+
+    #Gives a failed server which came back its share of the addresses again, taken from its neighbours
+    def serverRecovered(self, dp, index, reason):
+        if index not in self.failedServers or index in self.removedServers or self.servers[index][0] in self.downPorts:
+            return
+        self.logger.info("Server %s of switch %s recovered (%s)", self.servers[index][1], self.id, reason)
+        Metrics.registry.counter("server_recoveries_total",switch=self.id).inc()
+        self.failOver(dp,set(self.failedServers)-set([index]),index)
+
+    #Moves the switch to the given failed servers in a single batch, whatever the rebalance mode is. The standbys are chosen again, and only the flows
+    #of ranges which changed or whose server changed are rewritten. The range of a recovered server grows to its share by its weight.
+    def failOver(self, dp, failed, recovered=None):
+        oldRanges=self.ranges
+        oldServers=self.getServers()
+        self.setStandbys(failed)
+        if recovered is not None:
+            self.setBounds(Failover.expandRange(self.getBounds(),recovered,self.getShare(recovered)))
+        with Metrics.registry.timer("failover_seconds"):
+            batch=self.updateFlows(dp,oldRanges,oldServers)
+        return batch
+
+    #Chooses the standby of every one of the given failed servers
+    def setStandbys(self, failed):
+        self.failedServers=dict((i,Failover.getStandby(i,failed,len(self.servers))) for i in failed)
+
+    #Returns the addresses the server at the index should have by its weight, out of the addresses of the servers in rotation and its own
+    def getShare(self, index):
+        live=[i for i in range(0,len(self.servers)) if self.inRotation(i) or i==index]
+        total=sum(r.end-r.start+1 for r in self.ranges)
+        return int(total*self.capacities[index]/float(sum(self.capacities[i] for i in live)))
+
+    #Collapses the ranges of the failed and drained servers and sends the flows which changed since the old ranges and servers, in a single batch
+    #whatever the rebalance mode is
+    def updateFlows(self, dp, oldRanges, oldServers):
+        self.shrinkFailedRanges()
+        if self.probes:
+            self.removeProbes(dp)
+        if self.isRecompiling:
+            #The active bank holds the flows of the former compilation, the new bank is brought up to date once the switch moved to it
+            return None
+        if self.compilation=="group":
+            return self.updateGroup(dp)
+        return self.incrementalRebalance(dp,oldRanges,oldServers)
+
+    #Gives the addresses of the ranges of the failed and drained servers to their neighbours, and they keep placeholder ranges
+    def shrinkFailedRanges(self):
+        if self.failedServers or self.drainedServers:
+            self.setBounds(Failover.collapseFailedRanges(self.getBounds(),set(self.failedServers)|self.drainedServers))
+
+    #Returns the (start, end) bounds of the ranges
+    def getBounds(self):
+        return [(r.start,r.end) for r in self.ranges]
+
+    #Replaces the ranges by ranges of the given (start, end) bounds
+    def setBounds(self, bounds):
+        Range.Range.idGen=0
+        self.ranges=[Range.Range(start,end) for (start,end) in bounds]
+
+    #Sends a health probe to every server every healthInterval seconds while the switch is balanced. A server which did not answer healthMisses
+    #probes in a row fails.
+    def checkHealth(self, datapath):
+        while self.app.switches.get(self.id) is self:
+            for i in range(0,len(self.servers)):
+                if i in self.removedServers:
+                    continue
+                if self.missedProbes.get(i,0)>=LoadBalancingSwitch.healthMisses:
+                    self.serverFailed(datapath,i,"%d health probes were not answered" % self.missedProbes[i])
+                self.sendHealthProbe(datapath,i)
+                self.missedProbes[i]=self.missedProbes.get(i,0)+1
+            hub.sleep(LoadBalancingSwitch.healthInterval)
+
+    #Sends the health probe of the server at the index through its port
+    def sendHealthProbe(self, datapath, index):
+        ofproto=ofproto_v1_3
+        parser=datapath.ofproto_parser
+        (port,ip,mac)=self.servers[index]
+        data=Failover.createHealthProbe(mac,ip)
+        datapath.send_msg(parser.OFPPacketOut(datapath,0xffffffff,ofproto.OFPP_CONTROLLER,[parser.OFPActionOutput(port,0)],data))
+
+    #A server which answered a health probe is alive, it recovers if it failed
+    def healthReplyReceived(self, datapath, arpPacket):
+        index=self.findServer(lambda server: server[1]==arpPacket[2])
+        if index is not None:
+            self.missedProbes[index]=0
+            self.serverRecovered(datapath,index,"a health probe was answered")
         
+#--------------------Server changes-----------------------------
+
+    #Returns the index of the server of the ip, or None if there is none
+    def getServerIndex(self, ip):
+        return self.findServer(lambda server: server[1]==ip)
+
+    #Returns the servers which were not removed, as dictionaries for the server API (see Servers)
+    def describeServers(self):
+        res=[]
+        for i in range(0,len(self.servers)):
+            if i in self.removedServers:
+                continue
+            state="active"
+            if i in self.failedServers:
+                state="failed"
+            elif i in self.drainedServers:
+                state="drained"
+            (port,ip,mac)=self.servers[i]
+            res.append({"switch":self.id,"port":port,"ip":ip,"mac":mac,"weight":self.capacities[i],"state":state,
+                        "range":[Range.Int2IP(self.ranges[i].start),Range.Int2IP(self.ranges[i].end)] if i<len(self.ranges) else None})
+        return res
+
+    #Raises a ValueError if the switch is not balanced yet, or the server at the index is the last one new clients are sent to
+    def checkChange(self, index=None):
+        if not self.areFlowsSet:
+            raise ValueError("Switch %s is not balanced yet" % self.id)
+        if index is not None and not [i for i in range(0,len(self.servers)) if i!=index and self.inRotation(i)]:
+            raise ValueError("Server %s is the last server of switch %s in rotation" % (self.servers[index][1],self.id))
+
+    #Adds a server of the given (port, ip, mac) and weight. It takes the place of a removed server if there is one, and its range grows there,
+    #otherwise its range is added after the last one. Either way its addresses are taken from its neighbours only.
+    def addServer(self, dp, server, weight):
+        self.checkChange()
+        if weight<=0:
+            raise ValueError("The weight of a server should be positive")
+        if self.findServer(lambda s: s[0]==server[0] or s[1]==server[1] or s[2]==server[2]) is not None:
+            raise ValueError("Switch %s already has a server on port %d, ip %s or mac %s" % ((self.id,)+tuple(server)))
+        oldRanges=self.ranges
+        oldServers=self.getServers()
+        if self.removedServers:
+            index=min(self.removedServers)
+            self.removedServers.discard(index)
+            self.servers[index]=server
+            (self.weights[index],self.capacities[index])=(weight,weight)
+            self.setStandbys(set(self.failedServers)-set([index]))
+            self.setBounds(Failover.expandRange(self.getBounds(),index,self.getShare(index)))
+        else:
+            index=len(self.servers)
+            share=int(sum(r.end-r.start+1 for r in self.ranges)*weight/(weight+sum(self.capacities[i] for i in range(0,index) if self.inRotation(i))))
+            bounds=Servers.insertRange(self.getBounds(),index,share)
+            self.servers.append(server)
+            self.weights.append(weight)
+            self.capacities.append(weight)
+            self.numOfServers=len(self.servers)
+            if self.lastStats:
+                self.lastStats.append(0)
+            self.setBounds(bounds)
+        self.logger.info("Adding server %s to switch %s", server[1], self.id)
+        return self.changeServers(dp,oldRanges,oldServers,"add")
+
+    #Stops sending new clients to the server at the index, its range is given to its neighbours. Clients which are pinned to it stay there.
+    def drainServer(self, dp, index):
+        self.checkChange(index)
+        if index in self.drainedServers:
+            return None
+        oldRanges=self.ranges
+        oldServers=self.getServers()
+        self.drainedServers.add(index)
+        self.logger.info("Draining server %s of switch %s", self.servers[index][1], self.id)
+        return self.changeServers(dp,oldRanges,oldServers,"drain")
+
+    #Removes the server at the index. It is failed over for good - its range is given to its neighbours and the flows which were sent to it are sent
+    #to its standby - so the indices of the other ranges, and their flows, do not change.
+    def removeServer(self, dp, index):
+        self.checkChange(index)
+        oldRanges=self.ranges
+        oldServers=self.getServers()
+        self.removedServers.add(index)
+        self.drainedServers.discard(index)
+        self.missedProbes.pop(index,None)
+        self.downPorts.discard(self.servers[index][0])
+        self.setStandbys(set(self.failedServers)|set([index]))
+        self.logger.info("Removing server %s from switch %s", self.servers[index][1], self.id)
+        batch=self.changeServers(dp,oldRanges,oldServers,"remove")
+        #The clients pinned to the removed server stay with its standby, and do not follow a server which takes its place later
+        for (ip,pin) in self.pins.items():
+            if pin[0]==index:
+                self.pins[ip]=(self.failedServers[index],pin[1])
+        return batch
+
+    #Sets the weight of the server at the index and puts it back in rotation if it was drained. Its range grows or shrinks to its new share by moving
+    #its own boundaries, and the weight it was balanced to is scaled by the same factor.
+    def setServerWeight(self, dp, index, weight):
+        self.checkChange()
+        if weight<=0:
+            raise ValueError("The weight of a server should be positive")
+        oldRanges=self.ranges
+        oldServers=self.getServers()
+        self.weights[index]=self.weights[index]*weight/float(self.capacities[index])
+        self.capacities[index]=weight
+        self.drainedServers.discard(index)
+        if index not in self.failedServers:
+            self.setBounds(Servers.resizeRange(self.getBounds(),index,self.getShare(index)))
+        self.logger.info("Setting the weight of server %s of switch %s to %s", self.servers[index][1], self.id, weight)
+        return self.changeServers(dp,oldRanges,oldServers,"weight")
+
+    #Sends the flows of a server change, see updateFlows
+    def changeServers(self, dp, oldRanges, oldServers, change):
+        Metrics.registry.counter("server_changes_total",switch=self.id,change=change).inc()
+        return self.updateFlows(dp,oldRanges,oldServers)
+
 #--------------------Flow statistics----------------------------- 
 
-    #Starts a thread which will send stats requests to the switch
-    def flow_request(self, dp):
-        self.statTimerOn = True
-        monitor = stats.StatsMonitor(dp)
-        monitor.start()
+    #Creates a stats request about the RIDs table (or the prefix table) of the active bank, only flows with a RIDs cookie are asked for.
+    #While ranges are probed, all the flows are asked for, since the probes are in another table and have another cookie.
+    #In the group compilation, the counters of the group's buckets are asked for instead.
+    def createStatsRequest(self, dp):
+        if self.compilation=="group":
+            return SelectGroup.createStatsRequest(dp)
+        if self.probes:
+            return dp.ofproto_parser.OFPFlowStatsRequest(datapath=dp,table_id=dp.ofproto.OFPTT_ALL)
+        tables=self.getStatsTables()
+        return dp.ofproto_parser.OFPFlowStatsRequest(datapath=dp,table_id=tables[0] if len(tables)==1 else dp.ofproto.OFPTT_ALL,
+                                                     cookie=Flow.RID_COOKIE,cookie_mask=Flow.COOKIE_TYPE_MASK)
 
-    #Handle stats recieved from switch
-    @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
-    def _stats_reply_handler(self, ev):
-        packetCounts = []
-        msg = ev.msg
-        dp = msg.datapath
-        #print "Flow statistics:"
-        for stats in ev.msg.body:
-            packetCount = stats.packet_count
-            index = stats.cookie
-            tableID = stats.table_id
-            packetCounts.append((index,stats.packet_count))
-
-        #Packet count are represented as a tuple (id, count) and sorted by the id of the flow, which represents the id of the range
-        sorted_by_index = sorted(packetCounts, key=lambda tup: tup[0])
+    #Called with the full body of a stats reply
+    def flowStatsReceived(self, dp, body):
+        if self.compilation=="group":
+            #The packet counts of the servers are the counters of their buckets
+            packetCounts=SelectGroup.getPacketCounts(body)
+            if packetCounts is not None:
+                self.doBalancing(packetCounts, dp)
+            return
+        statsTables=self.getStatsTables()
+        ridStats=[stat for stat in body if stat.table_id in statsTables and (stat.cookie & Flow.COOKIE_TYPE_MASK)==Flow.RID_COOKIE]
+        #Stats which were requested before a bank switch are of the former ranges
+        if self.isRebalancing or (body and not ridStats):
+            return
+        if self.probes:
+            self.probesReceived(body)
+        #Packet counts are summed by the index of the range, found by the cookie of the flow
+        cookieToIndex=RidsTable.getCookieMap(len(self.ranges))
+        packetCounts=[0]*len(self.ranges)
+        self.pinPackets={}
+        for stat in ridStats:
+            index=cookieToIndex.get(stat.cookie)
+            if index is not None:
+                packetCounts[index]+=stat.packet_count
+                if LoadBalancingSwitch.affinityMode and Affinity.isPinTarget(stat,self.bank):
+                    self.pinPackets[index]=stat.packet_count
+        #Packets matched by a probe flow are not counted by the flows of its range
+        for (index,packets) in self.probePackets.items():
+            if index<len(packetCounts):
+                packetCounts[index]+=packets
 
         #Do rebalancig, if required
-        self.doBalancing(self.extractCounts(sorted_by_index), dp)
+        self.doBalancing(packetCounts, dp)
      
-    #Given a list of 2-tuples, returns a list of the second part of each tuple
-    def extractCounts(self, tuppleList):
-        res=[]
-        for i in range(0,len(tuppleList)):
-            res.append(tuppleList[i][1])
-        return res
             
             
 
@@ -1,18 +1,90 @@
-import threading,time
-
-#This class represents a thread which is used to ask statistics about the Rids table from the datapath every predetermined period of time, used for rebalancing the servers.
-
-class StatsMonitor(threading.Thread):
-    def __init__(self, dp):
-        super(StatsMonitor, self).__init__()
-        self.dp = dp
-          
-    def run(self):
-        interval=15
-        print "Stats will be sent every %d seconds!" % interval
-        print "-----\n"
-        dp = self.dp
-        while True:
-            time.sleep(interval)
-            stats = dp.ofproto_parser.OFPFlowStatsRequest(datapath=dp,table_id=4)
-            dp.send_msg(stats)
+import random,time
+from ryu.lib import hub
+from ryu.ofproto import ofproto_v1_3
+import Metrics
+
+#This file contains the scheduler used to ask statistics from the datapaths every predetermined period of time, used for rebalancing the servers.
+#All datapaths are served by green threads of a single scheduler, requests are tracked by their xid and multipart replies are
+#collected until their last part arrives, only then the full reply is handed to the callback.
+
+#A periodic statistics request of a single datapath
+class StatsJob(object):
+    def __init__(self,dp,interval,createRequest,callback,jitter):
+        self.dp=dp
+        self.interval=interval
+        self.createRequest=createRequest
+        self.callback=callback
+        self.jitter=jitter
+        self.active=True
+        self.thread=None
+        self.lastRoundTrip=None
+
+    #Returns the number of seconds until the next request, the interval moved randomly by up to the jitter
+    def nextDelay(self):
+        return max(0,self.interval+random.uniform(-self.jitter,self.jitter))
+
+#A request which was sent and waits for the last part of its reply
+class OutstandingRequest(object):
+    def __init__(self,job):
+        self.job=job
+        self.body=[]
+        self.sendTime=time.time()
+
+class StatsScheduler(object):
+    def __init__(self):
+        self.jobs={} #By datapath id
+        self.outstanding={} #By (datapath id, xid)
+
+    #Starts asking the datapath for statistics every interval seconds. createRequest is called with the datapath to create each request and callback
+    #is called with the datapath and the full reply body. A datapath has a single job, scheduling again replaces it.
+    def schedule(self,dp,interval,createRequest,callback,jitter=0):
+        self.cancel(dp)
+        job=StatsJob(dp,interval,createRequest,callback,jitter)
+        self.jobs[dp.id]=job
+        job.thread=hub.spawn(self.run,job)
+        return job
+
+    #Stops asking the datapath for statistics, replies of requests which were already sent are ignored
+    def cancel(self,dp):
+        job=self.jobs.pop(dp.id,None)
+        if job is None:
+            return
+        job.active=False
+        for key in [key for key in self.outstanding if self.outstanding[key].job is job]:
+            del self.outstanding[key]
+
+    def cancelAll(self):
+        for job in list(self.jobs.values()):
+            self.cancel(job.dp)
+
+    #The loop of a job's green thread
+    def run(self,job):
+        while job.active:
+            hub.sleep(job.nextDelay())
+            if job.active:
+                self.request(job)
+
+    #Sends a single request of a job, a former request of the job which was not answered by now is given up
+    def request(self,job):
+        dp=job.dp
+        for key in [key for key in self.outstanding if self.outstanding[key].job is job]:
+            del self.outstanding[key]
+        req=job.createRequest(dp)
+        dp.set_xid(req)
+        self.outstanding[(dp.id,req.xid)]=OutstandingRequest(job)
+        dp.send_msg(req)
+
+    #Should be called with every statistics reply. Returns true iff the reply belongs to a request of the scheduler.
+    def handleReply(self,msg):
+        key=(msg.datapath.id,msg.xid)
+        request=self.outstanding.get(key)
+        if request is None:
+            return False
+        request.body.extend(msg.body)
+        if msg.flags & ofproto_v1_3.OFPMPF_REPLY_MORE:
+            return True
+        del self.outstanding[key]
+        request.job.lastRoundTrip=time.time()-request.sendTime
+        Metrics.registry.histogram("stats_round_trip_seconds").observe(request.job.lastRoundTrip)
+        request.job.callback(msg.datapath,request.body)
+        return True
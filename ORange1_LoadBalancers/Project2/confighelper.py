@@ -40,7 +40,7 @@ def create_random_weight_servers(num_hosts):
     --mac option is assumed to have been used
     """
     rand_w = create_random_weights(num_hosts)
-    servers = [("00:00:00:00:00:%0.2x" % (i+1, ), "10.0.0.%d" % (i+1, ), rand_w[i] for i in xrange(num_hosts)]
+    servers = [("00:00:00:00:00:%0.2x" % (i+1, ), "10.0.0.%d" % (i+1, ), rand_w[i]) for i in xrange(num_hosts)]
 
     return servers
 
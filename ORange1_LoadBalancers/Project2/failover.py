@@ -0,0 +1,130 @@
+"""
+Failing over from servers that went away. A server fails when the switch port its MAC was learned
+on goes down or, if health probes are on, when it did not answer several ARP probes of the
+controller in a row.
+
+The range of a failed server is given to the live servers around it, half to each, so only the
+rules of these ranges are rewritten. The failed server keeps a placeholder range of
+FAILED_RANGE_SIZE addresses, and its rule in table 5 sends the packets of the placeholder (and of
+pins or probes of its range ID) to its standby - the nearest live server. All the rules are sent
+in a single batch, so a failover takes a single control round trip.
+"""
+
+from ryu.lib.packet import arp, ethernet, packet
+from ryu.ofproto import ofproto_v1_3, ether
+
+# The source MAC of the health probes. The replies of the servers to it are sent to the controller.
+HEALTH_MAC = "02:00:00:00:00:fe"
+# The source IP of the health probes. An ARP probe (RFC 5227) does not change the ARP caches of the
+# servers, and is answered to 0.0.0.0.
+HEALTH_IP = "0.0.0.0"
+HEALTH_PRIORITY = 100 # Above all the rules of table 0.
+FAILED_RANGE_SIZE = 2 # The addresses of the placeholder range of a failed server, the least a range may have.
+
+
+def is_port_down(msg):
+    """
+    Returns True if the port of a port status message went down - it was deleted, its link is
+    down or it was brought down by configuration.
+    """
+    ofproto = ofproto_v1_3
+    return (msg.reason == ofproto.OFPPR_DELETE or msg.desc.state & ofproto.OFPPS_LINK_DOWN != 0
+            or msg.desc.config & ofproto.OFPPC_PORT_DOWN != 0)
+
+
+def find_standby(position, failed, number_of_servers):
+    """
+    Returns the position of the live server nearest to the server at the position, the one
+    before it on a tie, or None if all the servers failed.
+    """
+    for distance in xrange(1, number_of_servers):
+        for candidate in (position - distance, position + distance):
+            if 0 <= candidate < number_of_servers and candidate not in failed:
+                return candidate
+    return None
+
+
+def aligned_address(low, high):
+    """
+    Returns the address from low to high with the most trailing zero bits, so a boundary there
+    needs the fewest prefixes.
+    """
+    for bits in xrange(31, 0, -1):
+        size = 2**bits
+        address = (low + size - 1) / size * size
+        if address <= high:
+            return address
+    return low
+
+
+def collapse_failed_ranges(ranges, failed):
+    """
+    Returns the (lower, upper) ranges where the addresses of every run of failed servers (by
+    position) are given to the live servers around it, half to each, and every failed server keeps
+    FAILED_RANGE_SIZE addresses between them. The boundaries of other ranges do not move. The
+    addresses are split near the middle, at an aligned address, so the prefix compilation changes
+    little.
+    """
+    ranges = [list(r) for r in ranges]
+    i = 0
+    while i < len(ranges):
+        if i not in failed:
+            i += 1
+            continue
+        first = i
+        while i < len(ranges) and i in failed:
+            i += 1
+        last = i - 1
+        if first == 0 and last == len(ranges) - 1:
+            break
+        (lower, upper) = (ranges[first][0], ranges[last][1])
+        free = upper - lower + 1 - (last - first + 1) * FAILED_RANGE_SIZE
+        if free < 0:
+            continue
+        if first == 0:
+            down = 0
+        elif last == len(ranges) - 1:
+            down = free
+        else:
+            down = aligned_address(lower + free / 4, lower + free - free / 4) - lower
+        if first > 0:
+            ranges[first - 1][1] = lower + down - 1
+        position = lower + down
+        for j in xrange(first, last + 1):
+            ranges[j] = [position, position + FAILED_RANGE_SIZE - 1]
+            position += FAILED_RANGE_SIZE
+        if last < len(ranges) - 1:
+            ranges[last + 1][0] = position
+    return [tuple(r) for r in ranges]
+
+
+def create_health_probe(server):
+    """
+    Returns the health probe of a server - an ARP request for its IP, sent to its MAC.
+    """
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(dst=server.mac, src=HEALTH_MAC, ethertype=ether.ETH_TYPE_ARP))
+    pkt.add_protocol(arp.arp(opcode=arp.ARP_REQUEST, src_mac=HEALTH_MAC, src_ip=HEALTH_IP, dst_mac="00:00:00:00:00:00",
+                             dst_ip=server.ip))
+    pkt.serialize()
+    return pkt.data
+
+
+def is_health_reply(pkt):
+    """
+    Returns True if a parsed packet is the reply of a server to a health probe.
+    """
+    arp_pkt = pkt.get_protocol(arp.arp)
+    return arp_pkt is not None and arp_pkt.opcode == arp.ARP_REPLY and arp_pkt.dst_mac == HEALTH_MAC
+
+
+def create_health_rule(datapath):
+    """
+    Creates the rule of table 0 that sends the replies to the health probes to the controller.
+    """
+    ofproto = datapath.ofproto
+    parser = datapath.ofproto_parser
+    match = parser.OFPMatch(eth_type=ether.ETH_TYPE_ARP, arp_op=arp.ARP_REPLY, eth_dst=HEALTH_MAC)
+    actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, ofproto.OFPCML_NO_BUFFER)]
+    instructions = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, actions)]
+    return parser.OFPFlowMod(datapath=datapath, priority=HEALTH_PRIORITY, match=match, instructions=instructions, table_id=0)
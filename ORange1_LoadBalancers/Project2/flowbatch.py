@@ -0,0 +1,140 @@
+import time
+
+from ryu.lib import hub
+
+import metrics
+
+# Maximal number of bytes written to the datapath at once.
+MAX_WRITE_SIZE = 65536
+
+
+class FlowBatch(object):
+    """
+    A batch of OpenFlow messages for a single datapath.
+
+    The messages are serialized together into large writes, and the batch is ended by a
+    barrier request. The batch is committed once the switch replies to the barrier, which
+    means that all the messages before it were applied.
+    """
+    # Batches which were sent and wait for their barrier reply, by (datapath id, barrier xid).
+    pending = {}
+
+    def __init__(self, datapath):
+        self.datapath = datapath
+        self.msgs = []
+        self.callbacks = []
+        self.xid = None
+        self.num_bytes = 0
+        self.create_time = time.time()
+        self.send_time = None
+        self.commit_time = None
+        self.committed = hub.Event()
+
+    def send_msg(self, msg):
+        """
+        Adds a message to the batch. It will be sent when the batch is committed.
+        """
+        self.msgs.append(msg)
+
+    def add_barrier(self):
+        """
+        Adds a barrier inside the batch. The switch applies all the messages before it before any message after it.
+        """
+        self.msgs.append(self.datapath.ofproto_parser.OFPBarrierRequest(self.datapath))
+
+    def add_callback(self, callback):
+        """
+        Registers a function to be called with this batch once the switch applied all of its messages.
+        """
+        if self.committed.is_set():
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def commit(self, callback=None):
+        """
+        Serializes all the messages, followed by a barrier request, and sends them to the
+        datapath using as few writes as possible.
+        """
+        if callback is not None:
+            self.add_callback(callback)
+        datapath = self.datapath
+        barrier = datapath.ofproto_parser.OFPBarrierRequest(datapath)
+        datapath.set_xid(barrier)
+        self.xid = barrier.xid
+        # Register before writing, the reply may arrive before this function returns.
+        FlowBatch.pending[(datapath.id, self.xid)] = self
+        self.send_time = time.time()
+        buf = bytearray()
+        for msg in self.msgs + [barrier]:
+            if msg.xid is None:
+                datapath.set_xid(msg)
+            metrics.count_message(msg)
+            msg.serialize()
+            buf += msg.buf
+            if len(buf) >= MAX_WRITE_SIZE:
+                self._write(buf)
+                buf = bytearray()
+        if len(buf) > 0:
+            self._write(buf)
+        return self
+
+    def _write(self, buf):
+        self.num_bytes += len(buf)
+        self.datapath.send(bytes(buf))
+
+    def done(self):
+        """
+        Marks the batch as committed and runs its callbacks.
+        """
+        self.commit_time = time.time()
+        self.committed.set()
+        callbacks = self.callbacks
+        self.callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def wait(self, timeout=None):
+        """
+        Blocks the calling green thread until the batch is committed.
+        Returns True iff it was committed in time.
+        """
+        return self.committed.wait(timeout)
+
+    def elapsed(self):
+        """
+        Returns the number of seconds from the creation of the batch until the switch
+        committed it, or None if it was not committed yet.
+        """
+        if self.commit_time is None:
+            return None
+        return self.commit_time - self.create_time
+
+
+def handle_barrier_reply(msg):
+    """
+    Marks the batch that waits for the given barrier reply as committed.
+    Returns the batch, or None if no batch waits for this reply.
+    """
+    batch = FlowBatch.pending.pop((msg.datapath.id, msg.xid), None)
+    if batch is not None:
+        batch.done()
+        metrics.registry.histogram("batch_commit_seconds").observe(batch.elapsed())
+    return batch
+
+
+def drop_datapath(datapath_id):
+    """
+    Forgets the batches of a datapath that disconnected, as their barrier replies will never arrive.
+    Returns the forgotten batches.
+    """
+    keys = [key for key in FlowBatch.pending if key[0] == datapath_id]
+    return [FlowBatch.pending.pop(key) for key in keys]
+
+
+def count_changes(batch):
+    """
+    Returns the number of flow mods and group mods in a batch.
+    """
+    parser = batch.datapath.ofproto_parser
+    return len([msg for msg in batch.msgs if isinstance(msg, (parser.OFPFlowMod, parser.OFPGroupMod))])
@@ -0,0 +1,111 @@
+"""
+The journal of the re-partitioning decisions - an append-only binary file that records every
+stats sample, the deltas and weights computed from it and the rules a re-partitioning emitted, so
+the policy can be replayed offline against real traffic (see Tools/replay.py).
+
+The file starts with a magic and is followed by records. Each record is a header (type, time,
+datapath ID, number of values) followed by its values, whose format depends on the type. The
+format is shared with the journal of Project1. A record that was cut by a crash is ignored by
+the reader.
+"""
+
+import struct
+import time
+
+MAGIC = "ORJ1"
+HEADER = struct.Struct("!BdQH")
+
+CONFIG = 1 # The policy constants of the controller, in the order of its CONFIG_NAMES.
+SAMPLE = 2 # The packet counts of the servers, as read from the switch.
+RANGES = 3 # The (lower, upper) of the range of every server when the sample was read, flattened.
+DELTAS = 4 # The packets of every server in the last interval.
+WEIGHTS = 5 # The weights of the servers after the sample was handled.
+DIFF = 6 # The messages a re-partitioning emitted - rules added, rules deleted and groups modified.
+MODES = 7 # The modes of the controller that change its rules, in the order of its CONFIG_MODES (see encode_modes).
+
+# The format of a single value of every record type.
+FORMATS = {CONFIG: "d", SAMPLE: "Q", RANGES: "I", DELTAS: "q", WEIGHTS: "d", DIFF: "I", MODES: "d"}
+
+
+class Journal(object):
+    """
+    A journal file that records are appended to.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+    def write(self, record_type, dpid, values, now=None):
+        """
+        Appends a record. The values are written by the format of its type.
+        """
+        now = time.time() if now is None else now
+        values = list(values)
+        self.file.write(HEADER.pack(record_type, now, dpid, len(values)) +
+                        struct.pack("!%d%s" %(len(values), FORMATS[record_type]), *values))
+
+    def flush(self):
+        """
+        Makes all the records written so far reach the file. Called once all the records of a
+        sample were written.
+        """
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_journal(path):
+    """
+    Returns the (type, time, datapath ID, values) records of a journal file, in the order they
+    were written.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("%s is not a rebalance journal" %(path, ))
+    records = []
+    offset = len(MAGIC)
+    while offset + HEADER.size <= len(data):
+        (record_type, record_time, dpid, count) = HEADER.unpack_from(data, offset)
+        body = struct.Struct("!%d%s" %(count, FORMATS[record_type]))
+        if offset + HEADER.size + body.size > len(data):
+            break
+        records += [(record_type, record_time, dpid, list(body.unpack_from(data, offset + HEADER.size)))]
+        offset += HEADER.size + body.size
+    return records
+
+
+def encode_modes(obj, modes):
+    """
+    Returns the values of a MODES record, given the (name, choices) of every mode. A mode is
+    recorded as the index of its value among its choices, or as its value if it has no choices.
+    """
+    return [getattr(obj, name) if choices is None else list(choices).index(getattr(obj, name)) for (name, choices) in modes]
+
+
+def apply_modes(obj, modes, values):
+    """
+    Sets the modes of a MODES record, given the (name, choices) of every mode, back on obj.
+    """
+    for ((name, choices), value) in zip(modes, values):
+        if choices is None:
+            setattr(obj, name, type(getattr(obj, name))(value))
+        else:
+            setattr(obj, name, choices[int(value)])
+
+
+def batch_diff(batch):
+    """
+    Returns the number of rules added, rules deleted and groups modified by the messages of a batch.
+    """
+    if batch is None:
+        return [0, 0, 0]
+    ofproto = batch.datapath.ofproto
+    parser = batch.datapath.ofproto_parser
+    flow_mods = [msg for msg in batch.msgs if isinstance(msg, parser.OFPFlowMod)]
+    added = len([msg for msg in flow_mods if msg.command in (ofproto.OFPFC_ADD, ofproto.OFPFC_MODIFY, ofproto.OFPFC_MODIFY_STRICT)])
+    groups = len([msg for msg in batch.msgs if isinstance(msg, parser.OFPGroupMod)])
+    return [added, len(flow_mods) - added, groups]
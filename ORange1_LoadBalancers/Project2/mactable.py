@@ -0,0 +1,107 @@
+"""
+The MAC table of the learning switch, bounded in size and in age.
+
+A MAC is forgotten once it was not seen as a source for ttl seconds while the switch has no
+learning rules toward it, or once the table is full and it is the least recently seen. A host
+whose traffic is forwarded by its rules sends no packet-ins, so its MAC ages only once its last
+rule was removed. The table also keeps the in ports of the learning rules
+installed toward each MAC, so the rules of a forgotten MAC are deleted from the switch only when
+there are any, and the switch never forwards by a MAC the controller forgot.
+"""
+
+import collections
+import time
+
+
+class MacTable(object):
+    """
+    The MAC table of a single datapath.
+    """
+    def __init__(self, capacity, ttl):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = collections.OrderedDict() # MAC -> (port, last seen), the least recently seen first.
+        self.flows = {} # MAC -> in ports of the learning rules toward it.
+
+    def __len__(self):
+        return len(self.entries)
+
+    def learn(self, mac, port, now=None):
+        """
+        Records that mac was seen on port. Returns the MACs whose rules should be deleted from the
+        switch - the MACs evicted to keep the table within its capacity, and mac itself if it
+        moved to another port.
+        """
+        now = time.time() if now is None else now
+        forgotten = []
+        old = self.entries.pop(mac, None)
+        if old is not None and old[0] != port and self.flows.pop(mac, None):
+            forgotten += [mac]
+        self.entries[mac] = (port, now)
+        while len(self.entries) > self.capacity:
+            forgotten += self.remove(next(iter(self.entries)))
+        return forgotten
+
+    def lookup(self, mac):
+        """
+        Returns the port of mac, or None if it is unknown.
+        """
+        entry = self.entries.get(mac)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def expire(self, now=None):
+        """
+        Forgets the MACs that were not seen for ttl seconds and have no learning rules on the switch.
+        The ones that still have rules are in use, and are treated as seen now. Returns the MACs
+        whose rules should be deleted from the switch - none, as only MACs without rules are forgotten.
+        """
+        now = time.time() if now is None else now
+        forgotten = []
+        expired = []
+        for (mac, (port, last_seen)) in self.entries.iteritems():
+            if now - last_seen < self.ttl:
+                break
+            expired += [mac]
+        for mac in expired:
+            if mac in self.flows:
+                self.touch(mac, now)
+            else:
+                forgotten += self.remove(mac)
+        return forgotten
+
+    def touch(self, mac, now=None):
+        """
+        Records that mac is still in use on its port, if it is known.
+        """
+        entry = self.entries.pop(mac, None)
+        if entry is not None:
+            self.entries[mac] = (entry[0], time.time() if now is None else now)
+
+    def remove(self, mac):
+        """
+        Forgets mac. Returns [mac] if there are rules toward it to delete, and an empty list otherwise.
+        """
+        self.entries.pop(mac, None)
+        if self.flows.pop(mac, None):
+            return [mac]
+        return []
+
+    def add_flow(self, mac, in_port):
+        """
+        Records a learning rule from in_port toward mac.
+        """
+        self.flows.setdefault(mac, set()).add(in_port)
+
+    def flow_removed(self, mac, in_port):
+        """
+        Records that the learning rule from in_port toward mac was removed from the switch. Once its
+        last rule was removed, mac starts to age from now.
+        """
+        in_ports = self.flows.get(mac)
+        if in_ports is not None:
+            in_ports.discard(in_port)
+            if not in_ports:
+                del self.flows[mac]
+                self.touch(mac)
@@ -0,0 +1,213 @@
+"""
+The metrics of the load balancer - counters, gauges and histograms of its hot paths, kept in a
+single registry.
+
+They are read in-process through the registry, or as text from the /metrics page of Ryu's web
+server (in the Prometheus text format), to tell when the controller rather than the switch
+becomes the bottleneck. An instrument is identified by its name and its labels, given as keyword
+arguments, e.g. registry.counter("flow_mods_total", table=1).
+"""
+
+import functools
+import threading
+import time
+
+from ryu.app.wsgi import ControllerBase, route
+from ryu.ofproto import ofproto_v1_3_parser
+from webob import Response
+
+# Default bucket bounds of histograms of durations, in seconds.
+TIME_BOUNDS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# Default bucket bounds of histograms of counts.
+COUNT_BOUNDS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+
+class Counter(object):
+    """
+    A value that only grows.
+    """
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [("", {}, self.value)]
+
+
+class Gauge(object):
+    """
+    A value that is set.
+    """
+    kind = "gauge"
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        return [("", {}, self.value)]
+
+
+class Histogram(object):
+    """
+    Counts observed values in buckets - each bucket counts the values up to its bound - and keeps
+    their count and sum.
+    """
+    kind = "histogram"
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * len(self.bounds)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i in xrange(len(self.bounds)):
+            if value <= self.bounds[i]:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, share):
+        """
+        Returns the bound below which the given share of the observed values are.
+        """
+        seen = 0
+        for i in xrange(len(self.bounds)):
+            seen += self.counts[i]
+            if seen >= share * self.count and seen > 0:
+                return self.bounds[i]
+        return float("inf")
+
+    def samples(self):
+        result = []
+        cumulative = 0
+        for (bound, count) in zip(self.bounds, self.counts):
+            cumulative += count
+            result += [("_bucket", {"le": repr(bound)}, cumulative)]
+        result += [("_bucket", {"le": "+Inf"}, self.count), ("_sum", {}, self.sum), ("_count", {}, self.count)]
+        return result
+
+
+class Timer(object):
+    """
+    Measures the time of the code inside a with statement into a histogram.
+    """
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.elapsed = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time.time() - self.start
+        self.histogram.observe(self.elapsed)
+        return False
+
+
+class Registry(object):
+    """
+    All the instruments, by (name, labels).
+    """
+    def __init__(self):
+        self.instruments = {}
+        self.lock = threading.Lock()
+
+    def _get(self, factory, name, labels):
+        key = (name, tuple(sorted((k, str(v)) for (k, v) in labels.items())))
+        instrument = self.instruments.get(key)
+        if instrument is None:
+            with self.lock:
+                instrument = self.instruments.setdefault(key, factory())
+        return instrument
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name, **labels):
+        return self._get(Gauge, name, labels)
+
+    def histogram(self, name, bounds=TIME_BOUNDS, **labels):
+        return self._get(lambda: Histogram(bounds), name, labels)
+
+    def timer(self, name, **labels):
+        """
+        Returns a timer for a with statement, whose time is observed by the histogram of the name
+        and labels.
+        """
+        return Timer(self.histogram(name, TIME_BOUNDS, **labels))
+
+    def snapshot(self):
+        """
+        Returns a dictionary from every (name, labels) to the value of its instrument, or to the
+        number of observed values for histograms.
+        """
+        result = {}
+        for (key, instrument) in self.instruments.items():
+            result[key] = instrument.count if instrument.kind == "histogram" else instrument.value
+        return result
+
+    def render(self):
+        """
+        Returns the text of all the instruments, in the Prometheus text format.
+        """
+        lines = []
+        typed = set()
+        for ((name, labels), instrument) in sorted(self.instruments.items()):
+            if name not in typed:
+                lines += ["# TYPE %s %s" %(name, instrument.kind)]
+                typed.add(name)
+            for (suffix, extra, value) in instrument.samples():
+                text = ",".join('%s="%s"' %(k, v) for (k, v) in list(labels) + sorted(extra.items()))
+                lines += ["%s%s%s %s" %(name, suffix, "{%s}" %(text, ) if text else "", value)]
+        return "\n".join(lines) + "\n"
+
+
+# The registry of the load balancer.
+registry = Registry()
+
+
+def timed(name, **labels):
+    """
+    Returns a decorator that measures every call of a function into the histogram of the name
+    and labels.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with registry.timer(name, **labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_message(msg):
+    """
+    Counts a message sent to a switch - flow mods by their table and group mods by their group.
+    """
+    if isinstance(msg, ofproto_v1_3_parser.OFPFlowMod):
+        registry.counter("flow_mods_total", table=msg.table_id).inc()
+    elif isinstance(msg, ofproto_v1_3_parser.OFPGroupMod):
+        registry.counter("group_mods_total", group=msg.group_id).inc()
+
+
+class MetricsController(ControllerBase):
+    """
+    Serves the text of the registry. It is registered with Ryu's web server by MicDekLoad.
+    """
+    def __init__(self, req, link, data, **config):
+        super(MetricsController, self).__init__(req, link, data, **config)
+        self.registry = data
+
+    @route("metrics", "/metrics", methods=["GET"])
+    def metrics(self, req, **kwargs):
+        return Response(content_type="text/plain", body=self.registry.render())
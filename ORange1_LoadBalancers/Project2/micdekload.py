@@ -13,20 +13,95 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import math
-import thread
-import time
-from random import random
 
+from ryu import cfg
+from ryu.app.wsgi import WSGIApplication, DEFAULT_WSGI_HOST
 from ryu.base import app_manager
 from ryu.controller import ofp_event
-from ryu.controller.handler import set_ev_cls, CONFIG_DISPATCHER, MAIN_DISPATCHER
-from ryu.controller.ofp_event import EventOFPFlowStatsReply
-from ryu.lib.packet import ethernet, packet
+from ryu.controller.handler import set_ev_cls, CONFIG_DISPATCHER, MAIN_DISPATCHER, DEAD_DISPATCHER
+from ryu.controller.ofp_event import EventOFPBarrierReply, EventOFPFlowStatsReply, EventOFPGroupStatsReply
+from ryu.lib import hub
+from ryu.lib.packet import arp, ethernet, ipv4, packet
 from ryu.ofproto import ofproto_v1_3, ether
 
 import confighelper
+import failover
+import flowbatch
+import journal
 import loadbalancerconfig
+import mactable
+import metrics
+import prefixcover
+import rangealloc
+import selectgroup
+import serverapi
+import serverregistry
+import statsscheduler
+
+
+def create_comparator_metas():
+    """
+    Creates metadata information and masks for the comparator tables (m<=end and m>start).
+    """
+    # This holds tuples of: metadata to match, a string representation of IP to match,
+    # and the mask for this match ("000...1...000"). The last parameter is a boolean, whether the
+    # metadata in this index should be bigger or smaller than the IP.
+    metas = []
+
+    for i in xrange(32):
+        #              METADATA                       IP                          MASK                        M>=P
+        metas += [(int("0"*i + "1" + "0"*(32-i-1),2), "0"*i + "0" + "0"*(32-i-1), "0"*i + "1" + "0"*(32-i-1), True)]
+        metas += [(int("0"*i + "0" + "0"*(32-i-1),2), "0"*i + "1" + "0"*(32-i-1), "0"*i + "1" + "0"*(32-i-1), False)]
+    # Wildcard rule.
+    metas += [(int("0"*32,2), "0"*32, "0"*32, True)]
+    return metas
+
+
+def create_comparator_rules(metas):
+    """
+    Converts the comparator metas into ready to use rules for tables 2 and 4.
+    Each rule is a tuple of: metadata, metadata mask, source IP, source IP mask, priority,
+    the table to go to from table 2 and the table to go to from table 4 (None for discard).
+    """
+    rules = []
+    comparator_priority = 65
+    for meta in metas:
+        if meta[3]:
+            # m >= p - in table 2, found a match. in table 4, discard
+            goto2 = 5
+            goto4 = None # This should never happen! We missed a rule.
+            if meta == metas[-1]: # If in the wildcard meta, send also from table 4.
+                goto4 = goto2
+        else:
+            # m < p - in table 2, no match, move to table 3. in table 4, found a match.
+            goto2 = 3
+            goto4 = 5
+
+        # Create a string representation of the source IP.
+        vals = [ str(int(meta[1][i*8:i*8+8], 2)) for i in xrange(4)]
+        src_ipv4 = ".".join(vals)
+        # Create the masks for the metadata (as a number) and the IP (as a string).
+        vals = [ str(int(meta[2][i*8:i*8+8], 2)) for i in xrange(4)]
+        meta_mask = int(meta[2], 2)
+        src_mask = ".".join(vals)
+
+        rules += [(meta[0], meta_mask, src_ipv4, src_mask, comparator_priority, goto2, goto4)]
+        comparator_priority-=1
+    return tuple(rules)
+
+
+# The comparator tables never change, so they are computed once and shared by all the datapaths.
+COMPARATOR_METAS = tuple(create_comparator_metas())
+COMPARATOR_RULES = create_comparator_rules(COMPARATOR_METAS)
+
+# The policy constants recorded at the start of the journal, in this order.
+CONFIG_NAMES = ("stats_interval", "imbalance_ratio", "min_partition_packets", "boundary_tolerance")
+# The modes recorded after the constants, as (name, choices), since they change the rules of every
+# re-partition. Modes without choices are recorded by their value.
+CONFIG_MODES = (("compilation_mode", ("elcp", "prefix", "auto", "group")), ("affinity_mode", (False, True)),
+                ("heavy_hitter_mode", (False, True)), ("lookup_cost", None), ("recompile_margin", None), ("num_of_probes", None))
 
 
 class MicDekLoad(app_manager.RyuApp):
@@ -36,31 +111,122 @@ class MicDekLoad(app_manager.RyuApp):
     Written by Michal Shagam and Dekel Auster.
     """
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
+    _CONTEXTS = {'wsgi': WSGIApplication}
+    stats_interval = 3 # Seconds between flow stats requests.
+    stats_jitter = 0.5 # Maximal random change of the interval, so requests of many switches are spread.
+    # How the ranges are compiled into rules - "elcp" (tables 1-4), "prefix" (the CIDR prefixes
+    # of each range in table 1) or "auto" (the cheaper of the two for the ranges, chosen again on
+    # every re-partition).
+    # In "group" mode there are no ranges - a weighted select group balances the traffic (see
+    # selectgroup), and switches that do not support it fall back to "auto".
+    compilation_mode = "auto"
+    lookup_cost = 64 # The cost of a table lookup when choosing the compilation, in rules.
+    # A re-partition changes the compilation only when the other one is cheaper by this fraction, so
+    # ranges near the break-even point do not rewrite all the rules on every re-partition.
+    recompile_margin = 0.05
+    imbalance_ratio = 2 # Re-partition when the load of a server, relative to its weight, is this many times another's.
+    min_partition_packets = 100 # Do not re-partition by intervals with fewer packets, they are mostly noise.
+    boundary_tolerance = 0.02 # A boundary is kept when re-partitioning would move it by less than this share of its ranges.
+    max_traffic_segments = 16 # Maximal number of segments of the traffic estimate, for each server.
+    # Whether clients whose address moves to another server on re-partitioning are pinned to their
+    # former server, until they are idle for pin_idle_timeout seconds.
+    affinity_mode = False
+    pin_idle_timeout = 10
+    pin_priority = 1000 # Above all the range rules of table 1.
+    max_clients = 10000 # Maximal number of client addresses that are remembered for pinning.
+    # Whether the ranges of overloaded servers are probed before re-partitioning: sub-prefixes of
+    # each range are counted by temporary rules for an interval, so the traffic estimate learns
+    # where inside the range the traffic comes from.
+    heavy_hitter_mode = False
+    num_of_probes = 16 # Number of probe rules of an overloaded range.
+    probe_priority = 500 # Above the range rules of table 1 and below the pins.
+    # A histogram of client addresses (see rangealloc.load_histogram) by which the first ranges
+    # are placed. When there is none the clients seen so far are used, and when no client is
+    # known the ranges are proportional to the weights.
+    client_histogram = None
+    # The MAC table of the learning switch of each datapath is bounded by mac_table_size, and a
+    # MAC that was not seen as a source for mac_ttl seconds is forgotten once it has no learning
+    # rules left. The learning rules expire once idle for learn_idle_timeout seconds.
+    mac_table_size = 4096
+    mac_ttl = 300
+    learn_idle_timeout = 60
+    # Path of the journal (see journal) that every stats sample and the decision taken by it are
+    # appended to, or None for no journal.
+    journal_path = None
+    # A server fails over to its neighbours (see failover) once the port its MAC was learned on goes
+    # down. If health_interval is set, the controller also sends the servers an ARP probe every
+    # health_interval seconds, and a server that did not answer health_misses probes in a row fails.
+    health_interval = None
+    health_misses = 3
+    # The REST API (see serverapi) changes the servers without authentication, so Ryu's web server
+    # listens on api_host unless another address is given with --wsapi-host. Set it to "0.0.0.0"
+    # to serve every interface, only on a trusted management network.
+    api_host = "127.0.0.1"
+
     def __init__(self, *args, **kwargs):
         super(MicDekLoad, self).__init__(*args, **kwargs)
-        self.mac_to_port = {} # Used by the learning switch, for packets when not handled by the LB.
+        self.mac_to_port = {} # Used by the learning switch, for packets when not handled by the LB. The mactable.MacTable of each datapath, by datapath ID.
         self.numberOfRules = 0
         self.changedRules = 0
         self.virtual_mac = loadbalancerconfig.virtual_server[0] # Virtual MAC Address of the LB.
         self.virtual_ip = loadbalancerconfig.virtual_server[1] # Virtual IP of the LB.
-        self.servers = loadbalancerconfig.servers # List of tuples: (MAC, IP, weight) of the servers.
-        self.number_of_servers = len(loadbalancerconfig.servers) # Number of servers.
+        self.servers = serverregistry.ServerRegistry(loadbalancerconfig.servers) # The servers, indexed by MAC, IP, range ID and cookie.
+        self.number_of_servers = len(self.servers) # Number of servers.
         self.num_packets = [0] * self.number_of_servers # Number of packets processed by each server. 
         self.ranges = [] # Range separation of the servers.
+        self.compilation = "elcp" # The compilation of the ranges in use, chosen when the rules are created.
+        self.traffic = [] # Estimated traffic over the address space, as rangealloc segments.
+        self.histogram = None # The client addresses loaded from client_histogram.
+        self.clients = collections.OrderedDict() # Client IPs seen by the controller, the least recently seen first.
+        self.pins = {} # The pinned clients of each datapath, by datapath ID. Each is a dictionary from client IP to range ID.
+        self.probes = {} # The installed probe rules of each datapath, by datapath ID. Each is a dictionary from cookie to (lower, upper).
+        self.probe_packets = {} # The probes counted in the last stats reply of each datapath, by datapath ID, as rangealloc segments.
+        self.batches = {} # The open batch of flow messages of each datapath, by datapath ID.
+        self.stats_scheduler = statsscheduler.StatsScheduler()
+        self.last_packets = {} # The packet counts of the former stats reply of each datapath, by datapath ID.
+        self.skip_partition = {} # Whether to skip re-partitioning in the next stats reply, by datapath ID.
+        self.groups = {} # The bucket weights of each datapath balanced by a select group, by datapath ID.
+        self.switches = {} # The connected datapaths, and the balanced ones, by datapath ID.
+        self.balanced = set() # The IDs of the datapaths balanced by the controller.
+        self.failed = {} # The standby server of each failed server, by the range ID of the failed server.
+        self.drained = set() # The range IDs of the servers that get no new clients (see drain_server).
+        self.missed_probes = {} # The health probes each server did not answer in a row, by range ID.
+        self.metrics = metrics.registry # Served as text at /metrics by Ryu's web server.
+        self.journal = None
+        if self.journal_path is not None:
+            self.journal = journal.Journal(self.journal_path)
+            self.journal.write(journal.CONFIG, 0, [getattr(self, name) for name in CONFIG_NAMES])
+            self.journal.write(journal.MODES, 0, journal.encode_modes(self, CONFIG_MODES))
+            self.journal.flush()
+        if 'wsgi' in kwargs:
+            if cfg.CONF.wsapi_host == DEFAULT_WSGI_HOST:
+                cfg.CONF.set_override('wsapi_host', self.api_host)
+            kwargs['wsgi'].register(metrics.MetricsController, self.metrics)
+            kwargs['wsgi'].register(serverapi.ServerController, self)
+        if self.health_interval is not None:
+            hub.spawn(self.check_health)
         
 
     def create_first_ranges(self):
         """
-        Returns a preliminary range separation of the servers.
+        Returns a preliminary range separation of the servers. If the distribution of the clients
+        is known, the boundaries are at its weighted quantiles, and it is the first estimate of
+        the traffic. Otherwise the ranges are proportional to the weights.
         """
+        clients = self.client_distribution()
+        if clients:
+            if not self.traffic:
+                self.traffic = clients
+            return rangealloc.allocate_ranges(clients, self.servers.weights())
         ranges = []
         start = 0
         end = 0
         random_weights = confighelper.create_random_weights(self.number_of_servers) 
 
-        # Create (start, end) tuple for each server.
+        # Create (start, end) tuple for each server. The weights may no longer sum up to 1 once servers were added at runtime.
+        total_weight = sum(self.servers.weights())
         for i in xrange(self.number_of_servers):
-            weight = self.servers[i][2]
+            weight = self.servers[i].weight / total_weight
             end = start + int(math.floor((2**32 - 1) * weight))
             ranges += [(start, end)]
             start = end + 1
@@ -69,22 +235,28 @@ class MicDekLoad(app_manager.RyuApp):
         return ranges
 
 
+    def client_distribution(self):
+        """
+        Returns the distribution of client addresses as rangealloc segments, from the histogram
+        file if there is one and from the clients seen so far otherwise. Returns an empty list
+        if no client is known.
+        """
+        if self.client_histogram is not None:
+            if self.histogram is None:
+                self.histogram = rangealloc.load_histogram(self.client_histogram)
+            points = self.histogram
+        else:
+            points = [(prefixcover.ipv4_to_int(ip), prefixcover.ipv4_to_int(ip), 1) for ip in self.clients]
+        if not points:
+            return []
+        return rangealloc.histogram_segments(points)
+
+
     def create_comparator_metas(self):
         """
-        Creates metadata information and masks for the comparator tables (m<=end and m>start).
+        Returns the metadata information and masks for the comparator tables (m<=end and m>start).
         """
-        # This holds tuples of: metadata to match, a string representation of IP to match,
-        # and the mask for this match ("000...1...000"). The last parameter is a boolean, whether the
-        # metadata in this index should be bigger or smaller than the IP.
-        metas = []
-       
-        for i in xrange(32):
-            #              METADATA                       IP                          MASK                        M>=P
-            metas += [(int("0"*i + "1" + "0"*(32-i-1),2), "0"*i + "0" + "0"*(32-i-1), "0"*i + "1" + "0"*(32-i-1), True)]
-            metas += [(int("0"*i + "0" + "0"*(32-i-1),2), "0"*i + "1" + "0"*(32-i-1), "0"*i + "1" + "0"*(32-i-1), False)]
-        # Wildcard rule.
-        metas += [(int("0"*32,2), "0"*32, "0"*32, True)]
-        return metas
+        return list(COMPARATOR_METAS)
 
     def create_rule_set(self, datapath):
         """
@@ -96,14 +268,28 @@ class MicDekLoad(app_manager.RyuApp):
         2, 4 - comparators. receive the metadata from tables 1 and 3 (respectively), and if the 
                compare is successful, forwards to the given range.
         5 - changes destination IP and MAC to the requested server, according to the given range ID.
+
+        In the prefix compilation, table 1 holds the CIDR prefixes of each range and forwards
+        straight to table 5, and tables 2-4 are empty.
         """
+        self.ranges = self.create_first_ranges()
+        self.shrink_failed_ranges()
+        self.add_balanced(datapath)
+        self.compilation = self.choose_compilation()
+        print "Compiling %d ranges into %s rules" %(len(self.ranges), self.compilation)
+        self.begin_batch(datapath)
         self.build_table_0(datapath)
-        self.build_table_1_3(datapath)
-        self.build_table_2_4(datapath)
+        if self.compilation == "prefix":
+            self.build_prefix_table(datapath)
+        else:
+            self.build_table_1_3(datapath)
+            self.build_table_2_4(datapath)
         self.build_table_5(datapath)
         print "The number of rules is: %d" %(self.numberOfRules, )
+        return self.commit_batch(datapath, self.rules_committed)
 
 
+    @metrics.timed("build_table_seconds", table="0")
     def build_table_0(self, datapath):
         """
         Builds table 0, as defined in create_rule_set doc.
@@ -115,14 +301,24 @@ class MicDekLoad(app_manager.RyuApp):
         self.add_flow_to_table(datapath, 1, parser.OFPMatch(eth_type=ether.ETH_TYPE_IP, ipv4_dst=self.virtual_ip), [], [parser.OFPInstructionGotoTable(1)], 0)
         self.numberOfRules +=1
         # Create rule to change src for each server to the LB IP and MAC.
-        for i in xrange(self.number_of_servers):
-            actions = [parser.OFPActionSetField(eth_src=self.virtual_mac),
-                       parser.OFPActionSetField(ipv4_src=self.virtual_ip),
-                       parser.OFPActionOutput(ofproto.OFPP_NORMAL, )]
-            self.add_flow_to_table(datapath, 2, parser.OFPMatch(eth_type = ether.ETH_TYPE_IP, ipv4_src=self.servers[i][1]), actions, [], 0)
+        for server in self.servers:
+            self.add_source_rule(datapath, server)
             self.numberOfRules +=1
 
+
+    def add_source_rule(self, datapath, server):
+        """
+        Adds the rule of table 0 that changes the source of the replies of a server to the LB IP and MAC.
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        actions = [parser.OFPActionSetField(eth_src=self.virtual_mac),
+                   parser.OFPActionSetField(ipv4_src=self.virtual_ip),
+                   parser.OFPActionOutput(ofproto.OFPP_NORMAL, )]
+        self.add_flow_to_table(datapath, 2, parser.OFPMatch(eth_type = ether.ETH_TYPE_IP, ipv4_src=server.ip), actions, [], 0)
+
         
+    @metrics.timed("build_table_seconds", table="1_3")
     def build_table_1_3(self, datapath):
         """
         Builds tables 1 and 3, as defined in create_rule_set doc.
@@ -135,18 +331,24 @@ class MicDekLoad(app_manager.RyuApp):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
-        self.ranges = self.create_first_ranges()
-
         # Add one rule (of the LCP+1) for each server, for tables 1 and 3.
         for i in xrange(self.number_of_servers):
-            self.add_rules_to_1_3(datapath, self.ranges[i][0], self.ranges[i][1], i)
+            self.add_rules_to_1_3(datapath, self.ranges[i][0], self.ranges[i][1], self.servers[i].range_id)
             self.numberOfRules +=2
 
         # If no match was found in table 1, move to table 3.
-        self.add_flow_to_table(datapath, 0, parser.OFPMatch(), [], [parser.OFPInstructionGotoTable(3)], 1)
+        self.add_table_1_miss(datapath)
         self.numberOfRules +=1
 
+    def add_table_1_miss(self, datapath):
+        """
+        Adds the table miss rule of table 1 of the ELCP compilation, which moves to table 3.
+        """
+        parser = datapath.ofproto_parser
+        self.add_flow_to_table(datapath, 0, parser.OFPMatch(), [], [parser.OFPInstructionGotoTable(3)], 1)
+
 
+    @metrics.timed("build_table_seconds", table="2_4")
     def build_table_2_4(self, datapath):
         """
         Builds tables 2 and 4, as defined in create_rule_set doc.
@@ -155,51 +357,75 @@ class MicDekLoad(app_manager.RyuApp):
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
-        metas = self.create_comparator_metas()
+        for (meta, meta_mask, src_ipv4, src_mask, priority, goto2, goto4) in COMPARATOR_RULES:
+            instructions2 = [parser.OFPInstructionGotoTable(goto2)]
+            instructions4 = []
+            if goto4 is not None:
+                instructions4 = [parser.OFPInstructionGotoTable(goto4)]
 
-        comparator_priority = 65
-        for meta in metas:
-            if meta[3]:
-                # m >= p - in table 2, found a match. in table 4, discard
-                instructions2 = [parser.OFPInstructionGotoTable(5)]
-                instructions4 = [] # This should never happen! We missed a rule.
-                if meta == metas[-1]: # If in the wildcard meta, send also from table 4.
-                    instructions4 = instructions2
-            else:
-                # m < p - in table 2, no match, move to table 3. in table 4, found a match.
-                instructions2 = [parser.OFPInstructionGotoTable(3)]
-                instructions4 = [parser.OFPInstructionGotoTable(5)]
-                
-            # Create a string representation of the source IP.
-            vals = [ str(int(meta[1][i*8:i*8+8], 2)) for i in xrange(4)]
-            src_ipv4 = ".".join(vals)
-            # Create the masks for the metadata (as a number) and the IP (as a string).
-            vals = [ str(int(meta[2][i*8:i*8+8], 2)) for i in xrange(4)]
-            meta_mask = int(meta[2], 2)
-            src_mask = ".".join(vals)
-        
             # Add rule to table 2.
-            self.add_flow_to_table(datapath, comparator_priority, parser.OFPMatch(metadata=(meta[0], meta_mask), eth_type=ether.ETH_TYPE_IP, ipv4_src=(src_ipv4, src_mask)), [], instructions2, 2)
+            self.add_flow_to_table(datapath, priority, parser.OFPMatch(metadata=(meta, meta_mask), eth_type=ether.ETH_TYPE_IP, ipv4_src=(src_ipv4, src_mask)), [], instructions2, 2)
             # Add rule to table 4.
-            self.add_flow_to_table(datapath, comparator_priority, parser.OFPMatch(metadata=(meta[0], meta_mask), eth_type=ether.ETH_TYPE_IP, ipv4_src=(src_ipv4, src_mask)), [], instructions4, 4)
-            comparator_priority-=1
+            self.add_flow_to_table(datapath, priority, parser.OFPMatch(metadata=(meta, meta_mask), eth_type=ether.ETH_TYPE_IP, ipv4_src=(src_ipv4, src_mask)), [], instructions4, 4)
             self.numberOfRules +=2
 
 
+    def choose_compilation(self, current=None):
+        """
+        Returns the compilation of the ranges by the class's mode. In "auto" mode, the cheaper of
+        the two for the current ranges is chosen, by the cost model of prefixcover. The "group" mode
+        falls back to "auto" on switches without select groups. It is chosen again on every
+        re-partition, since ranges that moved are no longer aligned and have more prefixes - the
+        current compilation is kept then unless the other one is cheaper by recompile_margin.
+        """
+        if self.compilation_mode not in ("auto", "group"):
+            return self.compilation_mode
+        prefix_rules = sum(len(prefixcover.range_to_prefixes(lower, upper)) for (lower, upper) in self.ranges)
+        elcp_rules = 2 * len(self.ranges) + 1 + 2 * len(COMPARATOR_RULES)
+        costs = {"prefix": prefixcover.compilation_cost(prefix_rules, prefixcover.PREFIX_DEPTH, self.lookup_cost),
+                 "elcp": prefixcover.compilation_cost(elcp_rules, prefixcover.ELCP_DEPTH, self.lookup_cost)}
+        if current in costs:
+            other = "elcp" if current == "prefix" else "prefix"
+            return other if costs[other] * (1 + self.recompile_margin) < costs[current] else current
+        if costs["prefix"] <= costs["elcp"]:
+            return "prefix"
+        return "elcp"
+
+
+    @metrics.timed("build_table_seconds", table="prefix")
+    def build_prefix_table(self, datapath):
+        """
+        Builds table 1 of the prefix compilation - a rule for each CIDR prefix of each range.
+        """
+        rules = self.create_range_rules(zip(self.ranges, [server.range_id for server in self.servers]))
+        for key in rules:
+            self.add_range_rule(datapath, key, rules[key])
+            self.numberOfRules +=1
+
+
+    @metrics.timed("build_table_seconds", table="5")
     def build_table_5(self, datapath):
         """
         Builds table 5, as defined in create_rule_set doc.
         """
+        for server in self.servers:
+            self.add_server_rule(datapath, server)
+            self.numberOfRules +=1
+
+
+    def add_server_rule(self, datapath, server):
+        """
+        Adds the rule of a server to table 5. The packets of a failed server are sent to its standby.
+        """
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
         rid_meta_mask = (2**32-1)*(2**32) # only the RID part of the metadata - the most significant 32 bits.
-
-        for i in xrange(self.number_of_servers):
-            actions = [parser.OFPActionSetField(eth_dst=self.servers[i][0]),
-                       parser.OFPActionSetField(ipv4_dst=self.servers[i][1]),
-                       parser.OFPActionOutput(ofproto.OFPP_NORMAL)]
-            self.add_flow_to_table(datapath, 0, parser.OFPMatch(eth_type=ether.ETH_TYPE_IP, metadata=(i*(2**32), rid_meta_mask)), actions, [], 5)
-            self.numberOfRules +=1
+        target = self.failed.get(server.range_id, server)
+        actions = [parser.OFPActionSetField(eth_dst=target.mac),
+                   parser.OFPActionSetField(ipv4_dst=target.ip),
+                   parser.OFPActionOutput(ofproto.OFPP_NORMAL)]
+        # The cookie identifies the server when reading the stats of the table.
+        self.add_flow_to_table(datapath, 0, parser.OFPMatch(eth_type=ether.ETH_TYPE_IP, metadata=(server.range_id*(2**32), rid_meta_mask)), actions, [], 5, server.cookie)
 
 
     def convert_lcp_to_ipv4(self, elcp, pref_length):
@@ -240,44 +466,69 @@ class MicDekLoad(app_manager.RyuApp):
         meta = range_id * (2**32) + range_limit
         meta_mask = 2**64 - 1 # Write the entire metadata. The 32 MSBs are for the RID, the others for the comparators.
         write_meta = parser.OFPInstructionWriteMetadata(meta, meta_mask)
-        self.add_flow_to_table(datapath, priority, match, [], [write_meta, parser.OFPInstructionGotoTable(table_id + 1)], table_id)
+        # The priority is above the table miss rule of table 1 even for an empty LCP.
+        self.add_flow_to_table(datapath, priority + 1, match, [], [write_meta, parser.OFPInstructionGotoTable(table_id + 1)], table_id)
 
 
-    def rewrite_rules_in_1_3(self, datapath, old_lower, old_upper, new_lower, new_upper, range_id):
+    def create_range_rules(self, ranges):
         """
-        Rewrite rules in tables 1 and 3, when the lower and upper values of a range have changed.
+        Returns the rules that the given ((lower, upper), range ID) tuples have in tables 1 and 3,
+        as a dictionary from the (table, source IP, source IP mask, priority) of each rule to the
+        metadata it writes. In the prefix compilation, the rules are the prefixes of the ranges in
+        table 1, and a longer prefix gets a higher priority. The prefixes do not overlap, so the
+        priority only matters while a re-partition replaces the rules.
         """
-        (old_lcp, old_elcp0, old_elcp1, old_priority) = self.find_lcp(old_lower, old_upper)
-        (new_lcp, new_elcp0, new_elcp1, new_priority) = self.find_lcp(new_lower, new_upper)  
+        rules = {}
+        for ((lower, upper), range_id) in ranges:
+            if self.compilation == "prefix":
+                for (value, prefix_length) in prefixcover.range_to_prefixes(lower, upper):
+                    (ip, mask) = prefixcover.prefix_to_ipv4(value, prefix_length)
+                    rules[(1, ip, mask, prefix_length + 1)] = range_id * (2**32)
+            else:
+                (lcp, elcp0, elcp1, priority) = self.find_lcp(lower, upper)
+                # Table 1 uses the upper bound and ELCP1, table 3 uses the lower bound and ELCP0.
+                (ip, mask) = self.convert_lcp_to_ipv4(elcp1, priority + 1)
+                rules[(1, ip, mask, priority + 1)] = range_id * (2**32) + upper
+                (ip, mask) = self.convert_lcp_to_ipv4(elcp0, priority + 1)
+                rules[(3, ip, mask, priority + 1)] = range_id * (2**32) + lower
+        return rules
 
-        # Rewrite rules in table 1, using ELCP1 and upper bound.
-        self.rewrite_rules_in_1_3_for_table(datapath, old_elcp1, new_elcp1, old_upper, new_upper, old_priority, new_priority, range_id, 1)
-        # Rewrite rules in table 3, using ELCP0 and lower bound.
-        self.rewrite_rules_in_1_3_for_table(datapath, old_elcp0, new_elcp0, old_lower, new_lower, old_priority, new_priority, range_id, 3)
-        self.changedRules+=2
 
-    def rewrite_rules_in_1_3_for_table(self, datapath, old_elcp, new_elcp, old_range, new_range, old_priority, new_priority, range_id, table_id):
+    def add_range_rule(self, datapath, key, meta):
         """
-        Helper method for rewrite_rules_in_1_3, for each table.
+        Adds a rule of create_range_rules. In the prefix compilation it goes straight to table 5,
+        otherwise to the comparator after its table.
         """
-        ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
+        (table_id, ip, mask, priority) = key
+        match = parser.OFPMatch(eth_type=ether.ETH_TYPE_IP, ipv4_src=(ip, mask))
         meta_mask = 2**64 - 1 # Write the entire metadata. The 32 MSBs are for the RID, the others for the comparators.
+        goto = 5 if self.compilation == "prefix" else table_id + 1
+        self.add_flow_to_table(datapath, priority, match, [], [parser.OFPInstructionWriteMetadata(meta, meta_mask), parser.OFPInstructionGotoTable(goto)], table_id)
 
-        (old_ip, old_wildcard_mask) = self.convert_lcp_to_ipv4(old_elcp, old_priority + 1)
-        (new_ip, new_wildcard_mask) = self.convert_lcp_to_ipv4(new_elcp, new_priority + 1)
-        old_match = parser.OFPMatch(eth_type=ether.ETH_TYPE_IP, ipv4_src=(old_ip, old_wildcard_mask))
-        new_match = parser.OFPMatch(eth_type=ether.ETH_TYPE_IP, ipv4_src=(new_ip, new_wildcard_mask))
-        old_meta = range_id * (2**32) + old_range
-        new_meta = range_id * (2**32) + new_range
-        old_write_meta = parser.OFPInstructionWriteMetadata(old_meta, meta_mask)
-        new_write_meta = parser.OFPInstructionWriteMetadata(new_meta, meta_mask)
-        # If any part of the rule is different, replace the old rule by a new one.
-        if old_ip != new_ip or old_wildcard_mask != new_wildcard_mask or old_meta != new_meta or old_priority != new_priority:
-            # We first delete the old rule, since otherwise, we cannot tell which rule will be
-            # deleted since not all field are matched.
-            self.delete_flow_from_table(datapath, old_priority, old_match, [], [old_write_meta, parser.OFPInstructionGotoTable(table_id + 1)], table_id)
-            self.add_flow_to_table(datapath, new_priority, new_match, [], [new_write_meta, parser.OFPInstructionGotoTable(table_id + 1)], table_id)
+
+    def rewrite_range_rules(self, datapath, old_ranges, new_ranges):
+        """
+        Rewrite rules in tables 1 and 3, when the lower and upper values of ranges have changed.
+        The ranges are given as ((lower, upper), range ID) tuples. Rules that are the same in the
+        old and new ranges are kept. The new rules are added first, and the old ones are deleted
+        after a barrier. A rule is deleted only if no new rule has its match and priority, since
+        adding such a rule already replaced it.
+        """
+        parser = datapath.ofproto_parser
+        old_rules = self.create_range_rules(old_ranges)
+        new_rules = self.create_range_rules(new_ranges)
+        for key in new_rules:
+            if old_rules.get(key) != new_rules[key]:
+                self.add_range_rule(datapath, key, new_rules[key])
+                self.changedRules+=1
+        deletions = [key for key in old_rules if key not in new_rules]
+        if deletions:
+            self.batches[datapath.id].add_barrier()
+        for (table_id, ip, mask, priority) in deletions:
+            match = parser.OFPMatch(eth_type=ether.ETH_TYPE_IP, ipv4_src=(ip, mask))
+            self.delete_flow_from_table(datapath, priority, match, [], [], table_id)
+            self.changedRules+=1
 
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
@@ -288,12 +539,129 @@ class MicDekLoad(app_manager.RyuApp):
         Also start monitoring statistics, for re-partitioning of the ranges.
         """
         datapath = ev.msg.datapath
+        self.switches[datapath.id] = datapath
+        if self.health_interval is not None:
+            datapath.send_msg(failover.create_health_rule(datapath))
         # Do the LB process except in the inner switch of the LB (it should know its real servers!).
         if ev.msg.datapath_id != 1:
+           if self.compilation_mode == "group":
+               # The rules are created once the group features of the switch are known.
+               datapath.send_msg(datapath.ofproto_parser.OFPGroupFeaturesStatsRequest(datapath))
+               return
            self.create_rule_set(datapath)
-           thread.start_new_thread(self.send_flow_stats_request, (datapath,))
+           self.start_flow_stats(datapath)
+
+    @set_ev_cls(ofp_event.EventOFPGroupFeaturesStatsReply, [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def group_features_handler(self, ev):
+        """
+        Balance the switch by a select group if it supports one, and by the range rules otherwise.
+        """
+        datapath = ev.msg.datapath
+        if datapath.id in self.groups:
+            return
+        if selectgroup.supports_select(ev.msg.body):
+            self.create_group_set(datapath)
+        else:
+            print "Switch %d does not support weighted select groups" %(datapath.id, )
+            self.create_rule_set(datapath)
+        self.start_flow_stats(datapath)
+
+    def add_balanced(self, datapath):
+        """
+        Records that the controller balances a datapath. The changes of the servers are sent to
+        every balanced datapath, so it is registered with the switches too.
+        """
+        self.switches[datapath.id] = datapath
+        self.balanced.add(datapath.id)
+
+    @metrics.timed("build_table_seconds", table="group")
+    def create_group_set(self, datapath):
+        """
+        Creates the rules of a switch balanced by a select group - table 0 as in create_rule_set,
+        the group with the buckets weighted by the servers' weights, and a rule in table 1 that
+        sends the traffic to the group.
+        """
+        self.groups[datapath.id] = selectgroup.bucket_weights(self.servers.weights())
+        self.add_balanced(datapath)
+        print "Balancing switch %d by a select group" %(datapath.id, )
+        self.begin_batch(datapath)
+        self.build_table_0(datapath)
+        self.send_message(datapath, self.create_group_mod(datapath))
+        self.send_message(datapath, selectgroup.create_group_rule(datapath))
+        return self.commit_batch(datapath, self.rules_committed)
+
+    def reweight_group(self, datapath, packets):
+        """
+        Re-weights the buckets of the group of a switch by the packets each server received in the
+        last interval, so the share of each server matches its weight. This is a single message.
+        """
+        buckets = selectgroup.reweight(self.groups[datapath.id], packets, self.servers.weights())
+        self.groups[datapath.id] = buckets
+        print "New bucket weights: %s" %(buckets, )
+        self.begin_batch(datapath)
+        self.send_message(datapath, self.create_group_mod(datapath, datapath.ofproto.OFPGC_MODIFY))
+        return self.commit_batch(datapath, self.rules_committed)
+
+    def create_group_mod(self, datapath, command=ofproto_v1_3.OFPGC_ADD):
+        """
+        Creates the group mod of a switch balanced by a select group. The bucket of a failed server
+        sends to its standby, and the bucket of a drained server to the nearest server in rotation,
+        so it gets no new flows. The buckets of failed and drained servers get the least weight.
+        """
+        out_of_rotation = set(i for i in xrange(self.number_of_servers) if not self.in_rotation(self.servers[i]))
+        targets = []
+        for (i, server) in enumerate(self.servers):
+            target = self.failed.get(server.range_id, server)
+            if server.range_id in self.drained:
+                standby = failover.find_standby(i, out_of_rotation, self.number_of_servers)
+                if standby is not None:
+                    target = self.servers[standby]
+            targets += [target]
+        buckets = [weight if self.in_rotation(server) else 1 for (server, weight) in zip(self.servers, self.groups[datapath.id])]
+        return selectgroup.create_group_mod(datapath, targets, buckets, command)
+
+    def begin_batch(self, datapath):
+        """
+        Opens a batch for the datapath. Until it is committed, all flow messages to the
+        datapath are collected in the batch instead of being sent one by one.
+        """
+        batch = flowbatch.FlowBatch(datapath)
+        self.batches[datapath.id] = batch
+        return batch
+
+    def commit_batch(self, datapath, callback=None):
+        """
+        Sends the open batch of the datapath, ended by a barrier. The callback is called
+        with the batch once the switch applied all of its messages.
+        """
+        batch = self.batches.pop(datapath.id)
+        return batch.commit(callback)
+
+    def rules_committed(self, batch):
+        """
+        Called once the switch applied a batch of rules.
+        """
+        print "%d messages (%d bytes) were applied by switch %d in %.3f seconds" %(len(batch.msgs), batch.num_bytes, batch.datapath.id, batch.elapsed())
+
+    def send_message(self, datapath, msg):
+        """
+        Sends a message to the datapath, through its open batch if there is one.
+        """
+        batch = self.batches.get(datapath.id)
+        if batch is None:
+            metrics.count_message(msg)
+            datapath.send_msg(msg)
+        else:
+            batch.send_msg(msg)
+
+    @set_ev_cls(EventOFPBarrierReply, MAIN_DISPATCHER)
+    def barrier_reply_handler(self, ev):
+        """
+        Handle barrier replies, used to know when a batch of rules was applied.
+        """
+        flowbatch.handle_barrier_reply(ev.msg)
 
-    def add_flow_to_table(self, datapath, priority, match, actions, instructions, table):
+    def add_flow_to_table(self, datapath, priority, match, actions, instructions, table, cookie=0, idle_timeout=0, flags=0):
         """
         Adds a flow with the given parameters to the table.
         """
@@ -306,9 +674,10 @@ class MicDekLoad(app_manager.RyuApp):
             inst += [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
                                                  actions)]
 
-        mod = parser.OFPFlowMod(datapath=datapath, priority=priority,
-                                match=match, instructions=inst, table_id=table)
-        datapath.send_msg(mod)
+        mod = parser.OFPFlowMod(datapath=datapath, cookie=cookie, priority=priority,
+                                match=match, instructions=inst, table_id=table,
+                                idle_timeout=idle_timeout, flags=flags)
+        self.send_message(datapath, mod)
 
 
     def delete_flow_from_table(self, datapath, priority, match, actions, instructions, table):
@@ -326,16 +695,18 @@ class MicDekLoad(app_manager.RyuApp):
 
         mod = parser.OFPFlowMod(datapath=datapath, priority=priority, out_port=ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY, command=ofproto.OFPFC_DELETE_STRICT, match=match, instructions=inst, table_id=table)
 
-        datapath.send_msg(mod)
+        self.send_message(datapath, mod)
 
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
+    @metrics.timed("packet_in_seconds")
     def _packet_in_handler(self, ev):
         """
         This function (taken from simple_switch) handles all packets, except the ones directed
         to the load balancer. Also, after the load balances does its job, the packets arrive here
         to get to the actual servers.
         """
+        self.metrics.counter("packet_ins_total").inc()
         msg = ev.msg
         datapath = msg.datapath
         ofproto = datapath.ofproto
@@ -344,18 +715,27 @@ class MicDekLoad(app_manager.RyuApp):
         
         pkt = packet.Packet(msg.data)
         eth = pkt.get_protocols(ethernet.ethernet)[0]
+        if failover.is_health_reply(pkt):
+            # The server answered from its port, so its MAC is still in use there.
+            mac_table = self.mac_to_port.get(datapath.id)
+            if mac_table is not None and mac_table.lookup(eth.src) == in_port:
+                mac_table.touch(eth.src)
+            self.health_reply_received(pkt.get_protocol(arp.arp))
+            return
+        self.learn_client(pkt)
 
         dst = eth.dst
         src = eth.src
                 
         dpid = datapath.id
-        self.mac_to_port.setdefault(dpid, {})
-
-        # learn a mac address to avoid FLOOD next time.
-        self.mac_to_port[dpid][src] = in_port
-        if dst in self.mac_to_port[dpid]:
-            out_port = self.mac_to_port[dpid][dst]
-        else:
+        mac_table = self.mac_to_port.get(dpid)
+        if mac_table is None:
+            mac_table = self.mac_to_port[dpid] = mactable.MacTable(self.mac_table_size, self.mac_ttl)
+
+        # learn a mac address to avoid FLOOD next time. The rules toward MACs that were forgotten are deleted.
+        self.forget_macs(datapath, mac_table.expire() + mac_table.learn(src, in_port))
+        out_port = mac_table.lookup(dst)
+        if out_port is None:
             out_port = ofproto.OFPP_FLOOD
 
         actions = [datapath.ofproto_parser.OFPActionOutput(out_port)]
@@ -363,7 +743,9 @@ class MicDekLoad(app_manager.RyuApp):
         # install a flow to avoid packet_in next time
         if out_port != ofproto.OFPP_FLOOD:
             match = parser.OFPMatch(in_port=in_port, eth_dst=dst)
-            self.add_flow_to_table(datapath, 1, match, actions, [], 0)
+            self.add_flow_to_table(datapath, 1, match, actions, [], 0, serverregistry.LEARN_COOKIE, self.learn_idle_timeout,
+                                   ofproto.OFPFF_SEND_FLOW_REM)
+            mac_table.add_flow(dst, in_port)
 
         data = None
         if msg.buffer_id == ofproto.OFP_NO_BUFFER:
@@ -374,6 +756,94 @@ class MicDekLoad(app_manager.RyuApp):
         datapath.send_msg(out)
 
 
+    def forget_macs(self, datapath, macs):
+        """
+        Deletes the learning rules toward the given MACs from table 0.
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        for mac in macs:
+            mod = parser.OFPFlowMod(datapath=datapath, cookie=serverregistry.LEARN_COOKIE, cookie_mask=serverregistry.COOKIE_TYPE_MASK,
+                                    table_id=0, command=ofproto.OFPFC_DELETE, out_port=ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY,
+                                    match=parser.OFPMatch(eth_dst=mac))
+            self.send_message(datapath, mod)
+
+
+    def learn_client(self, pkt):
+        """
+        Remembers the source IP of an ARP or IPv4 packet, unless it is of a server or the LB.
+        """
+        ip = None
+        arp_pkt = pkt.get_protocol(arp.arp)
+        ipv4_pkt = pkt.get_protocol(ipv4.ipv4)
+        if arp_pkt is not None:
+            ip = arp_pkt.src_ip
+        elif ipv4_pkt is not None:
+            ip = ipv4_pkt.src
+        if ip is None or ip == self.virtual_ip or self.servers.find_by_ip(ip) is not None:
+            return
+        # Move the client to the end, as the most recently seen.
+        self.clients.pop(ip, None)
+        self.clients[ip] = True
+        if len(self.clients) > self.max_clients:
+            self.clients.popitem(last=False)
+
+
+    def pin_moved_clients(self, datapath, old_ranges, old_range_ids=None):
+        """
+        Pins the known clients whose address moves from the old ranges to the range of another
+        server, to their former server. A pin rule in table 1 matches the exact client IP, above all
+        the range rules, and sends it to table 5 with the RID of its former server, so its packets
+        are still counted for that server. The rule expires once the client is idle, and the switch
+        reports it. A client that is already pinned stays pinned to the same server. The pins are
+        applied before the ranges move. The range IDs of the old ranges are those of the servers,
+        unless servers were added or removed since.
+        """
+        parser = datapath.ofproto_parser
+        ofproto = datapath.ofproto
+        pins = self.pins.setdefault(datapath.id, {})
+        if old_range_ids is None:
+            old_range_ids = [server.range_id for server in self.servers]
+        count = 0
+        for ip in self.clients:
+            if ip in pins:
+                continue
+            address = prefixcover.ipv4_to_int(ip)
+            old_position = rangealloc.find_range(old_ranges, address)
+            if old_position is None:
+                continue
+            range_id = old_range_ids[old_position]
+            new_position = rangealloc.find_range(self.ranges, address)
+            # A client of a removed server has nothing to be pinned to.
+            if (new_position is not None and self.servers[new_position].range_id == range_id) or self.servers.find_by_range_id(range_id) is None:
+                continue
+            pins[ip] = range_id
+            write_meta = parser.OFPInstructionWriteMetadata(range_id * (2**32), 2**64 - 1)
+            self.add_flow_to_table(datapath, self.pin_priority, parser.OFPMatch(eth_type=ether.ETH_TYPE_IP, ipv4_src=ip), [],
+                                   [write_meta, parser.OFPInstructionGotoTable(5)], 1, serverregistry.PIN_COOKIE + range_id,
+                                   self.pin_idle_timeout, ofproto.OFPFF_SEND_FLOW_REM)
+            count += 1
+        if count > 0:
+            print "Pinned %d clients to their former servers" %(count, )
+            self.batches[datapath.id].add_barrier()
+
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def flow_removed_handler(self, ev):
+        """
+        Forgets a pin once its rule expired, the client is balanced by its range again. Forgets a
+        learning rule once it expired or was deleted, so the MAC table knows which rules the switch has.
+        """
+        msg = ev.msg
+        cookie_type = msg.cookie & serverregistry.COOKIE_TYPE_MASK
+        if cookie_type == serverregistry.PIN_COOKIE:
+            self.pins.get(msg.datapath.id, {}).pop(msg.match['ipv4_src'], None)
+        elif cookie_type == serverregistry.LEARN_COOKIE:
+            mac_table = self.mac_to_port.get(msg.datapath.id)
+            if mac_table is not None:
+                mac_table.flow_removed(msg.match['eth_dst'], msg.match['in_port'])
+
+
     def find_lcp(self, lower, upper):
         """
         Finds the LCP (longest common prefix) of the given IP ranges, 
@@ -412,119 +882,577 @@ class MicDekLoad(app_manager.RyuApp):
                 return (lcp, elcp0, elcp1, prefix_length)
 
 
-    def send_flow_stats_request(self, datapath):
-       """
-       Send stat requests from a different thread, and handle its result - infinitely.
-       """
-       ofp = datapath.ofproto
-       ofp_parser = datapath.ofproto_parser
-       last_packets = [0] * self.number_of_servers # Keep the last packet results, because we compare deltas.
-       self.skip_partition = True # Whether to skip re-partitioning in the next run.
-       
-       while True:
-           # Send request to get connection stats.
-           req = ofp_parser.OFPFlowStatsRequest(datapath)
-           datapath.send_msg(req)
-           self.received_reply = False
-
-           # Wait until the results are all done.
-           while self.received_reply == False:
-               time.sleep(1)
-
-           # Read results, fix the partitioning accordingly.
-           # If the difference between the busiest and most relieved server are big, re-partition. 
-           min_delta = 0
-           min_delta_id = 0
-           max_delta = 0
-           max_delta_id = 0
-           # Find the busiest and most relieved servers.
-           for i in xrange(self.number_of_servers):
-               # Calculate a weighted delta.
-               delta = (self.num_packets[i] - last_packets[i]) * self.servers[i][2]
-               if i == 0 or min_delta > delta:
-                   min_delta = delta
-                   min_delta_id = i
-	       if i == 0 or max_delta < delta:
-                   max_delta = delta
-                   max_delta_id = i
-               last_packets[i] = self.num_packets[i]
-
-           # Re-partition if needed.
-           if not self.skip_partition and min_delta * 2 < max_delta:
-               self.repartition(datapath, min_delta_id, max_delta_id)
-               # Skip partition, so that next time we will have the refreshed deltas of the
-               # new rules.
-               self.skip_partition = True
-               
-           else:
-               self.skip_partition = False
-
-           # Sleep until next iteration.
-           time.sleep(3)
-
-    @set_ev_cls(EventOFPFlowStatsReply, MAIN_DISPATCHER)
+    def start_flow_stats(self, datapath):
+        """
+        Start asking the datapath for flow statistics periodically, for re-partitioning of the ranges.
+        """
+        self.last_packets[datapath.id] = [0] * self.number_of_servers # Keep the last packet results, because we compare deltas.
+        self.skip_partition[datapath.id] = True # Whether to skip re-partitioning in the next run.
+        self.stats_scheduler.schedule(datapath, self.stats_interval, self.create_flow_stats_request,
+                                      self.flow_stats_received, self.stats_jitter)
+
+    def create_flow_stats_request(self, datapath):
+        """
+        Creates the periodic flow stats request of a datapath. Only the server rules of table 5 are
+        requested, unless there are probes - then all the rules are. A datapath balanced by a
+        select group is asked for the counters of the group's buckets instead.
+        """
+        if datapath.id in self.groups:
+            return datapath.ofproto_parser.OFPGroupStatsRequest(datapath, group_id=selectgroup.GROUP_ID)
+        if self.probes.get(datapath.id):
+            return datapath.ofproto_parser.OFPFlowStatsRequest(datapath, table_id=datapath.ofproto.OFPTT_ALL)
+        return datapath.ofproto_parser.OFPFlowStatsRequest(datapath, table_id=5, cookie=serverregistry.RID_COOKIE,
+                                                           cookie_mask=serverregistry.COOKIE_TYPE_MASK)
+
+    def check_partition(self, datapath):
+        """
+        Read the latest stats results, and fix the partitioning accordingly.
+        """
+        last_packets = self.last_packets[datapath.id]
+        deltas = [self.num_packets[i] - last_packets[i] for i in xrange(self.number_of_servers)]
+        last_packets[:] = self.num_packets
+        for i in xrange(self.number_of_servers):
+            self.metrics.gauge("server_interval_packets", switch=datapath.id, server=self.servers[i].ip).set(deltas[i])
+        self.write_journal(journal.SAMPLE, datapath, self.num_packets)
+        self.write_journal(journal.RANGES, datapath, [bound for r in self.ranges for bound in r])
+        self.write_journal(journal.DELTAS, datapath, deltas)
+        self.balance(datapath, deltas)
+        weights = self.groups.get(datapath.id) or self.servers.weights()
+        self.write_journal(journal.WEIGHTS, datapath, weights, True)
+
+    def balance(self, datapath, deltas):
+        """
+        Re-partition the ranges, or re-weight the group, if the deltas of the last interval are
+        too far from the weights of the servers.
+        """
+        # The load of each server relative to its weight. Failed and drained servers are left out, their placeholder ranges get almost no packets.
+        loads = [float(deltas[i]) / self.servers[i].weight for i in xrange(self.number_of_servers)]
+        live_loads = [loads[i] for i in xrange(self.number_of_servers) if self.in_rotation(self.servers[i])]
+
+        probes = self.probe_packets.pop(datapath.id, [])
+
+        # Re-partition if the busiest server is too loaded compared to the most relieved one.
+        if (not self.skip_partition[datapath.id] and sum(deltas) >= self.min_partition_packets
+                and min(live_loads) * self.imbalance_ratio < max(live_loads)):
+            if datapath.id in self.groups:
+                # The bucket counters may start from zero once the group is modified.
+                with self.metrics.timer("rebalance_seconds", mode="group"):
+                    batch = self.reweight_group(datapath, deltas)
+                self.rebalanced("group", batch)
+                self.skip_partition[datapath.id] = True
+                return
+            if self.heavy_hitter_mode and not probes:
+                # Re-partition once the probes tell where the traffic of the overloaded servers comes from.
+                if not self.probes.get(datapath.id):
+                    average = sum(live_loads) / len(live_loads)
+                    self.probe_ranges(datapath, [i for i in xrange(self.number_of_servers) if loads[i] > average])
+                return
+            with self.metrics.timer("rebalance_seconds", mode="ranges"):
+                batch = self.repartition(datapath, deltas, probes)
+            self.rebalanced("ranges", batch)
+            # Skip partition, so that next time we will have the refreshed deltas of the
+            # new rules.
+            self.skip_partition[datapath.id] = True
+        else:
+            self.skip_partition[datapath.id] = False
+            if probes:
+                self.begin_batch(datapath)
+                self.remove_probes(datapath)
+                self.commit_batch(datapath)
+
+    def rebalanced(self, mode, batch):
+        """
+        Counts a rebalance and the rules it changed, which are the flow and group messages of its batch.
+        """
+        self.metrics.counter("rebalances_total", mode=mode).inc()
+        self.metrics.histogram("rebalance_changes", metrics.COUNT_BOUNDS).observe(flowbatch.count_changes(batch))
+        self.write_journal(journal.DIFF, batch.datapath, journal.batch_diff(batch))
+
+    def write_journal(self, record_type, datapath, values, last=False):
+        """
+        Appends a record of the datapath to the journal, if there is one. The journal is flushed
+        once the last record of a sample is written.
+        """
+        if self.journal is not None:
+            self.journal.write(record_type, datapath.id, values)
+            if last:
+                self.journal.flush()
+
+    def probe_ranges(self, datapath, positions):
+        """
+        Covers the ranges of the servers at the given positions by probe rules, one for each
+        sub-prefix of a range (see prefixcover.probe_prefixes). A probe rule in table 1 is above the
+        range rules and sends its packets to table 5 with the RID of the range's server, like the
+        range rules do, so it changes nothing but counting.
+        """
+        parser = datapath.ofproto_parser
+        probes = self.probes.setdefault(datapath.id, {})
+        self.begin_batch(datapath)
+        for i in positions:
+            range_id = self.servers[i].range_id
+            write_meta = parser.OFPInstructionWriteMetadata(range_id * (2**32), 2**64 - 1)
+            for (value, prefix_length) in prefixcover.probe_prefixes(self.ranges[i][0], self.ranges[i][1], self.num_of_probes):
+                cookie = serverregistry.PROBE_COOKIE + len(probes)
+                probes[cookie] = (value, value + 2**(32 - prefix_length) - 1)
+                match = parser.OFPMatch(eth_type=ether.ETH_TYPE_IP, ipv4_src=prefixcover.prefix_to_ipv4(value, prefix_length))
+                self.add_flow_to_table(datapath, self.probe_priority, match, [], [write_meta, parser.OFPInstructionGotoTable(5)], 1, cookie)
+        print "Probing the ranges of %d servers with %d rules" %(len(positions), len(probes))
+        return self.commit_batch(datapath, self.rules_committed)
+
+    def remove_probes(self, datapath):
+        """
+        Deletes all the probe rules of the datapath, followed by a barrier, since they must be
+        gone before the ranges they probed move.
+        """
+        ofproto = datapath.ofproto
+        mod = datapath.ofproto_parser.OFPFlowMod(datapath=datapath, cookie=serverregistry.PROBE_COOKIE,
+                                                 cookie_mask=serverregistry.COOKIE_TYPE_MASK, table_id=1,
+                                                 command=ofproto.OFPFC_DELETE, out_port=ofproto.OFPP_ANY,
+                                                 out_group=ofproto.OFPG_ANY)
+        self.send_message(datapath, mod)
+        self.batches[datapath.id].add_barrier()
+        self.probes.pop(datapath.id, None)
+
+    @set_ev_cls([EventOFPFlowStatsReply, EventOFPGroupStatsReply], MAIN_DISPATCHER)
     def flow_stats_reply_handler(self, ev):
         """
-        Handle stats reply. Set self.num_packets accordingly.
+        Handle stats reply. The parts of a multipart reply are collected by the stats scheduler.
+        """
+        self.stats_scheduler.handle_reply(ev.msg)
+
+    @set_ev_cls(ofp_event.EventOFPStateChange, DEAD_DISPATCHER)
+    def state_change_handler(self, ev):
+        """
+        Stop asking a datapath for statistics once it disconnects, and forget its MAC table, group
+        and the batches that wait for its barrier replies.
+        """
+        if ev.datapath.id is not None:
+            self.stats_scheduler.cancel(ev.datapath)
+            self.mac_to_port.pop(ev.datapath.id, None)
+            self.groups.pop(ev.datapath.id, None)
+            self.switches.pop(ev.datapath.id, None)
+            self.balanced.discard(ev.datapath.id)
+            flowbatch.drop_datapath(ev.datapath.id)
+
+    def flow_stats_received(self, datapath, body):
+        """
+        Handle the full body of a flow stats reply. Set self.num_packets accordingly, and re-partition if needed.
         """
         # Reset number of packets
         for i in range(self.number_of_servers):
             self.num_packets[i] = 0
+
+        # The packets of a datapath balanced by a select group are counted by the buckets of the group.
+        if datapath.id in self.groups:
+            bucket_packets = selectgroup.bucket_packets(body)
+            if bucket_packets is not None:
+                self.num_packets[:] = bucket_packets
+                self.check_partition(datapath)
+            return
         
-        # Calculate number of packets that went through table 5, by the dest MAC address.
-        for stat in ev.msg.body:
-            # Only care about valid rules in table 5.
-            if stat.table_id != 5 or len(stat.instructions) != 1 or len(stat.instructions[0].actions) != 3:
+        # Calculate number of packets that went through table 5, by the cookie of the server rule.
+        probes = self.probes.get(datapath.id, {})
+        probe_packets = []
+        for stat in body:
+            if stat.cookie in probes:
+                probe_packets += [probes[stat.cookie] + (stat.packet_count, )]
                 continue
-            # Convert MAC address to string (e.g. "0000000000").
-            mac = str(stat.instructions[0].actions[0].field.value).encode('hex').lower()
-            # Find the server with the matching MAC address.
-            server = -1
-            for i in xrange(self.number_of_servers):
-                # Convert server's MAC to the same format.
-                current_mac = self.servers[i][0].replace(":", "").lower()
-                if current_mac == mac:
-                  server = i
-
+            server = self.servers.find_by_cookie(stat.cookie) if stat.table_id == 5 else None
             # If found, add the packet count to this server's counting.
-            if server >= 0 and server < self.number_of_servers:
-                self.num_packets[server] = self.num_packets[server] + stat.packet_count
+            if server is not None:
+                i = self.servers.position_of(server)
+                self.num_packets[i] = self.num_packets[i] + stat.packet_count
+        if probe_packets:
+            self.probe_packets[datapath.id] = sorted(probe_packets)
 
-        # Allow other thread to continue.
-        self.received_reply = True
-	        
-    def repartition(self, datapath, min_id, max_id):
+        self.check_partition(datapath)
+
+    def repartition(self, datapath, packets, probes=()):
          """
-         Re-partition the ranges, in order to make the busiest server more relieved.
-         The current logic is decreasing the range of the busiest server, without modifying the min. server.
+         Re-partition the ranges by the packets each server received in the last interval.
+         All the new ranges are computed at once, so the estimated traffic of each server is
+         proportional to its weight. The traffic inside each range is estimated by the former
+         intervals (see rangealloc.refine_segments), and inside probed ranges by the probes of the
+         last interval. Boundaries that would move only a little are kept, and only the rules of
+         ranges whose limits moved are rewritten. Failed and drained servers keep their placeholder ranges.
          """
-         percent_to_take = random() / 2 # How much % to take from the busiest server.
-         total_max_size = self.ranges[max_id][1] - self.ranges[max_id][0] # Total size of the busiest server.
-         # if we have two sides - how much to give to each side?
-         if max_id != 0 and max_id != self.number_of_servers:
-             up = random()
-         # we only have 1 side
-         elif max_id == 0:
-             up = 1
-         else:
-             up = 0
-         percent_up = percent_to_take * up
-         percent_down = percent_to_take * (1 - up)
-         amount_up = int(math.floor(total_max_size * percent_up)) # Amount to give to max_id+1
-         amount_down = int(math.floor(total_max_size * percent_down)) # Amount to give to max_id-1
-     
-         for i in xrange(self.number_of_servers):
-             old_range = self.ranges[i]
-             # Increase top of max_id-1
-             if i == max_id - 1:
-                 self.ranges[i] = (old_range[0], old_range[1] + amount_down)
-             # Increase bottom of max_id and decrease its top.
-             elif i == max_id:
-                 self.ranges[i] = (old_range[0] + amount_down, old_range[1] - amount_up)
-             # Decrease bottom of max_id - 1.
-             elif i == max_id + 1:
-                 self.ranges[i] = (old_range[0] - amount_up, old_range[1])
-
-             self.rewrite_rules_in_1_3(datapath, old_range[0], old_range[1], self.ranges[i][0], self.ranges[i][1], i)
+         old_ranges = self.ranges
+         self.traffic = rangealloc.refine_segments(self.traffic, old_ranges, packets, self.max_traffic_segments * self.number_of_servers)
+         self.traffic = rangealloc.reshape_segments(self.traffic, probes)
+         weights = [server.weight if self.in_rotation(server) else 0 for server in self.servers]
+         new_ranges = rangealloc.allocate_ranges(self.traffic, weights, min_size=failover.FAILED_RANGE_SIZE)
+         self.ranges = rangealloc.keep_boundaries(old_ranges, new_ranges, self.boundary_tolerance)
+         self.shrink_failed_ranges()
+         compilation = self.choose_compilation(self.compilation)
+         if compilation != self.compilation:
+             return self.recompile(datapath, old_ranges, compilation)
+
+         # Only the ranges that moved are rewritten.
+         changed = [i for i in xrange(self.number_of_servers) if old_ranges[i] != self.ranges[i]]
+         range_ids = [self.servers[i].range_id for i in changed]
+         self.begin_batch(datapath)
+         if self.probes.get(datapath.id):
+             self.remove_probes(datapath)
+         if self.affinity_mode:
+             self.pin_moved_clients(datapath, old_ranges)
+         self.rewrite_range_rules(datapath, zip([old_ranges[i] for i in changed], range_ids), zip([self.ranges[i] for i in changed], range_ids))
          print "The number of updated rules is: %d" %(self.changedRules, )
+         return self.commit_batch(datapath, self.rules_committed)
+
+
+    def recompile(self, datapath, old_ranges, compilation):
+        """
+        Moves all the switches balanced by ranges from the rules of the old ranges in the current
+        compilation to the rules of the current ranges in the given one. The rules of both send a
+        packet to its range, so the new rules (and the comparators of the ELCP compilation) are
+        added first, and the old ones are deleted after a barrier. Returns the batch of the datapath.
+        """
+        parser = datapath.ofproto_parser
+        range_ids = [server.range_id for server in self.servers]
+        old_rules = self.create_range_rules(zip(old_ranges, range_ids))
+        print "Recompiling %d ranges from %s into %s rules" %(len(self.ranges), self.compilation, compilation)
+        self.metrics.counter("recompilations_total", compilation=compilation).inc()
+        self.compilation = compilation
+        new_rules = self.create_range_rules(zip(self.ranges, range_ids))
+        batch = None
+        for datapath_id in self.balanced:
+            if datapath_id in self.groups:
+                continue
+            switch = datapath if datapath_id == datapath.id else self.switches.get(datapath_id)
+            if switch is None:
+                continue
+            self.begin_batch(switch)
+            if self.probes.get(datapath_id):
+                self.remove_probes(switch)
+            if self.affinity_mode:
+                self.pin_moved_clients(switch, old_ranges)
+            if compilation != "prefix":
+                self.build_table_2_4(switch)
+                self.add_table_1_miss(switch)
+                self.batches[datapath_id].add_barrier()
+            for key in new_rules:
+                self.add_range_rule(switch, key, new_rules[key])
+                self.changedRules += 1
+            self.batches[datapath_id].add_barrier()
+            for (table_id, ip, mask, priority) in [key for key in old_rules if key not in new_rules]:
+                self.delete_flow_from_table(switch, priority, parser.OFPMatch(eth_type=ether.ETH_TYPE_IP, ipv4_src=(ip, mask)), [], [], table_id)
+                self.changedRules += 1
+            if compilation == "prefix":
+                # The comparators and the table miss of table 1 are no longer reached.
+                self.delete_flow_from_table(switch, 0, parser.OFPMatch(), [], [], 1)
+                for table_id in (2, 4):
+                    self.send_message(switch, parser.OFPFlowMod(datapath=switch, table_id=table_id, command=switch.ofproto.OFPFC_DELETE,
+                                                                out_port=switch.ofproto.OFPP_ANY, out_group=switch.ofproto.OFPG_ANY))
+            committed = self.commit_batch(switch, self.rules_committed)
+            if switch is datapath:
+                batch = committed
+            else:
+                self.skip_partition[datapath_id] = True
+        return batch
 
+    @set_ev_cls(ofp_event.EventOFPPortStatus, MAIN_DISPATCHER)
+    def port_status_handler(self, ev):
+        """
+        Fail the servers whose MAC was learned on a port that went down, and recover them once it is up.
+        """
+        msg = ev.msg
+        mac_table = self.mac_to_port.get(msg.datapath.id)
+        if mac_table is None:
+            return
+        port = msg.desc.port_no
+        servers = [server for server in self.servers if mac_table.lookup(server.mac) == port]
+        if not servers:
+            return
+        if failover.is_port_down(msg):
+            self.servers_failed(servers, "port %d of switch %d is down" %(port, msg.datapath.id))
+        else:
+            self.servers_recovered(servers, "port %d of switch %d is up" %(port, msg.datapath.id))
+
+    def servers_failed(self, servers, reason):
+        """
+        Fails over from the given servers, unless no other server would be left.
+        """
+        servers = [server for server in servers if server.range_id not in self.failed]
+        if not servers:
+            return
+        failed = set(self.failed) | set(server.range_id for server in servers)
+        ips = ", ".join(server.ip for server in servers)
+        if len(failed) == self.number_of_servers:
+            print "Servers %s failed (%s), but no other server is left" %(ips, reason)
+            return
+        print "Servers %s failed (%s), failing over" %(ips, reason)
+        self.metrics.counter("server_failures_total").inc(len(servers))
+        self.fail_over(failed)
+
+    def servers_recovered(self, servers, reason):
+        """
+        Sends the traffic of the given failed servers back to them. Their ranges grow to their
+        share by the next re-partitioning, since their load is the least.
+        """
+        servers = [server for server in servers if server.range_id in self.failed]
+        if not servers:
+            return
+        print "Servers %s recovered (%s)" %(", ".join(server.ip for server in servers), reason)
+        self.metrics.counter("server_recoveries_total").inc(len(servers))
+        self.fail_over(set(self.failed) - set(server.range_id for server in servers))
+
+    def fail_over(self, failed):
+        """
+        Moves all the balanced switches to the given failed servers (by range ID), in a single batch
+        for each switch (see apply_server_changes). The standbys are chosen again.
+        """
+        snapshot = self.snapshot_servers()
+        self.choose_standbys(failed)
+        self.shrink_failed_ranges()
+        with self.metrics.timer("failover_seconds"):
+            self.apply_server_changes(snapshot, pin=False)
+
+    def choose_standbys(self, failed):
+        """
+        Sets the standby of every failed server (by range ID) - the nearest live server.
+        """
+        positions = set(i for i in xrange(self.number_of_servers) if self.servers[i].range_id in failed)
+        self.failed = dict((self.servers[i].range_id, self.servers[failover.find_standby(i, positions, self.number_of_servers)])
+                           for i in positions)
+
+    def in_rotation(self, server):
+        """
+        Returns True if a server gets new clients - it neither failed nor is drained.
+        """
+        return server.range_id not in self.failed and server.range_id not in self.drained
+
+    def shrink_failed_ranges(self):
+        """
+        Gives the addresses of the ranges of the failed and drained servers to their active
+        neighbours, the failed and drained servers keep placeholder ranges.
+        """
+        if self.ranges and (self.failed or self.drained):
+            positions = set(i for i in xrange(self.number_of_servers) if not self.in_rotation(self.servers[i]))
+            self.ranges = failover.collapse_failed_ranges(self.ranges, positions)
+
+    def snapshot_servers(self):
+        """
+        Returns the state that apply_server_changes compares the servers and ranges with - the
+        ranges, the range ID of each one and the server every range ID is sent to.
+        """
+        targets = dict((server.range_id, self.failed.get(server.range_id, server)) for server in self.servers)
+        return (list(self.ranges), [server.range_id for server in self.servers], targets)
+
+    def apply_server_changes(self, snapshot, added=(), removed=(), pin=True):
+        """
+        Moves all the balanced switches from the snapshot (see snapshot_servers) to the current
+        servers and ranges, in a single batch for each switch. On a switch balanced by ranges, the
+        rules of the added servers and the rules of table 5 whose server changed are written first.
+        After a barrier, only the rules of the ranges that moved are rewritten, and after another
+        barrier the rules of the removed servers are deleted. On a switch balanced by a select group,
+        the group is modified.
+        """
+        (old_ranges, old_range_ids, old_targets) = snapshot
+        old = dict(zip(old_range_ids, old_ranges))
+        new = dict(zip([server.range_id for server in self.servers], self.ranges))
+        # There are no ranges when all the switches are balanced by a select group.
+        old_changed = [(old[range_id], range_id) for range_id in old_range_ids if range_id in old and old[range_id] != new.get(range_id)]
+        new_changed = [(new[server.range_id], server.range_id) for server in self.servers
+                       if server.range_id in new and new[server.range_id] != old.get(server.range_id)]
+        redirected = [server for server in self.servers
+                      if self.failed.get(server.range_id, server) is not old_targets.get(server.range_id)]
+        self.remap_positions(old_range_ids)
+        for datapath_id in self.balanced:
+            datapath = self.switches[datapath_id]
+            self.begin_batch(datapath)
+            for server in added:
+                self.add_source_rule(datapath, server)
+            if datapath_id in self.groups:
+                self.send_message(datapath, self.create_group_mod(datapath, datapath.ofproto.OFPGC_MODIFY))
+            else:
+                if self.probes.get(datapath_id):
+                    self.remove_probes(datapath)
+                for server in redirected:
+                    self.add_server_rule(datapath, server)
+                    self.changedRules += 1
+                if redirected:
+                    self.batches[datapath_id].add_barrier()
+                if self.affinity_mode and pin:
+                    self.pin_moved_clients(datapath, old_ranges, old_range_ids)
+                self.rewrite_range_rules(datapath, old_changed, new_changed)
+            if removed:
+                self.batches[datapath_id].add_barrier()
+            for server in removed:
+                self.delete_server_rules(datapath, server)
+            self.commit_batch(datapath, self.rules_committed)
+            # The counters of the rewritten rules start again from zero.
+            self.skip_partition[datapath_id] = True
+
+    def remap_positions(self, old_range_ids):
+        """
+        Moves the values that are kept by the position of the server - the packet counts and the
+        bucket weights - to the current positions, once servers were added or removed. An added
+        server starts with no packets, and with the bucket weight of its weight.
+        """
+        if old_range_ids == [server.range_id for server in self.servers]:
+            return
+        old_positions = dict((range_id, i) for (i, range_id) in enumerate(old_range_ids))
+        def remap(values, defaults):
+            return [values[old_positions[server.range_id]] if server.range_id in old_positions else default
+                    for (server, default) in zip(self.servers, defaults)]
+        self.num_packets = remap(self.num_packets, [0] * self.number_of_servers)
+        for datapath_id in self.last_packets:
+            self.last_packets[datapath_id] = remap(self.last_packets[datapath_id], [0] * self.number_of_servers)
+        buckets = selectgroup.bucket_weights(self.servers.weights())
+        for datapath_id in self.groups:
+            self.groups[datapath_id] = remap(self.groups[datapath_id], buckets)
+
+    def delete_server_rules(self, datapath, server):
+        """
+        Deletes the rules of a removed server - its rules in tables 0 and 5, and the pins to it.
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        rid_meta_mask = (2**32-1)*(2**32) # only the RID part of the metadata - the most significant 32 bits.
+        self.delete_flow_from_table(datapath, 2, parser.OFPMatch(eth_type=ether.ETH_TYPE_IP, ipv4_src=server.ip), [], [], 0)
+        if datapath.id in self.groups:
+            return
+        self.delete_flow_from_table(datapath, 0, parser.OFPMatch(eth_type=ether.ETH_TYPE_IP, metadata=(server.range_id*(2**32), rid_meta_mask)), [], [], 5)
+        mod = parser.OFPFlowMod(datapath=datapath, cookie=serverregistry.PIN_COOKIE + server.range_id, cookie_mask=2**64 - 1, table_id=1,
+                                command=ofproto.OFPFC_DELETE, out_port=ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY)
+        self.send_message(datapath, mod)
+        pins = self.pins.get(datapath.id, {})
+        for ip in [ip for ip in pins if pins[ip] == server.range_id]:
+            del pins[ip]
+
+    def range_share(self, weight):
+        """
+        Returns the number of addresses of the share of an active server with the weight, among the
+        active servers.
+        """
+        return int((2**32) * weight / sum(server.weight for server in self.servers if self.in_rotation(server)))
+
+    def add_server(self, mac, ip, weight, position=None):
+        """
+        Adds a server at runtime, by default after all others. Its range is split from the ranges
+        around its position, by its share of the weights, so only the rules of these ranges are
+        rewritten. The next re-partitioning corrects its share by the traffic. Returns the server.
+        """
+        if self.servers.find_by_ip(ip) is not None or self.servers.find_by_mac(mac) is not None:
+            raise ValueError("A server with the IP %s or the MAC %s already exists" %(ip, mac))
+        if weight <= 0:
+            raise ValueError("The weight of a server should be positive")
+        if position is None:
+            position = self.number_of_servers
+        if not 0 <= position <= self.number_of_servers:
+            raise ValueError("The position should be from 0 to %d" %(self.number_of_servers, ))
+        snapshot = self.snapshot_servers()
+        if self.ranges:
+            # The share of the new server includes its own weight.
+            size = int((2**32) * weight / (sum(server.weight for server in self.servers if self.in_rotation(server)) + weight))
+            self.ranges = rangealloc.insert_range(self.ranges, position, size, failover.FAILED_RANGE_SIZE)
+        server = self.servers.add(mac, ip, weight, position)
+        self.number_of_servers = len(self.servers)
+        self.shrink_failed_ranges()
+        print "Adding server %s at position %d" %(ip, position)
+        self.metrics.counter("server_changes_total", change="add").inc()
+        self.apply_server_changes(snapshot, added=[server])
+        return server
+
+    def drain_server(self, server):
+        """
+        Stops sending new clients to a server. Its range is given to its neighbours, and it keeps a
+        placeholder range like a failed server. In affinity mode its known clients are pinned to it
+        until they are idle, so it can be removed once its connections ended. Setting its weight
+        again undrains it.
+        """
+        if server.range_id in self.drained:
+            return
+        if not [other for other in self.servers if other is not server and self.in_rotation(other)]:
+            raise ValueError("Server %s is the last active server" %(server.ip, ))
+        snapshot = self.snapshot_servers()
+        self.drained.add(server.range_id)
+        self.shrink_failed_ranges()
+        print "Draining server %s" %(server.ip, )
+        self.metrics.counter("server_changes_total", change="drain").inc()
+        self.apply_server_changes(snapshot)
+
+    def remove_server(self, server):
+        """
+        Removes a server at runtime. Its range is merged into the ranges around it, half to each,
+        so only the rules of these ranges are rewritten, and then its own rules are deleted.
+        """
+        if not [other for other in self.servers if other is not server and self.in_rotation(other)]:
+            raise ValueError("Server %s is the last active server" %(server.ip, ))
+        snapshot = self.snapshot_servers()
+        position = self.servers.position_of(server)
+        if self.ranges:
+            self.ranges = rangealloc.remove_range(self.ranges, position)
+        self.servers.remove(server)
+        self.number_of_servers = len(self.servers)
+        self.drained.discard(server.range_id)
+        self.missed_probes.pop(server.range_id, None)
+        failed = set(self.failed) - set([server.range_id])
+        self.choose_standbys(failed)
+        self.shrink_failed_ranges()
+        print "Removing server %s" %(server.ip, )
+        self.metrics.counter("server_changes_total", change="remove").inc()
+        self.apply_server_changes(snapshot, removed=[server])
+
+    def set_server_weight(self, server, weight):
+        """
+        Changes the weight of a server at runtime, and undrains it. Its range grows or shrinks to
+        its new share by moving only its own boundaries, and on a switch balanced by a select group
+        its bucket weight is scaled by the change.
+        """
+        if weight <= 0:
+            raise ValueError("The weight of a server should be positive")
+        snapshot = self.snapshot_servers()
+        position = self.servers.position_of(server)
+        for datapath_id in self.groups:
+            buckets = list(self.groups[datapath_id])
+            buckets[position] = buckets[position] * weight / server.weight
+            self.groups[datapath_id] = selectgroup.bucket_weights(buckets)
+        server.weight = weight
+        self.drained.discard(server.range_id)
+        if self.ranges and self.in_rotation(server):
+            self.ranges = rangealloc.resize_range(self.ranges, position, self.range_share(weight), failover.FAILED_RANGE_SIZE)
+            self.shrink_failed_ranges()
+        print "Setting the weight of server %s to %s" %(server.ip, weight)
+        self.metrics.counter("server_changes_total", change="weight").inc()
+        self.apply_server_changes(snapshot)
+
+    def check_health(self):
+        """
+        Sends a health probe to every server every health_interval seconds. A server that did not
+        answer health_misses probes in a row fails.
+        """
+        while True:
+            for server in list(self.servers):
+                missed = self.missed_probes.get(server.range_id, 0)
+                if missed >= self.health_misses:
+                    self.servers_failed([server], "%d health probes were not answered" %(missed, ))
+                if self.send_health_probe(server):
+                    self.missed_probes[server.range_id] = missed + 1
+            hub.sleep(self.health_interval)
+
+    def send_health_probe(self, server):
+        """
+        Sends the health probe of a server out of the port of a switch its MAC was learned on.
+        Returns False if no connected switch learned it.
+        """
+        for (datapath_id, mac_table) in self.mac_to_port.items():
+            port = mac_table.lookup(server.mac)
+            datapath = self.switches.get(datapath_id)
+            if port is None or datapath is None:
+                continue
+            ofproto = datapath.ofproto
+            parser = datapath.ofproto_parser
+            datapath.send_msg(parser.OFPPacketOut(datapath=datapath, buffer_id=ofproto.OFP_NO_BUFFER, in_port=ofproto.OFPP_CONTROLLER,
+                                                  actions=[parser.OFPActionOutput(port)], data=failover.create_health_probe(server)))
+            return True
+        return False
+
+    def health_reply_received(self, arp_pkt):
+        """
+        A server that answered a health probe is alive, and recovers if it failed.
+        """
+        server = self.servers.find_by_ip(arp_pkt.src_ip)
+        if server is not None:
+            self.missed_probes[server.range_id] = 0
+            self.servers_recovered([server], "a health probe was answered")
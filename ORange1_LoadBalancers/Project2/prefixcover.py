@@ -0,0 +1,72 @@
+"""
+The prefix compilation of the ranges, an alternative to the ELCP and comparator tables.
+
+Every range is split into the minimal set of CIDR prefixes that covers it. Each prefix gets a
+rule in table 1 that writes the range ID into the metadata and goes straight to table 5, so a
+packet takes three table lookups instead of up to six, at the price of more rules - up to 62
+for a range instead of two.
+"""
+
+# Number of tables a packet goes through in the worst case, including tables 0 and 5.
+ELCP_DEPTH = 6
+PREFIX_DEPTH = 3
+
+
+def range_to_prefixes(lower, upper):
+    """
+    Returns the minimal list of (value, prefix length) CIDR prefixes that covers exactly the
+    addresses from lower to upper. Each prefix is the largest aligned block that starts at the
+    first uncovered address and does not pass the upper bound.
+    """
+    prefixes = []
+    while lower <= upper:
+        size = (lower & -lower) if lower else 2**32
+        while size > upper - lower + 1:
+            size >>= 1
+        prefixes += [(lower, 32 - (size.bit_length() - 1))]
+        lower += size
+    return prefixes
+
+
+def probe_prefixes(lower, upper, number_of_probes):
+    """
+    Returns (value, prefix length) prefixes that cover exactly the addresses from lower to upper,
+    at least number_of_probes of them when there are enough addresses. The minimal cover is split
+    by halving its largest prefix until there are enough prefixes.
+    """
+    prefixes = range_to_prefixes(lower, upper)
+    while len(prefixes) < number_of_probes:
+        (value, prefix_length) = min(prefixes, key=lambda prefix: prefix[1])
+        if prefix_length == 32:
+            break
+        index = prefixes.index((value, prefix_length))
+        half = 2**(32 - prefix_length - 1)
+        prefixes[index:index + 1] = [(value, prefix_length + 1), (value + half, prefix_length + 1)]
+    return prefixes
+
+
+def prefix_to_ipv4(value, prefix_length):
+    """
+    Converts a prefix into a representation that is acceptable as src_ipv4.
+    """
+    mask = (2**32 - 1) ^ (2**(32 - prefix_length) - 1)
+    return (int_to_ipv4(value), int_to_ipv4(mask))
+
+
+def ipv4_to_int(ip):
+    value = 0
+    for part in ip.split("."):
+        value = value * 256 + int(part)
+    return value
+
+
+def int_to_ipv4(value):
+    return ".".join(str((value >> shift) & 255) for shift in (24, 16, 8, 0))
+
+
+def compilation_cost(number_of_rules, depth, lookup_cost):
+    """
+    Returns the cost of a compilation - its rules, plus its pipeline depth where every
+    table lookup costs as much as lookup_cost rules.
+    """
+    return number_of_rules + depth * lookup_cost
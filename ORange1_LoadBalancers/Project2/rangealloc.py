@@ -0,0 +1,316 @@
+"""
+Proportional allocation of the address space between the servers.
+
+The traffic over the address space is estimated by segments - (lower, upper, packets) tuples
+that cover the addresses in order, with the packets of a segment spread evenly over its
+addresses. The ranges of the servers are the current segments with their measured packet
+counts, and finer segments give a better estimate.
+"""
+
+import bisect
+
+import prefixcover
+
+
+def allocate_ranges(segments, weights, low=0, high=2**32-1, uniform_share=0.01, min_size=2):
+    """
+    Divides the addresses from low to high into consecutive ranges, one for each weight, so the
+    estimated traffic of each range is proportional to its weight. Returns a list of
+    (lower, upper) tuples.
+
+    A share of uniform_share of the traffic is assumed to be spread evenly over all the
+    addresses, so addresses that had no traffic in the last interval are not given away for
+    free. Each range gets at least min_size addresses.
+    """
+    number_of_ranges = len(weights)
+    total_weight = float(sum(weights))
+    total_packets = float(sum(packets for (lower, upper, packets) in segments))
+    # With no traffic, the ranges are proportional to the weights.
+    if total_packets == 0:
+        segments = [(low, high, 1)]
+        total_packets = 1.0
+    floor = total_packets * uniform_share / (high - low + 1) # Packets added to each address.
+    total = total_packets * (1 + uniform_share)
+
+    ranges = []
+    lower = low
+    target = 0.0 # The estimated packets from low to the end of the current range.
+    passed = 0.0 # The estimated packets from low to the start of the current segment.
+    segment_index = 0
+    for i in xrange(number_of_ranges - 1):
+        target += total * weights[i] / total_weight
+        # Find the segment in which the cumulative traffic reaches the target.
+        while segment_index < len(segments) - 1:
+            (segment_lower, segment_upper, packets) = segments[segment_index]
+            segment_total = packets + floor * (segment_upper - segment_lower + 1)
+            if passed + segment_total >= target:
+                break
+            passed += segment_total
+            segment_index += 1
+        (segment_lower, segment_upper, packets) = segments[segment_index]
+        density = float(packets) / (segment_upper - segment_lower + 1) + floor
+        upper = segment_lower + int(round((target - passed) / density)) - 1
+        # Leave room for this range and all the ranges after it.
+        upper = max(upper, lower + min_size - 1)
+        upper = min(upper, high - (number_of_ranges - 1 - i) * min_size, segment_upper)
+        upper = max(upper, lower + min_size - 1)
+        ranges += [(lower, upper)]
+        lower = upper + 1
+    ranges += [(lower, high)]
+    return ranges
+
+
+def load_histogram(path):
+    """
+    Loads a histogram of client addresses from a file. Every line holds an address or a CIDR
+    prefix, optionally followed by a count (1 by default). Empty lines and lines starting with #
+    are skipped. Returns a list of (lower, upper, count) tuples.
+    """
+    points = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            count = float(fields[1]) if len(fields) > 1 else 1
+            if "/" in fields[0]:
+                (ip, prefix_length) = fields[0].split("/")
+                size = 2**(32 - int(prefix_length))
+                lower = prefixcover.ipv4_to_int(ip) // size * size
+                points += [(lower, lower + size - 1, count)]
+            else:
+                address = prefixcover.ipv4_to_int(fields[0])
+                points += [(address, address, count)]
+    return points
+
+
+def histogram_segments(points, low=0, high=2**32-1):
+    """
+    Returns segments that cover the addresses from low to high, with the counts of the given
+    (lower, upper, count) points and no traffic between them. The count of a point that is cut,
+    because it passes the limits or overlaps a former point, is cut by the same share.
+    """
+    segments = []
+    position = low
+    for (lower, upper, count) in sorted(points):
+        (piece_lower, piece_upper) = (max(lower, position), min(upper, high))
+        if piece_lower > piece_upper:
+            continue
+        if piece_lower > position:
+            segments += [(position, piece_lower - 1, 0)]
+        segments += [(piece_lower, piece_upper, float(count) * (piece_upper - piece_lower + 1) / (upper - lower + 1))]
+        position = piece_upper + 1
+    if position <= high:
+        segments += [(position, high, 0)]
+    return segments
+
+
+def find_range(ranges, address):
+    """
+    Returns the position of the (lower, upper) range that holds the address, or None. The ranges are in order.
+    """
+    position = bisect.bisect_right(ranges, (address, 2**32)) - 1
+    if position >= 0 and address <= ranges[position][1]:
+        return position
+    return None
+
+
+def segments_of_ranges(ranges, packets):
+    """
+    Returns the segments of ranges with the packet count of each range.
+    """
+    return [(lower, upper, count) for ((lower, upper), count) in zip(ranges, packets)]
+
+
+def refine_segments(estimate, ranges, packets, max_segments, tolerance=0.1):
+    """
+    Returns a new estimate of the traffic by the packets measured in each range. The segments of
+    the former estimate are cut at the limits of the ranges, and the packets of each range are
+    spread over its pieces in proportion to their former traffic. So the totals of the ranges
+    follow the latest measurement, and the shape inside them is learned over several intervals.
+
+    Neighbouring segments of about the same density (by tolerance) are merged. If there are still
+    more than max_segments, the former estimate is dropped and the ranges are the segments.
+    """
+    if not estimate:
+        return segments_of_ranges(ranges, packets)
+    segments = []
+    index = 0
+    for ((lower, upper), count) in zip(ranges, packets):
+        # The pieces of the former segments inside the range, with their former traffic.
+        pieces = []
+        while index < len(estimate) and estimate[index][0] <= upper:
+            (segment_lower, segment_upper, segment_packets) = estimate[index]
+            piece_lower = max(lower, segment_lower)
+            piece_upper = min(upper, segment_upper)
+            share = float(piece_upper - piece_lower + 1) / (segment_upper - segment_lower + 1)
+            pieces += [(piece_lower, piece_upper, segment_packets * share)]
+            if segment_upper > upper:
+                break
+            index += 1
+        former = sum(piece[2] for piece in pieces)
+        for (piece_lower, piece_upper, piece_packets) in pieces:
+            if former > 0:
+                segments += [(piece_lower, piece_upper, count * piece_packets / former)]
+            else:
+                segments += [(piece_lower, piece_upper, float(count) * (piece_upper - piece_lower + 1) / (upper - lower + 1))]
+    segments = merge_segments(segments, tolerance)
+    if len(segments) > max_segments:
+        return segments_of_ranges(ranges, packets)
+    return segments
+
+
+def reshape_segments(segments, probes, tolerance=0.1):
+    """
+    Returns the segments, where the traffic inside each span of consecutive probes is spread by
+    the packets of the probes instead of by the former estimate. The probes are (lower, upper,
+    packets) tuples in order, counted over the same time. The total traffic of a span is kept,
+    only its shape changes. A span whose probes counted no packets is left as it was.
+    """
+    if not probes:
+        return segments
+    spans = [] # (lower, upper, probes of the span) tuples.
+    for probe in probes:
+        if spans and spans[-1][1] + 1 == probe[0]:
+            spans[-1] = (spans[-1][0], probe[1], spans[-1][2] + [probe])
+        else:
+            spans += [(probe[0], probe[1], [probe])]
+    reshaped = []
+    inside = [[] for span in spans] # The pieces of the segments inside each span.
+    for (lower, upper, packets) in segments:
+        # Cut the segment at the limits of the spans.
+        position = lower
+        for (index, (span_lower, span_upper, span_probes)) in enumerate(spans):
+            if span_upper < position or span_lower > upper:
+                continue
+            if span_lower > position:
+                reshaped += [(position, span_lower - 1, packets * float(span_lower - position) / (upper - lower + 1))]
+                position = span_lower
+            piece_upper = min(upper, span_upper)
+            inside[index] += [(position, piece_upper, packets * float(piece_upper - position + 1) / (upper - lower + 1))]
+            position = piece_upper + 1
+        if position <= upper:
+            reshaped += [(position, upper, packets * float(upper - position + 1) / (upper - lower + 1))]
+    for ((span_lower, span_upper, span_probes), pieces) in zip(spans, inside):
+        counted = float(sum(probe[2] for probe in span_probes))
+        if counted == 0:
+            reshaped += pieces
+            continue
+        total = sum(piece[2] for piece in pieces)
+        reshaped += [(probe_lower, probe_upper, total * probe_packets / counted) for (probe_lower, probe_upper, probe_packets) in span_probes]
+    reshaped.sort()
+    return merge_segments(reshaped, tolerance)
+
+
+def merge_segments(segments, tolerance):
+    """
+    Returns the segments, where neighbouring segments whose densities differ by no more than
+    tolerance are merged.
+    """
+    merged = [segments[0]]
+    for (lower, upper, packets) in segments[1:]:
+        (last_lower, last_upper, last_packets) = merged[-1]
+        density = float(packets) / (upper - lower + 1)
+        last_density = float(last_packets) / (last_upper - last_lower + 1)
+        if abs(density - last_density) <= tolerance * max(density, last_density):
+            merged[-1] = (last_lower, upper, last_packets + packets)
+        else:
+            merged += [(lower, upper, packets)]
+    return merged
+
+
+def keep_boundaries(old_ranges, new_ranges, tolerance):
+    """
+    Returns the new ranges, where each boundary that moved by no more than tolerance of the
+    smaller of its two new ranges is kept in its old place, so its rules are not rewritten.
+    The tolerance should be below 0.5, so the boundaries stay in order.
+    """
+    uppers = []
+    for i in xrange(len(new_ranges) - 1):
+        old_upper = old_ranges[i][1]
+        new_upper = new_ranges[i][1]
+        smaller = min(new_ranges[i][1] - new_ranges[i][0], new_ranges[i + 1][1] - new_ranges[i + 1][0]) + 1
+        if abs(new_upper - old_upper) <= tolerance * smaller:
+            uppers += [old_upper]
+        else:
+            uppers += [new_upper]
+    ranges = []
+    lower = new_ranges[0][0]
+    for upper in uppers:
+        ranges += [(lower, upper)]
+        lower = upper + 1
+    ranges += [(lower, new_ranges[-1][1])]
+    return ranges
+
+
+def insert_range(ranges, position, size, min_size=2):
+    """
+    Returns the ranges with a new range at the position, of about size addresses that are taken
+    from the ranges around it, half from each. Each of them keeps at least half of its addresses.
+    Only the boundaries next to the new range move. Raises ValueError if there is no room for
+    min_size addresses.
+    """
+    sides = [j for j in (position - 1, position) if 0 <= j < len(ranges)]
+    takes = {}
+    need = size
+    for j in sides:
+        # The range before gives half, and the range after gives the rest.
+        share = need / 2 if j < position and len(sides) > 1 else need
+        takes[j] = max(0, min(share, (ranges[j][1] - ranges[j][0] + 1) / 2))
+        need -= takes[j]
+    if sum(takes.values()) < min_size:
+        raise ValueError("There is no room for a new range at position %d" %(position, ))
+    ranges = [list(r) for r in ranges]
+    if position - 1 in takes:
+        lower = ranges[position - 1][1] - takes[position - 1] + 1
+        ranges[position - 1][1] = lower - 1
+    else:
+        lower = ranges[position][0]
+    upper = lower + sum(takes.values()) - 1
+    if position in takes:
+        ranges[position][0] = upper + 1
+    ranges.insert(position, [lower, upper])
+    return [tuple(r) for r in ranges]
+
+
+def remove_range(ranges, position):
+    """
+    Returns the ranges without the range at the position, whose addresses are given to the ranges
+    around it, half to each. Only the boundaries next to the removed range move.
+    """
+    ranges = [list(r) for r in ranges]
+    (lower, upper) = ranges.pop(position)
+    if position == 0:
+        ranges[0][0] = lower
+    elif position == len(ranges):
+        ranges[-1][1] = upper
+    else:
+        middle = lower + (upper - lower + 1) / 2
+        ranges[position - 1][1] = middle - 1
+        ranges[position][0] = middle
+    return [tuple(r) for r in ranges]
+
+
+def resize_range(ranges, position, size, min_size=2):
+    """
+    Returns the ranges where the range at the position grows or shrinks to about size addresses,
+    by moving its boundaries with the ranges around it, half on each side. A range that addresses
+    are taken from keeps at least half of them, and the resized range keeps at least min_size.
+    """
+    ranges = [list(r) for r in ranges]
+    sides = [j for j in (position - 1, position + 1) if 0 <= j < len(ranges)]
+    change = size - (ranges[position][1] - ranges[position][0] + 1)
+    for j in sides:
+        share = change / 2 if j < position and len(sides) > 1 else change
+        if share > 0:
+            amount = min(share, (ranges[j][1] - ranges[j][0] + 1) / 2)
+        else:
+            amount = max(share, min_size - (ranges[position][1] - ranges[position][0] + 1))
+        if j < position:
+            ranges[j][1] -= amount
+            ranges[position][0] -= amount
+        else:
+            ranges[j][0] += amount
+            ranges[position][1] += amount
+        change -= amount
+    return [tuple(r) for r in ranges]
@@ -0,0 +1,92 @@
+"""
+The select group offload of the load balancer, an alternative to the range tables.
+
+A single OpenFlow select group has a bucket for every server, and the switch picks a bucket for
+every flow by hashing it in the datapath. Table 1 only holds a rule that sends the traffic to the
+group, so re-partitioning is a single group modification that changes the bucket weights. The
+counters of the buckets are the packet counts of the servers.
+"""
+
+from ryu.ofproto import ofproto_v1_3, ether
+
+GROUP_ID = 1
+MAX_BUCKET_WEIGHT = 1000 # The weight of the heaviest bucket. Bucket weights are 16 bit integers.
+MAX_CORRECTION = 4 # The most a bucket weight is multiplied or divided by when re-weighting.
+
+
+def supports_select(features):
+    """
+    Returns True if the group features (the body of a group features reply) allow weighted
+    select groups.
+    """
+    ofproto = ofproto_v1_3
+    return (features.types & (1 << ofproto.OFPGT_SELECT) != 0
+            and features.capabilities & ofproto.OFPGFC_SELECT_WEIGHT != 0
+            and features.max_groups[ofproto.OFPGT_SELECT] > 0)
+
+
+def bucket_weights(weights):
+    """
+    Scales the weights to bucket weights - the heaviest gets MAX_BUCKET_WEIGHT and every bucket
+    gets at least 1.
+    """
+    heaviest = max(weights)
+    return [max(1, int(round(MAX_BUCKET_WEIGHT * weight / float(heaviest)))) for weight in weights]
+
+
+def reweight(buckets, packets, weights):
+    """
+    Returns the bucket weights that should make the share of the packets of each server match
+    its share of the weights, given the current bucket weights and the packets each server got
+    with them. Each bucket weight is corrected by the ratio of the two shares, bounded by
+    MAX_CORRECTION, since a server with no packets tells nothing about how much it should get.
+    """
+    total_packets = float(sum(packets))
+    total_weight = float(sum(weights))
+    if total_packets == 0:
+        return list(buckets)
+    corrected = []
+    for (bucket, count, weight) in zip(buckets, packets, weights):
+        target = weight / total_weight
+        share = max(count / total_packets, target / MAX_CORRECTION)
+        corrected += [bucket * min(target / share, MAX_CORRECTION)]
+    return bucket_weights(corrected)
+
+
+def create_group_mod(datapath, servers, buckets, command=ofproto_v1_3.OFPGC_ADD):
+    """
+    Creates the group mod that adds the group (or modifies it, given OFPGC_MODIFY) with a bucket
+    for every server. A bucket sends the packet to its server like the server's rule in table 5.
+    """
+    ofproto = datapath.ofproto
+    parser = datapath.ofproto_parser
+    group_buckets = []
+    for (server, weight) in zip(servers, buckets):
+        actions = [parser.OFPActionSetField(eth_dst=server.mac),
+                   parser.OFPActionSetField(ipv4_dst=server.ip),
+                   parser.OFPActionOutput(ofproto.OFPP_NORMAL)]
+        group_buckets += [parser.OFPBucket(weight=weight, watch_port=ofproto.OFPP_ANY,
+                                           watch_group=ofproto.OFPG_ANY, actions=actions)]
+    return parser.OFPGroupMod(datapath, command, ofproto.OFPGT_SELECT, GROUP_ID, group_buckets)
+
+
+def create_group_rule(datapath):
+    """
+    Creates the rule of table 1 that sends all the traffic to the group.
+    """
+    ofproto = datapath.ofproto
+    parser = datapath.ofproto_parser
+    instructions = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, [parser.OFPActionGroup(GROUP_ID)])]
+    return parser.OFPFlowMod(datapath=datapath, priority=0, match=parser.OFPMatch(eth_type=ether.ETH_TYPE_IP),
+                             instructions=instructions, table_id=1)
+
+
+def bucket_packets(body):
+    """
+    Returns the packet count of every bucket in the body of a group stats reply, or None if the
+    group is not in it.
+    """
+    for stat in body:
+        if stat.group_id == GROUP_ID:
+            return [bucket.packet_count for bucket in stat.bucket_stats]
+    return None
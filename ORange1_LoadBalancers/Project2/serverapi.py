@@ -0,0 +1,109 @@
+"""
+The REST interface that adds, drains, removes and re-weights servers at runtime, served by Ryu's
+web server. Each change is applied by MicDekLoad with a minimal split or merge of the ranges, so
+only the rules of the affected ranges are sent to the switches.
+
+    GET    /servers               - the servers, in the order of their ranges
+    POST   /servers               - add a server, {"mac": ..., "ip": ..., "weight": ..., "position": ...}
+    PUT    /servers/{ip}          - set the weight of a server, and undrain it, {"weight": ...}
+    POST   /servers/{ip}/drain    - stop sending new clients to a server
+    DELETE /servers/{ip}          - remove a server
+
+The interface has no authentication, so it is served only on MicDekLoad.api_host, the loopback
+address unless set otherwise.
+"""
+
+import json
+
+from ryu.app.wsgi import ControllerBase, route
+from webob import Response
+
+
+def describe_server(app, server):
+    """
+    Returns the JSON representation of a server of the app.
+    """
+    position = app.servers.position_of(server)
+    state = "active"
+    if server.range_id in app.failed:
+        state = "failed"
+    elif server.range_id in app.drained:
+        state = "drained"
+    description = {"mac": server.mac, "ip": server.ip, "weight": server.weight, "position": position, "state": state}
+    if app.ranges:
+        description["range"] = list(app.ranges[position])
+    return description
+
+
+def json_response(value, status=200):
+    return Response(status=status, content_type="application/json", body=json.dumps(value))
+
+
+def error_response(message, status=400):
+    return json_response({"error": message}, status)
+
+
+class ServerController(ControllerBase):
+    """
+    Serves the server changes of a MicDekLoad, which registers it with Ryu's web server.
+    """
+    def __init__(self, req, link, data, **config):
+        super(ServerController, self).__init__(req, link, data, **config)
+        self.app = data
+
+    def read_body(self, req):
+        try:
+            body = json.loads(req.body) if req.body else {}
+        except ValueError:
+            raise ValueError("The body is not valid JSON")
+        if not isinstance(body, dict):
+            raise ValueError("The body should be a JSON object")
+        return body
+
+    def change(self, ip, action):
+        """
+        Applies the action to the server of the IP, and returns it as the response.
+        """
+        server = self.app.servers.find_by_ip(ip)
+        if server is None:
+            return error_response("There is no server %s" %(ip, ), 404)
+        try:
+            action(server)
+        except ValueError as e:
+            return error_response(str(e))
+        if self.app.servers.find_by_ip(ip) is None:
+            return json_response({"removed": ip})
+        return json_response(describe_server(self.app, server))
+
+    @route("servers", "/servers", methods=["GET"])
+    def list_servers(self, req, **kwargs):
+        return json_response([describe_server(self.app, server) for server in self.app.servers])
+
+    @route("servers", "/servers", methods=["POST"])
+    def add_server(self, req, **kwargs):
+        try:
+            body = self.read_body(req)
+            if "mac" not in body or "ip" not in body:
+                raise ValueError("A server needs a mac and an ip")
+            position = body.get("position")
+            server = self.app.add_server(str(body["mac"]), str(body["ip"]), float(body.get("weight", 1)),
+                                         int(position) if position is not None else None)
+        except (ValueError, TypeError) as e:
+            return error_response(str(e))
+        return json_response(describe_server(self.app, server), 201)
+
+    @route("servers", "/servers/{ip}", methods=["PUT"])
+    def set_weight(self, req, ip, **kwargs):
+        try:
+            weight = float(self.read_body(req)["weight"])
+        except (ValueError, TypeError, KeyError):
+            return error_response("The body should hold the new weight")
+        return self.change(ip, lambda server: self.app.set_server_weight(server, weight))
+
+    @route("servers", "/servers/{ip}/drain", methods=["POST"])
+    def drain(self, req, ip, **kwargs):
+        return self.change(ip, self.app.drain_server)
+
+    @route("servers", "/servers/{ip}", methods=["DELETE"])
+    def remove(self, req, ip, **kwargs):
+        return self.change(ip, self.app.remove_server)
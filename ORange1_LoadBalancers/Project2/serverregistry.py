@@ -0,0 +1,110 @@
+# Cookies of flows whose statistics are collected hold the flow type in their 32 MSBs and the
+# range ID in the others, so stats requests can ask for a single type using a cookie mask.
+COOKIE_TYPE_MASK = (2**32-1)*(2**32)
+RID_COOKIE = 2**32 # Flows of table 5.
+PIN_COOKIE = 2 * 2**32 # Flows that pin a client to a server, in table 1.
+PROBE_COOKIE = 3 * 2**32 # Flows that count the traffic of a sub-prefix of a range, in table 1.
+LEARN_COOKIE = 4 * 2**32 # Flows of the learning switch, in table 0.
+
+
+class Server(object):
+    """
+    A real server behind the load balancer.
+
+    The range ID is given once, when the server is added, and never changes. It is written
+    into the metadata of packets sent to the server and into the cookie of its rules.
+    """
+    def __init__(self, mac, ip, weight, range_id):
+        self.mac = mac
+        self.ip = ip
+        self.weight = weight
+        self.range_id = range_id
+        self.cookie = RID_COOKIE + range_id
+
+    def __repr__(self):
+        return "Server(%s, %s, %s, range_id=%d)" %(self.mac, self.ip, self.weight, self.range_id)
+
+
+class ServerRegistry(object):
+    """
+    The servers of the load balancer, in the order of their ranges, indexed by MAC, IP,
+    range ID and cookie. The indexes are updated incrementally when servers are added or removed.
+    """
+    def __init__(self, servers=()):
+        self.servers = []
+        self.by_mac = {}
+        self.by_ip = {}
+        self.by_range_id = {}
+        self.by_cookie = {}
+        self.positions = {} # The position of each server in the list, by range ID.
+        self.next_range_id = 0
+        for (mac, ip, weight) in servers:
+            self.add(mac, ip, weight)
+
+    def __len__(self):
+        return len(self.servers)
+
+    def __getitem__(self, position):
+        return self.servers[position]
+
+    def __iter__(self):
+        return iter(self.servers)
+
+    def add(self, mac, ip, weight, position=None):
+        """
+        Adds a server, by default after all others. Returns the new server.
+        """
+        if position is None:
+            position = len(self.servers)
+        server = Server(mac, ip, weight, self.next_range_id)
+        self.next_range_id += 1
+        self.servers.insert(position, server)
+        self.by_mac[self._mac_key(mac)] = server
+        self.by_ip[ip] = server
+        self.by_range_id[server.range_id] = server
+        self.by_cookie[server.cookie] = server
+        self._update_positions(position)
+        return server
+
+    def remove(self, server):
+        """
+        Removes a server. Returns its position before the removal.
+        """
+        position = self.positions.pop(server.range_id)
+        del self.servers[position]
+        del self.by_mac[self._mac_key(server.mac)]
+        del self.by_ip[server.ip]
+        del self.by_range_id[server.range_id]
+        del self.by_cookie[server.cookie]
+        self._update_positions(position)
+        return position
+
+    def position_of(self, server):
+        """
+        Returns the position of the server in the list, which is also the position of its range.
+        """
+        return self.positions[server.range_id]
+
+    def find_by_mac(self, mac):
+        return self.by_mac.get(self._mac_key(mac))
+
+    def find_by_ip(self, ip):
+        return self.by_ip.get(ip)
+
+    def find_by_range_id(self, range_id):
+        return self.by_range_id.get(range_id)
+
+    def find_by_cookie(self, cookie):
+        return self.by_cookie.get(cookie)
+
+    def weights(self):
+        return [server.weight for server in self.servers]
+
+    def _update_positions(self, start):
+        # Only the servers from the changed position onwards have moved.
+        for i in xrange(start, len(self.servers)):
+            self.positions[self.servers[i].range_id] = i
+
+    @staticmethod
+    def _mac_key(mac):
+        return mac.replace(":", "").lower()
@@ -0,0 +1,115 @@
+import random
+import time
+
+from ryu.lib import hub
+from ryu.ofproto import ofproto_v1_3
+
+import metrics
+
+
+class StatsJob(object):
+    """
+    A periodic statistics request of a single datapath.
+    """
+    def __init__(self, datapath, interval, create_request, callback, jitter):
+        self.datapath = datapath
+        self.interval = interval
+        self.create_request = create_request
+        self.callback = callback
+        self.jitter = jitter
+        self.active = True
+        self.thread = None
+        self.last_round_trip = None
+
+    def next_delay(self):
+        """
+        Returns the number of seconds until the next request - the interval, moved randomly by up to the jitter.
+        """
+        return max(0, self.interval + random.uniform(-self.jitter, self.jitter))
+
+
+class OutstandingRequest(object):
+    """
+    A request that was sent and waits for the last part of its reply.
+    """
+    def __init__(self, job):
+        self.job = job
+        self.body = []
+        self.send_time = time.time()
+
+
+class StatsScheduler(object):
+    """
+    Asks datapaths for statistics periodically.
+
+    All the datapaths are served by green threads of a single scheduler. Requests are tracked
+    by their xid, and multipart replies are collected until their last part arrives. Only then
+    the full reply body is handed to the callback.
+    """
+    def __init__(self):
+        self.jobs = {} # By datapath ID.
+        self.outstanding = {} # By (datapath ID, xid).
+
+    def schedule(self, datapath, interval, create_request, callback, jitter=0):
+        """
+        Starts asking the datapath for statistics every interval seconds.
+        create_request is called with the datapath to create each request, and callback is
+        called with the datapath and the full reply body. A datapath has a single job,
+        scheduling again replaces it.
+        """
+        self.cancel(datapath)
+        job = StatsJob(datapath, interval, create_request, callback, jitter)
+        self.jobs[datapath.id] = job
+        job.thread = hub.spawn(self._run, job)
+        return job
+
+    def cancel(self, datapath):
+        """
+        Stops asking the datapath for statistics. Replies to requests that were already sent are ignored.
+        """
+        job = self.jobs.pop(datapath.id, None)
+        if job is None:
+            return
+        job.active = False
+        self._drop_outstanding(job)
+
+    def cancel_all(self):
+        for job in list(self.jobs.values()):
+            self.cancel(job.datapath)
+
+    def _drop_outstanding(self, job):
+        for key in [key for key in self.outstanding if self.outstanding[key].job is job]:
+            del self.outstanding[key]
+
+    def _run(self, job):
+        while job.active:
+            hub.sleep(job.next_delay())
+            if job.active:
+                self._request(job)
+
+    def _request(self, job):
+        # A former request of the job that was not answered by now is given up.
+        self._drop_outstanding(job)
+        datapath = job.datapath
+        req = job.create_request(datapath)
+        datapath.set_xid(req)
+        self.outstanding[(datapath.id, req.xid)] = OutstandingRequest(job)
+        datapath.send_msg(req)
+
+    def handle_reply(self, msg):
+        """
+        Should be called with every statistics reply.
+        Returns True iff the reply belongs to a request of the scheduler.
+        """
+        key = (msg.datapath.id, msg.xid)
+        request = self.outstanding.get(key)
+        if request is None:
+            return False
+        request.body.extend(msg.body)
+        if msg.flags & ofproto_v1_3.OFPMPF_REPLY_MORE:
+            return True
+        del self.outstanding[key]
+        request.job.last_round_trip = time.time() - request.send_time
+        metrics.registry.histogram("stats_round_trip_seconds").observe(request.job.last_round_trip)
+        request.job.callback(msg.datapath, request.body)
+        return True
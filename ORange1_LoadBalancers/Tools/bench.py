@@ -0,0 +1,239 @@
+#!/usr/bin/python
+
+"""
+Benchmarks of the controllers' hot paths: range creation, rule generation, rebalancing and
+stats handling. The controllers send their messages to a fake datapath that records them, so
+no switch is needed.
+
+Every case runs in a fresh process, so its peak memory is its own. The results are written
+as JSON, one record per case, so runs of different versions can be compared.
+
+usage: python bench.py [--servers 4,16,...] [--clients 10,...] [--rebalances 1,10] [--output bench.json]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import fakedp
+
+
+class Stat(object):
+    """
+    A flow stats entry, as found in the body of a flow stats reply.
+    """
+    def __init__(self, table_id, cookie, packet_count):
+        self.table_id = table_id
+        self.cookie = cookie
+        self.packet_count = packet_count
+        self.byte_count = packet_count * 100
+
+
+def create_servers(num_servers):
+    """
+    Returns (MAC, IP, weight) tuples of evenly weighted servers. Unlike confighelper, any number of servers is supported.
+    """
+    return [("02:00:00:%02x:%02x:%02x" % ((i + 1) >> 16 & 0xff, (i + 1) >> 8 & 0xff, (i + 1) & 0xff),
+             "10.%d.%d.%d" % ((i + 1) >> 16 & 0xff, (i + 1) >> 8 & 0xff, (i + 1) & 0xff),
+             1.0 / num_servers) for i in xrange(num_servers)]
+
+
+def skewed_counts(num_servers, total, rng):
+    """
+    Returns per-server packet counts where a few random servers get much more traffic than the rest.
+    """
+    counts = [total / num_servers] * num_servers
+    for i in rng.sample(xrange(num_servers), max(1, num_servers / 10)):
+        counts[i] *= 4
+    return counts
+
+
+def measure(datapath, func):
+    """
+    Runs func and returns its wall time with the flow mods and bytes it sent to the datapath.
+    """
+    datapath.clear()
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    return {"wall_time": elapsed, "flow_mods": len(datapath.flow_mods()), "messages": len(datapath.msgs),
+            "bytes": datapath.num_bytes}
+
+
+def bench_project1_ranges(servers, clients, rebalances):
+    import c
+    import Range
+    app = c.LoadBalancingSwitch().getSwitch(fakedp.FakeDatapath())
+    app.numOfServers = servers
+    app.getDefaultWeights()
+    rounds = max(1, rebalances)
+    start = time.time()
+    for _ in xrange(rounds):
+        Range.Range.idGen = 0
+        app.setRangesSubnetVersion(app.subnet)
+    return {"wall_time": (time.time() - start) / rounds, "flow_mods": 0, "messages": 0, "bytes": 0}
+
+
+def bench_project1_install(servers, clients, rebalances):
+    import pipesim
+    datapath = fakedp.FakeDatapath()
+    return measure(datapath, lambda: pipesim.build_project1(servers, clients, datapath))
+
+
+def bench_project1_rebalance(servers, clients, rebalances):
+    import pipesim
+    (app, datapath, _, _) = pipesim.build_project1(servers, clients)
+    rng = random.Random(0)
+    totals = [0] * servers
+
+    def run():
+        for _ in xrange(rebalances):
+            counts = skewed_counts(servers, 100 * servers, rng)
+            for i in xrange(servers):
+                totals[i] += counts[i]
+            app.doBalancing(list(totals), datapath)
+            # The shadow mode waits for barrier replies, which the fake datapath never sends.
+            app.isRebalancing = False
+    return measure(datapath, run)
+
+
+def bench_project1_stats(servers, clients, rebalances):
+    import pipesim
+    import Flow
+    (app, datapath, _, _) = pipesim.build_project1(servers, clients)
+    # Stats handling without the rebalance it may trigger.
+    app.doBalancing = lambda counts, dp: None
+    body = [Stat(app.getStatsTable(), Flow.createCookie(Flow.RID_COOKIE, i), 1000) for i in xrange(servers)]
+    rounds = max(1, rebalances)
+    result = measure(datapath, lambda: [app.flowStatsReceived(datapath, body) for _ in xrange(rounds)])
+    result["wall_time"] /= rounds
+    return result
+
+
+def bench_micdekload_install(servers, clients, rebalances):
+    import pipesim
+    datapath = fakedp.FakeDatapath()
+    return measure(datapath, lambda: pipesim.build_micdekload(create_servers(servers), datapath))
+
+
+def bench_micdekload_find_lcp(servers, clients, rebalances):
+    import pipesim
+    (app, datapath, ranges, _) = pipesim.build_micdekload(create_servers(servers))
+    start = time.time()
+    for (lower, upper) in ranges:
+        app.find_lcp(lower, upper)
+    return {"wall_time": time.time() - start, "flow_mods": 0, "messages": 0, "bytes": 0}
+
+
+def bench_micdekload_repartition(servers, clients, rebalances):
+    import pipesim
+    (app, datapath, _, _) = pipesim.build_micdekload(create_servers(servers))
+    rng = random.Random(0)
+
+    def run():
+        for _ in xrange(rebalances):
+            app.repartition(datapath, skewed_counts(servers, 100 * servers, rng))
+    return measure(datapath, run)
+
+
+def bench_micdekload_stats(servers, clients, rebalances):
+    import pipesim
+    (app, datapath, _, _) = pipesim.build_micdekload(create_servers(servers))
+    # Stats handling without the repartition it may trigger.
+    app.check_partition = lambda datapath: None
+    body = [Stat(5, server.cookie, 1000) for server in app.servers]
+    rounds = max(1, rebalances)
+    result = measure(datapath, lambda: [app.flow_stats_received(datapath, body) for _ in xrange(rounds)])
+    result["wall_time"] /= rounds
+    return result
+
+
+CASES = {
+    "project1_ranges": bench_project1_ranges,
+    "project1_install": bench_project1_install,
+    "project1_rebalance": bench_project1_rebalance,
+    "project1_stats": bench_project1_stats,
+    "micdekload_install": bench_micdekload_install,
+    "micdekload_find_lcp": bench_micdekload_find_lcp,
+    "micdekload_repartition": bench_micdekload_repartition,
+    "micdekload_stats": bench_micdekload_stats,
+}
+
+
+def run_case(args):
+    """
+    Runs a single case. Called in a fresh worker process.
+    """
+    (case, servers, clients, rebalances) = args
+    # The controllers print a lot while rebalancing.
+    devnull = open(os.devnull, "w")
+    stdout = sys.stdout
+    sys.stdout = devnull
+    try:
+        result = CASES[case](servers, clients, rebalances)
+        error = None
+    except Exception as e:
+        result = {}
+        error = "%s: %s" %(type(e).__name__, e)
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+    record = {"case": case, "servers": servers, "clients": clients, "rebalances": rebalances, "error": error,
+              "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    record.update(result)
+    return record
+
+
+def version():
+    """
+    Returns the git revision of the tree being benchmarked.
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=fakedp.TOOLS_DIR,
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def int_list(value):
+    return [int(x) for x in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the load balancer controllers.")
+    parser.add_argument("--servers", type=int_list, default=[4, 16, 64, 256, 1024, 10000])
+    parser.add_argument("--clients", type=int_list, default=[10])
+    parser.add_argument("--rebalances", type=int_list, default=[1, 10])
+    parser.add_argument("--cases", type=lambda v: v.split(","), default=sorted(CASES))
+    parser.add_argument("--output", default="bench_output.json")
+    args = parser.parse_args()
+
+    jobs = [(case, servers, clients, rebalances) for case in args.cases for servers in args.servers
+            for clients in args.clients for rebalances in args.rebalances]
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    records = []
+    for record in pool.imap(run_case, jobs):
+        records.append(record)
+        if record["error"]:
+            print "%-24s servers=%-6d clients=%-4d rebalances=%-3d ERROR %s" %(
+                record["case"], record["servers"], record["clients"], record["rebalances"], record["error"])
+        else:
+            print "%-24s servers=%-6d clients=%-4d rebalances=%-3d %9.4fs %7d flow mods %9d bytes %8d KB" %(
+                record["case"], record["servers"], record["clients"], record["rebalances"], record["wall_time"],
+                record["flow_mods"], record["bytes"], record["peak_rss_kb"])
+    pool.close()
+    pool.join()
+
+    with open(args.output, "w") as f:
+        json.dump({"version": version(), "time": time.time(), "results": records}, f, indent=1, sort_keys=True)
+    print "Results were written to %s" % args.output
+
+
+if __name__ == "__main__":
+    main()
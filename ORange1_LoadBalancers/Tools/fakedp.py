@@ -0,0 +1,68 @@
+import os
+import sys
+
+from ryu.ofproto import ofproto_v1_3, ofproto_v1_3_parser
+
+# The controllers use flat imports of their own modules, so their directories are added to the path.
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT1_DIR = os.path.join(TOOLS_DIR, "..", "Project1", "Controller", "Split")
+PROJECT2_DIR = os.path.join(TOOLS_DIR, "..", "Project2")
+for project_dir in (PROJECT1_DIR, PROJECT2_DIR):
+    if project_dir not in sys.path:
+        sys.path.insert(0, project_dir)
+
+
+class FakeDatapath(object):
+    """
+    A datapath that records the messages sent to it instead of writing them to a switch.
+
+    Messages sent one by one go through send_msg. Messages sent in a batch are serialized by
+    the batch and written with send, so they are recorded when the batch gives them an xid.
+    Either way, every message is recorded exactly once, in the order it was sent, and the
+    number of serialized bytes is counted.
+    """
+    def __init__(self, dpid=2, ports=()):
+        self.id = dpid
+        self.ofproto = ofproto_v1_3
+        self.ofproto_parser = ofproto_v1_3_parser
+        self.ports = dict((port, None) for port in ports)
+        self.xid = 0
+        self.msgs = []
+        self.num_bytes = 0
+        self.num_writes = 0
+        self.serialize = True # Whether send_msg serializes messages, like the real datapath does.
+
+    def set_xid(self, msg):
+        self.xid += 1
+        msg.set_xid(self.xid)
+        self.msgs.append(msg)
+        return self.xid
+
+    def send_msg(self, msg, close_socket=False):
+        if msg.xid is None:
+            self.set_xid(msg)
+        else:
+            self.msgs.append(msg)
+        if self.serialize:
+            msg.serialize()
+            self.send(msg.buf)
+        return True
+
+    def send(self, buf, close_socket=False):
+        self.num_writes += 1
+        self.num_bytes += len(buf)
+        return True
+
+    def flow_mods(self):
+        """
+        Returns the recorded flow mod messages.
+        """
+        return [msg for msg in self.msgs if isinstance(msg, ofproto_v1_3_parser.OFPFlowMod)]
+
+    def clear(self):
+        """
+        Forgets the recorded messages and counters.
+        """
+        self.msgs = []
+        self.num_bytes = 0
+        self.num_writes = 0
@@ -0,0 +1,378 @@
+#!/usr/bin/python
+
+"""
+Offline software model of the OpenFlow pipeline that the load balancers program.
+
+The simulator takes the flow mods produced by the table builders, classifies arrays of
+synthetic IPv4 packets through the resulting tables with NumPy, and reports how many packets
+reached each server and how many disagree with the intended ranges.
+
+usage: python pipesim.py [--project 1|2] [--servers N] [--packets N] [--compilation auto|elcp|prefix]
+"""
+
+import argparse
+import socket
+import struct
+import time
+
+import numpy as np
+
+import fakedp
+from ryu.ofproto import ofproto_v1_3, ofproto_v1_3_parser
+
+# Field values of packets that did not reach an output.
+NO_PORT = -1
+# Reasons a packet left the pipeline.
+OUTPUT = 0
+TABLE_MISS = 1
+NO_ACTIONS = 2
+LOOP = 3
+
+
+def ip_to_int(ip):
+    return struct.unpack(">I", socket.inet_aton(ip))[0]
+
+
+def int_to_ip(value):
+    return socket.inet_ntoa(struct.pack(">I", int(value)))
+
+
+def _value_and_mask(value, full_mask, convert):
+    # Match fields are either a value or a (value, mask) tuple.
+    if isinstance(value, tuple):
+        (value, mask) = value
+        mask = convert(mask)
+    else:
+        mask = full_mask
+    value = convert(value)
+    return (value & mask, mask)
+
+
+class Rule(object):
+    """
+    A single flow entry of a simulated table.
+    """
+    # Match fields the simulator understands. Rules with other fields never match.
+    SUPPORTED_FIELDS = ("eth_type", "ipv4_src", "ipv4_dst", "metadata")
+
+    def __init__(self, flow_mod, order):
+        self.flow_mod = flow_mod
+        self.table_id = flow_mod.table_id
+        self.priority = flow_mod.priority
+        self.cookie = flow_mod.cookie
+        self.order = order # Insertion order, to break ties of equal priorities deterministically.
+        self.key = rule_key(flow_mod)
+        self.supported = True
+        self.eth_type = None
+        self.fields = {} # Field name -> (value, mask).
+        for (name, value) in flow_mod.match.items():
+            if name == "eth_type":
+                self.eth_type = value
+            elif name in ("ipv4_src", "ipv4_dst"):
+                self.fields[name] = _value_and_mask(value, 0xffffffff, lambda v: ip_to_int(v) if isinstance(v, str) else int(v))
+            elif name == "metadata":
+                self.fields[name] = _value_and_mask(value, 2**64 - 1, int)
+            else:
+                self.supported = False
+
+        self.goto = None
+        self.write_metadata = None
+        self.actions = []
+        for inst in flow_mod.instructions:
+            if isinstance(inst, ofproto_v1_3_parser.OFPInstructionGotoTable):
+                self.goto = inst.table_id
+            elif isinstance(inst, ofproto_v1_3_parser.OFPInstructionWriteMetadata):
+                self.write_metadata = (inst.metadata, inst.metadata_mask)
+            elif isinstance(inst, ofproto_v1_3_parser.OFPInstructionActions):
+                self.actions.extend(inst.actions)
+
+    def match(self, packets, idx):
+        """
+        Returns a boolean array, whether each of the packets at the given indexes matches the rule.
+        """
+        if not self.supported or (self.eth_type is not None and self.eth_type != 0x800):
+            return np.zeros(len(idx), dtype=bool)
+        result = np.ones(len(idx), dtype=bool)
+        for (name, (value, mask)) in self.fields.items():
+            column = packets.fields[name][idx]
+            if name == "metadata":
+                result &= (column & np.uint64(mask)) == np.uint64(value)
+            else:
+                result &= (column & np.uint32(mask)) == np.uint32(value)
+        return result
+
+
+def rule_key(flow_mod):
+    """
+    Returns the identity of a flow entry: its table, priority and match.
+    """
+    return (flow_mod.table_id, flow_mod.priority, tuple(sorted((k, repr(v)) for (k, v) in flow_mod.match.items())))
+
+
+class Packets(object):
+    """
+    A set of IPv4 packets and their state while going through the pipeline.
+    """
+    def __init__(self, src, dst, start_table=0):
+        n = len(src)
+        self.fields = {
+            "ipv4_src": np.asarray(src, dtype=np.uint32).copy(),
+            "ipv4_dst": np.asarray(dst, dtype=np.uint32).copy(),
+            "metadata": np.zeros(n, dtype=np.uint64),
+        }
+        self.table = np.full(n, start_table, dtype=np.int32)
+        self.active = np.ones(n, dtype=bool)
+        self.out_port = np.full(n, NO_PORT, dtype=np.int64)
+        self.group = np.full(n, NO_PORT, dtype=np.int64)
+        self.eth_dst = np.zeros(n, dtype=np.int32) # Index into Pipeline.macs, 0 is unchanged.
+        self.reason = np.full(n, OUTPUT, dtype=np.int8)
+        self.rule_hits = {}
+
+    def __len__(self):
+        return len(self.table)
+
+
+class Pipeline(object):
+    """
+    The tables of a simulated switch, built by applying flow mods.
+    """
+    def __init__(self):
+        self.tables = {} # Table ID -> {rule key: Rule}.
+        self.macs = [None]
+        self.mac_ids = {}
+        self.order = 0
+        self.ignored = 0 # Messages that are not flow mods, or commands that are not simulated.
+
+    def apply(self, msgs):
+        """
+        Applies flow mod messages (add, modify, delete and strict delete) to the tables, in order.
+        """
+        for msg in msgs:
+            if not isinstance(msg, ofproto_v1_3_parser.OFPFlowMod):
+                self.ignored += 1
+                continue
+            if msg.command == ofproto_v1_3.OFPFC_ADD:
+                self.order += 1
+                rule = Rule(msg, self.order)
+                self.tables.setdefault(rule.table_id, {})[rule.key] = rule
+            elif msg.command == ofproto_v1_3.OFPFC_DELETE_STRICT:
+                self.tables.get(msg.table_id, {}).pop(rule_key(msg), None)
+            elif msg.command == ofproto_v1_3.OFPFC_DELETE and not msg.match.items():
+                # Only whole-table deletes are used by the controllers, possibly filtered by cookie.
+                tables = self.tables.keys() if msg.table_id == ofproto_v1_3.OFPTT_ALL else [msg.table_id]
+                for table_id in list(tables):
+                    self.tables[table_id] = dict((key, rule) for (key, rule) in self.tables.get(table_id, {}).items()
+                                                 if (rule.cookie & msg.cookie_mask) != (msg.cookie & msg.cookie_mask))
+            elif msg.command in (ofproto_v1_3.OFPFC_MODIFY, ofproto_v1_3.OFPFC_MODIFY_STRICT):
+                table = self.tables.get(msg.table_id, {})
+                if rule_key(msg) in table:
+                    old = table[rule_key(msg)]
+                    rule = Rule(msg, old.order)
+                    table[rule.key] = rule
+            else:
+                self.ignored += 1
+
+    def num_rules(self):
+        return sum(len(table) for table in self.tables.values())
+
+    def _mac_id(self, mac):
+        if mac not in self.mac_ids:
+            self.mac_ids[mac] = len(self.macs)
+            self.macs.append(mac)
+        return self.mac_ids[mac]
+
+    def classify(self, src, dst, start_table=0, max_tables=16):
+        """
+        Sends the packets through the pipeline. Returns the Packets with their final state.
+        """
+        packets = Packets(src, dst, start_table)
+        for _ in xrange(max_tables):
+            if not packets.active.any():
+                break
+            for table_id in np.unique(packets.table[packets.active]):
+                idx = np.nonzero(packets.active & (packets.table == table_id))[0]
+                self._run_table(int(table_id), idx, packets)
+        # Packets still active went through too many tables.
+        packets.reason[packets.active] = LOOP
+        packets.active[:] = False
+        return packets
+
+    def _run_table(self, table_id, idx, packets):
+        rules = sorted(self.tables.get(table_id, {}).values(), key=lambda r: (-r.priority, r.order))
+        pending = idx
+        for rule in rules:
+            if len(pending) == 0:
+                break
+            matched = rule.match(packets, pending)
+            hit = pending[matched]
+            pending = pending[~matched]
+            if len(hit) == 0:
+                continue
+            packets.rule_hits[rule.key] = packets.rule_hits.get(rule.key, 0) + len(hit)
+            self._execute(rule, hit, packets)
+        # Table miss with no miss flow - the packet is dropped.
+        packets.active[pending] = False
+        packets.reason[pending] = TABLE_MISS
+
+    def _execute(self, rule, hit, packets):
+        # Instructions are executed in the order of the specification: apply actions,
+        # write metadata and then go to table.
+        for action in rule.actions:
+            if isinstance(action, ofproto_v1_3_parser.OFPActionSetField):
+                if action.key in ("ipv4_src", "ipv4_dst"):
+                    packets.fields[action.key][hit] = ip_to_int(action.value)
+                elif action.key == "eth_dst":
+                    packets.eth_dst[hit] = self._mac_id(action.value)
+            elif isinstance(action, ofproto_v1_3_parser.OFPActionOutput):
+                packets.out_port[hit] = action.port
+            elif isinstance(action, ofproto_v1_3_parser.OFPActionGroup):
+                packets.group[hit] = action.group_id
+        if rule.write_metadata is not None:
+            (value, mask) = rule.write_metadata
+            column = packets.fields["metadata"]
+            column[hit] = (column[hit] & ~np.uint64(mask)) | np.uint64(value & mask)
+        if rule.goto is not None:
+            packets.table[hit] = rule.goto
+        else:
+            packets.active[hit] = False
+            no_output = hit[(packets.out_port[hit] == NO_PORT) & (packets.group[hit] == NO_PORT)]
+            packets.reason[no_output] = NO_ACTIONS
+
+
+def expected_servers(src, ranges):
+    """
+    Returns the index of the range that contains each source IP, or -1 if none does.
+    ranges is a list of (start, end) tuples.
+    """
+    order = sorted(xrange(len(ranges)), key=lambda i: ranges[i][0])
+    starts = np.array([ranges[i][0] for i in order], dtype=np.uint64)
+    ends = np.array([ranges[i][1] for i in order], dtype=np.uint64)
+    src = np.asarray(src, dtype=np.uint64)
+    pos = np.searchsorted(starts, src, side="right") - 1
+    valid = pos >= 0
+    pos[~valid] = 0
+    valid &= src <= ends[pos]
+    result = np.array(order, dtype=np.int64)[pos]
+    result[~valid] = -1
+    return result
+
+
+def actual_servers(packets, server_ips):
+    """
+    Returns the index of the server whose IP was written as the destination of each packet, or -1.
+    """
+    ips = np.array([ip_to_int(ip) for ip in server_ips], dtype=np.uint32)
+    order = np.argsort(ips)
+    sorted_ips = ips[order]
+    dst = packets.fields["ipv4_dst"]
+    pos = np.clip(np.searchsorted(sorted_ips, dst), 0, len(sorted_ips) - 1)
+    result = order[pos].astype(np.int64)
+    result[(sorted_ips[pos] != dst) | (packets.reason != OUTPUT)] = -1
+    return result
+
+
+def report(packets, src, ranges, server_ips):
+    """
+    Compares the simulated classification with the intended ranges.
+    Returns a dictionary with per-server hits and the mismatches.
+    """
+    expected = expected_servers(src, ranges)
+    actual = actual_servers(packets, server_ips)
+    num_servers = len(server_ips)
+    mismatch = expected != actual
+    return {
+        "packets": len(packets),
+        "hits": np.bincount(actual[actual >= 0], minlength=num_servers).tolist(),
+        "expected_hits": np.bincount(expected[expected >= 0], minlength=num_servers).tolist(),
+        "mismatches": int(mismatch.sum()),
+        "table_misses": int((packets.reason == TABLE_MISS).sum()),
+        "no_actions": int((packets.reason == NO_ACTIONS).sum()),
+        "loops": int((packets.reason == LOOP).sum()),
+        "mismatch_examples": [int_to_ip(ip) for ip in np.asarray(src)[mismatch][:10]],
+    }
+
+
+def build_project1(num_servers, num_clients, datapath=None):
+    """
+    Builds the Project1 controller with the given number of learned hosts and installs its tables.
+    Returns (app, datapath, ranges, server IPs), where app is the BalancedSwitch of the datapath.
+    Ranges are of the 192.168.0.0/16 subnet.
+    """
+    import c
+    import Range
+    datapath = datapath or fakedp.FakeDatapath()
+    c.LoadBalancingSwitch.numOfClients = num_clients
+    app = c.LoadBalancingSwitch().getSwitch(datapath)
+    app.clients = [(i + 1, "192.168.%d.%d" % ((i + 1) / 250, (i + 1) % 250 + 1), "00:00:00:00:01:%02x" % ((i + 1) % 256))
+                   for i in xrange(num_clients)]
+    app.servers = [(num_clients + i + 1, "10.0.%d.%d" % ((i + 1) / 250, (i + 1) % 250 + 1), "00:00:00:00:02:%02x" % ((i + 1) % 256))
+                   for i in xrange(num_servers)]
+    app.numOfServers = num_servers
+    app.totalHosts = num_servers + num_clients
+    app.getDefaultWeights()
+    Range.Range.idGen = 0
+    app.setRangesSubnetVersion(app.subnet)
+    app.chooseCompilation()
+    app.defineAllFlows(datapath, True)
+    app.areFlowsSet = True
+    return (app, datapath, project1_ranges(app), [server[1] for server in app.servers])
+
+
+def project1_ranges(app):
+    return [(r.start, r.end) for r in app.ranges]
+
+
+def build_micdekload(servers, datapath=None):
+    """
+    Builds MicDekLoad with the given (MAC, IP, weight) servers and installs its tables.
+    Returns (app, datapath, ranges, server IPs).
+    """
+    import loadbalancerconfig
+    import micdekload
+    datapath = datapath or fakedp.FakeDatapath()
+    loadbalancerconfig.servers = servers
+    app = micdekload.MicDekLoad()
+    app.create_rule_set(datapath)
+    return (app, datapath, list(app.ranges), [server.ip for server in app.servers])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the load balancer tables on synthetic traffic.")
+    parser.add_argument("--project", type=int, choices=(1, 2), default=1)
+    parser.add_argument("--servers", type=int, default=8)
+    parser.add_argument("--clients", type=int, default=10, help="learned clients (Project1 only)")
+    parser.add_argument("--packets", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compilation", choices=("auto", "elcp", "prefix"), default="auto")
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    if args.project == 1:
+        import c
+        c.LoadBalancingSwitch.compilationMode = args.compilation
+        (app, datapath, ranges, server_ips) = build_project1(args.servers, args.clients)
+        src = rng.randint(0, 2**16, size=args.packets).astype(np.uint32) + np.uint32(ip_to_int("192.168.0.0"))
+        dst = np.full(args.packets, ip_to_int("10.255.255.254"), dtype=np.uint32)
+    else:
+        import confighelper
+        import loadbalancerconfig
+        import micdekload
+        micdekload.MicDekLoad.compilation_mode = args.compilation
+        (app, datapath, ranges, server_ips) = build_micdekload(confighelper.create_even_weight_servers(args.servers))
+        src = rng.randint(0, 2**32, size=args.packets, dtype=np.uint64).astype(np.uint32)
+        dst = np.full(args.packets, ip_to_int(loadbalancerconfig.virtual_server[1]), dtype=np.uint32)
+
+    pipeline = Pipeline()
+    pipeline.apply(datapath.msgs)
+    start = time.time()
+    packets = pipeline.classify(src, dst)
+    elapsed = time.time() - start
+    result = report(packets, src, ranges, server_ips)
+    print "Rules: %d, packets: %d, classified in %.3f seconds (%.0f packets/second)" %(
+        pipeline.num_rules(), len(packets), elapsed, len(packets) / max(elapsed, 1e-9))
+    for (name, value) in sorted(result.items()):
+        print "%s: %s" %(name, value)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/python
+
+"""
+Replays the rebalance journal of a controller (see Project1's Journal and Project2's journal)
+against alternative rebalance policies, to tune them on recorded traffic instead of guessing.
+
+The traffic of every recorded interval is the packets each server got, spread evenly over the
+range it had then. A policy is replayed by running the controller with its constants on a fake
+datapath, in virtual time: every interval, the traffic is counted by the ranges the replayed
+controller has at that point and handed to it as a stats sample. Merging intervals replays a
+longer stats interval. For every policy, the number of rebalances, the rules they changed and
+the imbalance of the servers are reported, next to the recorded run.
+
+usage: python replay.py JOURNAL [--dpid N] [--merge 1,2] [--overload 1.2,1.5] [--min-average 10]
+                        [--imbalance-ratio 1.5,2] [--min-partition-packets 100] [--boundary-tolerance 0.02]
+"""
+
+import argparse
+import itertools
+import os
+import sys
+
+import fakedp
+import pipesim
+import journal
+
+
+class Interval(object):
+    """
+    The traffic of a recorded interval - (lower, upper, packets) segments - and the decision
+    recorded for it.
+    """
+    def __init__(self, time, segments):
+        self.time = time
+        self.segments = segments
+        self.diff = None
+        self.weights = None
+
+
+def read_intervals(path, dpid=None):
+    """
+    Reads a journal. Returns (config, modes, dpid, intervals) - the recorded policy constants and
+    modes, the datapath whose intervals are returned (by default the first one with samples) and
+    its intervals in order.
+    """
+    records = journal.read_journal(path)
+    config = [values for (record_type, t, record_dpid, values) in records if record_type == journal.CONFIG]
+    modes = [values for (record_type, t, record_dpid, values) in records if record_type == journal.MODES]
+    if dpid is None:
+        dpids = [record_dpid for (record_type, t, record_dpid, values) in records if record_type == journal.DELTAS]
+        if not dpids:
+            raise ValueError("%s has no stats samples" %(path, ))
+        dpid = dpids[0]
+    intervals = []
+    ranges = []
+    for (record_type, t, record_dpid, values) in records:
+        if record_dpid != dpid:
+            continue
+        if record_type == journal.RANGES:
+            ranges = zip(values[0::2], values[1::2])
+        elif record_type == journal.DELTAS:
+            # A counter which was reset by the switch gives a negative delta, its packets are unknown.
+            intervals += [Interval(t, [(lower, upper, max(0, packets)) for ((lower, upper), packets) in zip(ranges, values)])]
+        elif record_type == journal.DIFF and intervals:
+            intervals[-1].diff = values
+        elif record_type == journal.WEIGHTS and intervals:
+            intervals[-1].weights = values
+    return (config[0] if config else [], modes[0] if modes else [], dpid, intervals)
+
+
+def merge_intervals(intervals, merge):
+    """
+    Merges every merge consecutive intervals into one, as if the stats interval was that many
+    times longer. The decisions of merged intervals are summed.
+    """
+    merged = []
+    for start in xrange(0, len(intervals), merge):
+        group = intervals[start:start + merge]
+        interval = Interval(group[-1].time, [segment for i in group for segment in i.segments])
+        diffs = [i.diff for i in group if i.diff is not None]
+        interval.diff = [sum(values) for values in zip(*diffs)] if diffs else None
+        interval.weights = group[-1].weights
+        merged += [interval]
+    return merged
+
+
+def count_by_ranges(segments, ranges):
+    """
+    Returns the packets of the segments inside every (lower, upper) range, the packets of a
+    segment being spread evenly over its addresses.
+    """
+    counts = [0.0] * len(ranges)
+    for (lower, upper, packets) in segments:
+        if packets == 0:
+            continue
+        size = float(upper - lower + 1)
+        for i in xrange(len(ranges)):
+            overlap = min(upper, ranges[i][1]) - max(lower, ranges[i][0]) + 1
+            if overlap > 0:
+                counts[i] += packets * overlap / size
+    return [int(round(count)) for count in counts]
+
+
+def imbalance(loads, weights):
+    """
+    Returns how much more than its share the most loaded server got - the maximum over the servers
+    of the share of the packets divided by the share of the weights. 1 is a perfect balance.
+    """
+    total = float(sum(loads))
+    if total == 0:
+        return 1.0
+    return max((load / total) / (weight / float(sum(weights))) for (load, weight) in zip(loads, weights))
+
+
+def count_changes(msgs):
+    parser = fakedp.ofproto_v1_3_parser
+    return len([msg for msg in msgs if isinstance(msg, (parser.OFPFlowMod, parser.OFPGroupMod))])
+
+
+class Quiet(object):
+    """
+    Silences the prints of the controllers inside a with statement.
+    """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        return False
+
+
+def replay_project1(intervals, policy):
+    """
+    Replays the intervals through LoadBalancingSwitch.doBalancing with the policy's constants.
+    Returns (rebalances, changed rules, imbalance of every interval).
+    """
+    import c
+    import Range
+    c.LoadBalancingSwitch.minAveragePackets = policy["min_average"]
+    c.LoadBalancingSwitch.overloadFactor = policy["overload"]
+    ranges = [(lower, upper) for (lower, upper, packets) in intervals[0].segments]
+    with Quiet():
+        (switch, datapath, initial, server_ips) = pipesim.build_project1(len(ranges), 1)
+    Range.Range.idGen = 0
+    switch.ranges = [Range.Range(lower, upper) for (lower, upper) in ranges]
+    counters = [0] * len(ranges)
+    (rebalances, changes, imbalances) = (0, 0, [])
+    for interval in intervals:
+        loads = count_by_ranges(interval.segments, [(r.start, r.end) for r in switch.ranges])
+        imbalances += [imbalance(loads, [1] * len(loads))]
+        counters = [counter + load for (counter, load) in zip(counters, loads)]
+        sent = len(datapath.msgs)
+        with Quiet():
+            switch.doBalancing(list(counters), datapath)
+        changed = count_changes(datapath.msgs[sent:])
+        rebalances += 1 if changed else 0
+        changes += changed
+        # The counters of the replaced flows start again from zero, as the controller expects.
+        counters = list(switch.lastStats) if switch.lastStats else [0] * len(ranges)
+    return (rebalances, changes, imbalances)
+
+
+def replay_project2(intervals, policy, weights):
+    """
+    Replays the intervals through MicDekLoad.check_partition with the policy's constants.
+    Returns (rebalances, changed rules, imbalance of every interval).
+    """
+    import micdekload
+    micdekload.MicDekLoad.imbalance_ratio = policy["imbalance_ratio"]
+    micdekload.MicDekLoad.min_partition_packets = policy["min_partition_packets"]
+    micdekload.MicDekLoad.boundary_tolerance = policy["boundary_tolerance"]
+    ranges = [(lower, upper) for (lower, upper, packets) in intervals[0].segments]
+    servers = [("00:00:00:00:%02x:%02x" %(i / 256, i % 256), "10.1.%d.%d" %(i / 250, i % 250 + 1), weight)
+               for (i, weight) in enumerate(weights)]
+    with Quiet():
+        (app, datapath, initial, server_ips) = pipesim.build_micdekload(servers)
+    app.ranges = ranges
+    app.traffic = []
+    app.last_packets[datapath.id] = [0] * len(ranges)
+    app.skip_partition[datapath.id] = False
+    (rebalances, changes, imbalances) = (0, 0, [])
+    for interval in intervals:
+        loads = count_by_ranges(interval.segments, app.ranges)
+        imbalances += [imbalance(loads, weights)]
+        app.num_packets[:] = [last + load for (last, load) in zip(app.last_packets[datapath.id], loads)]
+        sent = len(datapath.msgs)
+        with Quiet():
+            app.check_partition(datapath)
+        changed = count_changes(datapath.msgs[sent:])
+        rebalances += 1 if changed else 0
+        changes += changed
+    return (rebalances, changes, imbalances)
+
+
+def recorded(intervals, weights):
+    """
+    Returns (rebalances, changed rules, imbalance of every interval) of the recorded run.
+    """
+    diffs = [interval.diff for interval in intervals if interval.diff is not None]
+    imbalances = [imbalance([packets for (lower, upper, packets) in interval.segments], weights) for interval in intervals]
+    return (len(diffs), sum(sum(diff) for diff in diffs), imbalances)
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def report_line(name, intervals, result):
+    (rebalances, changes, imbalances) = result
+    print "%-64s %9d %10d %8d %9.3f %9.3f %9.3f" %(name, intervals, rebalances, changes, sum(imbalances) / len(imbalances),
+                                                     percentile(imbalances, 0.95), max(imbalances))
+
+
+def parse_list(convert):
+    return lambda text: [convert(value) for value in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a rebalance journal against alternative policies.")
+    parser.add_argument("journal")
+    parser.add_argument("--dpid", type=int, default=None, help="the datapath to replay, by default the first one")
+    parser.add_argument("--merge", type=parse_list(int), default=[1], help="recorded intervals in a replayed stats interval")
+    parser.add_argument("--overload", type=parse_list(float), default=None, help="Project1 overloadFactor values")
+    parser.add_argument("--min-average", type=parse_list(float), default=None, help="Project1 minAveragePackets values")
+    parser.add_argument("--imbalance-ratio", type=parse_list(float), default=None, help="Project2 imbalance_ratio values")
+    parser.add_argument("--min-partition-packets", type=parse_list(int), default=None, help="Project2 min_partition_packets values")
+    parser.add_argument("--boundary-tolerance", type=parse_list(float), default=None, help="Project2 boundary_tolerance values")
+    args = parser.parse_args()
+
+    (config, modes, dpid, intervals) = read_intervals(args.journal, args.dpid)
+    if not intervals:
+        print "No intervals of datapath %d in %s" %(dpid, args.journal)
+        return
+    # Project1 records 3 constants (see c.CONFIG_NAMES) and Project2 records 4 (see micdekload.CONFIG_NAMES).
+    project = 1 if len(config) == 3 else 2
+    weights = intervals[0].weights or [1] * len(intervals[0].segments)
+    if project == 1:
+        weights = [1] * len(weights)
+        defaults = dict(zip(("stats_interval", "min_average", "overload"), config or (15, 10, 1.5)))
+        grid = {"min_average": args.min_average or [defaults["min_average"]], "overload": args.overload or [defaults["overload"]]}
+    else:
+        defaults = dict(zip(("stats_interval", "imbalance_ratio", "min_partition_packets", "boundary_tolerance"), config or (3, 2, 100, 0.02)))
+        grid = {"imbalance_ratio": args.imbalance_ratio or [defaults["imbalance_ratio"]],
+                "min_partition_packets": args.min_partition_packets or [int(defaults["min_partition_packets"])],
+                "boundary_tolerance": args.boundary_tolerance or [defaults["boundary_tolerance"]]}
+    # The modes change the rules of every rebalance, so the replays run under the recorded ones.
+    # Journals without modes are replayed under the defaults of the controller.
+    if project == 1:
+        import c
+        (controller, mode_names) = (c.LoadBalancingSwitch, c.CONFIG_MODES)
+    else:
+        import micdekload
+        (controller, mode_names) = (micdekload.MicDekLoad, micdekload.CONFIG_MODES)
+    journal.apply_modes(controller, mode_names, modes)
+    defaults.update((name, getattr(controller, name)) for (name, choices) in mode_names)
+    span = intervals[-1].time - intervals[0].time
+    print "Project%d datapath %d: %d intervals of %.1f seconds, recorded with %s" %(
+        project, dpid, len(intervals), span / max(1, len(intervals) - 1), ", ".join("%s=%s" %(k, v) for (k, v) in sorted(defaults.items())))
+    print "%-64s %9s %10s %8s %9s %9s %9s" %("policy", "intervals", "rebalances", "rules", "mean", "p95", "max")
+    report_line("recorded", len(intervals), recorded(intervals, weights))
+    names = sorted(grid)
+    for merge in args.merge:
+        merged = merge_intervals(intervals, merge)
+        for values in itertools.product(*[grid[name] for name in names]):
+            policy = dict(zip(names, values))
+            if project == 1:
+                result = replay_project1(merged, policy)
+            else:
+                result = replay_project2(merged, policy, weights)
+            name = ",".join("%s=%s" %(k, policy[k]) for k in names) + (" x%d" %(merge, ) if merge > 1 else "")
+            report_line(name, len(merged), result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+#!/usr/bin/python
+
+"""
+Replays packet captures (e.g. the per-server tcpdump captures of Topologies/top.txt) through a
+load balancer, without Mininet, to see how it balances real traffic.
+
+The captures are read through a memory map, one record header and IPv4 address pair at a time,
+so files larger than the memory are streamed. Packets are cut into stats intervals by their
+timestamps, in virtual time. Every interval, its packets are classified by the simulated tables
+of the controller (see pipesim), the counters of the rules they hit grow, and the counters are
+handed to the controller as a flow stats reply - to LoadBalancingSwitch.flowStatsReceived, which
+calls doBalancing, or to MicDekLoad.flow_stats_received, which re-partitions. The rules it sends
+back are applied to the tables before the next interval, and its barriers are answered once they
+are. For every interval, the packets of every server, their imbalance and the rules changed are
+reported.
+
+Only the source address of a packet decides its server. The ranges of Project1 are of its /16
+subnet, so the sources are folded into it by their low 16 bits unless --no-fold is given.
+
+usage: python tracereplay.py CAPTURE [CAPTURE ...] [--project 1|2] [--servers N] [--clients N]
+                             [--interval SECONDS] [--compilation auto|elcp|prefix] [--dst IP,...]
+                             [--chunk N] [--no-fold] [--output curves.csv]
+"""
+
+import argparse
+import heapq
+import mmap
+import struct
+
+import numpy as np
+
+import fakedp
+import pipesim
+from bench import Stat, create_servers
+from replay import Quiet, imbalance, percentile
+from ryu.ofproto import ofproto_v1_3, ofproto_v1_3_parser
+
+# Magics of the global header of a capture, as read in little endian, and the fraction of a
+# second of their timestamps.
+MAGICS = {0xa1b2c3d4: ("<", 1e-6), 0xd4c3b2a1: (">", 1e-6), 0xa1b23c4d: ("<", 1e-9), 0x4d3cb2a1: (">", 1e-9)}
+# Link types, by the offset of the IP header or None for Ethernet, whose offset depends on VLAN tags.
+ETHERNET = 1
+LINUX_SLL = 113
+LINKTYPES = {ETHERNET: None, LINUX_SLL: 16, 101: 0, 12: 0, 14: 0, 228: 0}
+VLAN_TYPES = (0x8100, 0x88a8)
+IPV4_TYPE = 0x800
+
+
+def read_capture(path, dst=None):
+    """
+    Yields the (time, source, destination) of the IPv4 packets of a capture file, as integers,
+    in the order of the file. Only the headers of the records and the addresses of the packets
+    are read. If dst is given, only packets to one of its addresses are.
+    """
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if len(data) < 24:
+            raise ValueError("%s is not a pcap file" %(path, ))
+        (magic, ) = struct.unpack_from("<I", data, 0)
+        if magic not in MAGICS:
+            raise ValueError("%s is not a pcap file (pcapng files should be converted with editcap -F pcap)" %(path, ))
+        (endian, resolution) = MAGICS[magic]
+        (linktype, ) = struct.unpack_from(endian + "I", data, 20)
+        if linktype & 0xffff not in LINKTYPES:
+            raise ValueError("%s has an unsupported link type %d" %(path, linktype))
+        ip_offset = LINKTYPES[linktype & 0xffff]
+        record = struct.Struct(endian + "IIII")
+        ethertype = struct.Struct("!H")
+        addresses = struct.Struct("!II")
+        offset = 24
+        end = len(data)
+        while offset + record.size <= end:
+            (seconds, fraction, captured, length) = record.unpack_from(data, offset)
+            packet = offset + record.size
+            offset = packet + captured
+            if offset > end:
+                break # The capture was cut in the middle of a packet.
+            if ip_offset is None:
+                header = 12
+                (kind, ) = ethertype.unpack_from(data, packet + header) if captured >= 14 else (0, )
+                while kind in VLAN_TYPES and captured >= header + 6:
+                    header += 4
+                    (kind, ) = ethertype.unpack_from(data, packet + header)
+                if kind != IPV4_TYPE:
+                    continue
+                ip = header + 2
+            elif ip_offset == 16:
+                if captured < 16 or ethertype.unpack_from(data, packet + 14)[0] != IPV4_TYPE:
+                    continue
+                ip = ip_offset
+            else:
+                ip = ip_offset
+            if captured < ip + 20 or ord(data[packet + ip]) >> 4 != 4:
+                continue
+            (source, destination) = addresses.unpack_from(data, packet + ip + 12)
+            if dst is not None and destination not in dst:
+                continue
+            yield (seconds + fraction * resolution, source, destination)
+    finally:
+        data.close()
+
+
+def read_captures(paths, dst=None):
+    """
+    Yields the packets of all the captures, merged by their time. Every capture is expected to
+    be in time order, as tcpdump writes them.
+    """
+    return heapq.merge(*[read_capture(path, dst) for path in paths])
+
+
+class Counters(object):
+    """
+    The packet counters of the rules of a simulated switch, by rule key. Like on a switch, the
+    counter of a rule starts from zero when the rule is added and is kept when it is modified.
+    """
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.rules = {} # Rule key -> (Rule, packets).
+
+    def sync(self):
+        """
+        Follows the rules of the tables. Called after messages were applied to them.
+        """
+        rules = {}
+        for table in self.pipeline.tables.values():
+            for (key, rule) in table.items():
+                (known, packets) = self.rules.get(key, (None, 0))
+                if known is not rule and rule.flow_mod.command == ofproto_v1_3.OFPFC_ADD:
+                    packets = 0
+                rules[key] = (rule, packets)
+        self.rules = rules
+
+    def add(self, hits):
+        for (key, packets) in hits.items():
+            (rule, count) = self.rules[key]
+            self.rules[key] = (rule, count + packets)
+
+    def body(self):
+        """
+        Returns the body of a flow stats reply of all the rules.
+        """
+        return [Stat(rule.table_id, rule.cookie, packets) for (rule, packets) in self.rules.values()]
+
+
+class Project1(object):
+    """
+    A LoadBalancingSwitch under replay, with its learned hosts and installed flows.
+    """
+    def __init__(self, num_servers, num_clients, compilation):
+        import c
+        import Batch
+        c.LoadBalancingSwitch.compilationMode = compilation
+        with Quiet():
+            (self.switch, self.datapath, ranges, self.server_ips) = pipesim.build_project1(num_servers, num_clients)
+        self.handle_barrier_reply = Batch.handleBarrierReply
+        self.stats_interval = c.LoadBalancingSwitch.statsInterval
+        self.service = pipesim.ip_to_int("10.255.255.254")
+        self.subnet = pipesim.ip_to_int(self.switch.subnet + ".0.0")
+
+    def weights(self):
+        # The servers of Project1 are alike, its weights are the shares of the subnet it gives them.
+        return [1] * len(self.server_ips)
+
+    def fold(self, src):
+        return (src & np.uint32(0xffff)) | np.uint32(self.subnet)
+
+    def stats_received(self, body):
+        self.switch.flowStatsReceived(self.datapath, body)
+
+
+class Project2(object):
+    """
+    A MicDekLoad under replay, with its installed rules.
+    """
+    def __init__(self, num_servers, compilation):
+        import flowbatch
+        import loadbalancerconfig
+        import micdekload
+        micdekload.MicDekLoad.compilation_mode = compilation
+        with Quiet():
+            (self.app, self.datapath, ranges, self.server_ips) = pipesim.build_micdekload(create_servers(num_servers))
+        # As start_flow_stats does, without scheduling the requests.
+        self.app.last_packets[self.datapath.id] = [0] * self.app.number_of_servers
+        self.app.skip_partition[self.datapath.id] = True
+        self.handle_barrier_reply = flowbatch.handle_barrier_reply
+        self.stats_interval = micdekload.MicDekLoad.stats_interval
+        self.service = pipesim.ip_to_int(loadbalancerconfig.virtual_server[1])
+
+    def weights(self):
+        return self.app.servers.weights()
+
+    def fold(self, src):
+        return src
+
+    def stats_received(self, body):
+        self.app.flow_stats_received(self.datapath, body)
+
+
+def settle(target, pipeline, counters, cursor):
+    """
+    Applies the messages the controller sent since the cursor to the tables, then answers its
+    barriers as the switch would, until it sends no more. Returns (cursor, rules changed).
+    """
+    datapath = target.datapath
+    changes = 0
+    while cursor < len(datapath.msgs):
+        msgs = datapath.msgs[cursor:]
+        cursor = len(datapath.msgs)
+        pipeline.apply(msgs)
+        counters.sync()
+        changes += len([msg for msg in msgs if isinstance(msg, (ofproto_v1_3_parser.OFPFlowMod, ofproto_v1_3_parser.OFPGroupMod))])
+        for msg in msgs:
+            if isinstance(msg, ofproto_v1_3_parser.OFPBarrierRequest):
+                reply = ofproto_v1_3_parser.OFPBarrierReply(datapath)
+                reply.xid = msg.xid
+                with Quiet():
+                    target.handle_barrier_reply(reply)
+    return (cursor, changes)
+
+
+class Interval(object):
+    """
+    The packets of an interval, classified in chunks as they are read.
+    """
+    def __init__(self, num_servers):
+        self.packets = 0
+        self.loads = np.zeros(num_servers, dtype=np.int64)
+        self.hits = {}
+
+    def classify(self, target, pipeline, sources, fold):
+        src = np.array(sources, dtype=np.uint32)
+        if fold:
+            src = target.fold(src)
+        packets = pipeline.classify(src, np.full(len(src), target.service, dtype=np.uint32))
+        servers = pipesim.actual_servers(packets, target.server_ips)
+        self.packets += len(src)
+        self.loads += np.bincount(servers[servers >= 0], minlength=len(self.loads))
+        for (key, hits) in packets.rule_hits.items():
+            self.hits[key] = self.hits.get(key, 0) + hits
+
+
+def replay(target, packets, interval, chunk, fold):
+    """
+    Drives the controller with the packets in virtual time. Yields a row for every interval -
+    (start time, packets, packets of every server, rules changed after it, rules).
+    """
+    pipeline = pipesim.Pipeline()
+    counters = Counters(pipeline)
+    (cursor, changes) = settle(target, pipeline, counters, 0)
+    num_servers = len(target.server_ips)
+    start = None
+    current = Interval(num_servers)
+    sources = []
+    for (time, src, dst) in packets:
+        if start is None:
+            start = time
+        while time >= start + interval:
+            if sources:
+                current.classify(target, pipeline, sources, fold)
+                sources = []
+            counters.add(current.hits)
+            with Quiet():
+                target.stats_received(counters.body())
+            (cursor, changes) = settle(target, pipeline, counters, cursor)
+            yield (start, current.packets, current.loads.tolist(), changes, pipeline.num_rules())
+            start += interval
+            current = Interval(num_servers)
+        sources += [src]
+        if len(sources) >= chunk:
+            current.classify(target, pipeline, sources, fold)
+            sources = []
+    if start is not None:
+        # The last interval is partial, its traffic is reported without a stats reply.
+        if sources:
+            current.classify(target, pipeline, sources, fold)
+        yield (start, current.packets, current.loads.tolist(), 0, pipeline.num_rules())
+
+
+def ip_list(text):
+    return set(pipesim.ip_to_int(ip) for ip in text.split(","))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay packet captures through a load balancer in virtual time.")
+    parser.add_argument("captures", nargs="+")
+    parser.add_argument("--project", type=int, choices=(1, 2), default=1)
+    parser.add_argument("--servers", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=10, help="learned clients (Project1 only)")
+    parser.add_argument("--interval", type=float, default=None, help="seconds of a stats interval, by default the controller's")
+    parser.add_argument("--compilation", choices=("auto", "elcp", "prefix"), default="auto")
+    parser.add_argument("--dst", type=ip_list, default=None, help="only replay packets to these addresses, e.g. of the servers")
+    parser.add_argument("--chunk", type=int, default=1000000, help="packets classified at once")
+    parser.add_argument("--no-fold", dest="fold", action="store_false", help="do not fold the sources into the subnet of Project1")
+    parser.add_argument("--output", default=None, help="CSV file of the curves")
+    args = parser.parse_args()
+
+    if args.project == 1:
+        target = Project1(args.servers, args.clients, args.compilation)
+    else:
+        target = Project2(args.servers, args.compilation)
+    interval = args.interval or target.stats_interval
+    fold = args.fold and args.project == 1
+    output = open(args.output, "w") if args.output else None
+    if output:
+        output.write("time,packets,imbalance,changes,rules,%s\n" %(",".join(target.server_ips), ))
+    print "%10s %10s %9s %8s %8s" %("time", "packets", "imbalance", "changes", "rules")
+    (first, imbalances, changes, rebalances, total) = (None, [], 0, 0, 0)
+    for (start, packets, loads, changed, rules) in replay(target, read_captures(args.captures, args.dst), interval, args.chunk, fold):
+        first = start if first is None else first
+        ratio = imbalance(loads, target.weights())
+        if packets:
+            imbalances += [ratio]
+        changes += changed
+        rebalances += 1 if changed else 0
+        total += packets
+        print "%10.1f %10d %9.3f %8d %8d" %(start - first, packets, ratio, changed, rules)
+        if output:
+            output.write("%.3f,%d,%.4f,%d,%d,%s\n" %(start - first, packets, ratio, changed, rules, ",".join(str(load) for load in loads)))
+    if output:
+        output.close()
+    if not imbalances:
+        print "No IPv4 packets to replay"
+        return
+    print "%d packets, %d rebalances, %d rules changed, imbalance mean %.3f p95 %.3f max %.3f" %(
+        total, rebalances, changes, sum(imbalances) / len(imbalances), percentile(imbalances, 0.95), max(imbalances))
+
+
+if __name__ == "__main__":
+    main()